@@ -0,0 +1,211 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from Function.LineApi import FLEX_CAROUSEL_LIMIT
+from Function.LineQuota import MODE_DIGEST, parse_digest_times, next_digest_time
+
+
+class BookingCoalescer:
+    """短時間に続けて届いた予約を1通のカルーセルにまとめて送信する
+
+    - 直前の送信からwindow秒以上空いていれば、予約はすぐに単体で送信する
+    - window秒以内に届いた予約はバッファに溜め、windowの終わりにまとめて送信する
+    - 1通に入れるのは最大12件で、それを超える分は複数通に分ける
+    - 通知先の組み合わせが異なる予約は別のカルーセルにする
+    LINEの月間メッセージ数が予算を超えそうな間（QuotaBudgetがdigestモードの間）は、
+    予約をすべて溜めておき、LINE_DIGEST_TIMESの時刻にまとめて送信する。
+    まとめ送信待ちの予約はLINE_DIGEST_FILEに保存し、on_heldにキーを渡して知らせる
+    （台帳の再処理の対象から外れ、再起動後は保存したものから送信する）。
+    送信できた予約はon_deliveredにキー（message_id）を渡して知らせる。
+    送信できなかった予約は通知済みにならないため、台帳の再処理で再送される。
+    """
+
+    def __init__(self, line_api, window=None, on_delivered=None, digest_times=None, on_held=None, digest_file=None):
+        self.line_api = line_api
+        self.window = float(window if window is not None else os.getenv("LINE_COALESCE_WINDOW", "10"))
+        self.on_delivered = on_delivered
+        self.on_held = on_held
+        self.digest_times = parse_digest_times(digest_times or os.getenv("LINE_DIGEST_TIMES", "09:00,13:00,18:00"))
+        self.digest_file = digest_file if digest_file is not None else os.getenv("LINE_DIGEST_FILE", "line_digest.json")
+
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._timer = None
+        self._quiet_until = 0.0
+        self._digest = {}  # キー → 予約情報（同じ予約を再処理しても1件にする）
+        self._digest_timer = None
+        self._digest_at = None
+
+        # 前回の停止時にまとめ送信待ちだった予約を引き継ぐ
+        self._load_digest()
+
+    def submit(self, key, booking_info):
+        """予約を送信またはバッファに追加
+
+        すぐに送信した場合はその結果を、バッファに溜めた場合はNoneを返す。
+        """
+        quota = self.line_api.quota
+        if quota:
+            quota.record_demand(len(self.line_api.recipients_for([booking_info])))
+            if quota.current_mode() == MODE_DIGEST:
+                return self._hold_for_digest(key, booking_info)
+            if self._digest:
+                # 予約ごとの送信に戻ったら、まとめ送信待ちの予約を先に送る
+                self.flush_digest()
+
+        with self._lock:
+            now = time.time()
+            if not self._buffer and now >= self._quiet_until:
+                self._quiet_until = now + self.window
+                immediate = True
+            else:
+                self._buffer.append((key, booking_info))
+                self._start_timer(now)
+                immediate = False
+
+        if not immediate:
+            print(f"📦 予約をまとめ送信待ちに追加しました（{len(self._buffer)}件）")
+            return None
+
+        with self._send_lock:
+            sent = self.line_api.send_booking_flex_message(booking_info, keys=[key])
+        if sent:
+            self._delivered([key])
+        return sent
+
+    def flush(self):
+        """バッファに溜まった予約をまとめて送信"""
+        with self._lock:
+            pending, self._buffer = self._buffer, []
+            self._timer = None
+            self._quiet_until = time.time() + self.window
+
+        # 通知先の組み合わせが同じ予約ごとにまとめる
+        groups = {}
+        for key, booking_info in pending:
+            recipients = tuple(self.line_api.recipients_for([booking_info]))
+            groups.setdefault(recipients, []).append((key, booking_info))
+
+        with self._send_lock:
+            for group in groups.values():
+                for start in range(0, len(group), FLEX_CAROUSEL_LIMIT):
+                    chunk = group[start:start + FLEX_CAROUSEL_LIMIT]
+                    keys = [key for key, _ in chunk]
+                    sent = self.line_api.send_booking_carousel([info for _, info in chunk], keys=keys)
+                    if sent:
+                        self._delivered(keys)
+
+        return len(pending)
+
+    def flush_digest(self):
+        """まとめ送信待ちの予約を、通知先の組み合わせごとに1回のリクエストで送信
+
+        送信できなかった予約はまとめ送信待ちに戻し、次の時刻に送り直す。
+        """
+        with self._lock:
+            pending, self._digest = list(self._digest.items()), {}
+            timer, self._digest_timer = self._digest_timer, None
+        if timer:
+            timer.cancel()
+        if not pending:
+            return 0
+
+        groups = {}
+        for key, booking_info in pending:
+            recipients = tuple(self.line_api.recipients_for([booking_info]))
+            groups.setdefault(recipients, []).append((key, booking_info))
+
+        print(f"🗓️ まとめ送信: {len(pending)}件の予約を送信します")
+        failed = []
+        with self._send_lock:
+            for group in groups.values():
+                keys = [key for key, _ in group]
+                sent = self.line_api.send_booking_digest([info for _, info in group], keys=keys)
+                if sent is False:
+                    failed.extend(group)
+                elif sent:
+                    self._delivered(keys)
+
+        with self._lock:
+            # 送信中に追加された予約の前に戻す
+            self._digest = {**dict(failed), **self._digest}
+            if self._digest:
+                self._schedule_digest()
+            self._save_digest()
+        if failed:
+            print(f"⚠️ まとめ送信できなかった {len(failed)}件を次の時刻に送り直します")
+
+        return len(pending) - len(failed)
+
+    def close(self):
+        """タイマーを止めて、残っている予約を送信（まとめ送信待ちの予約は保存したまま次回の起動に引き継ぐ）"""
+        with self._lock:
+            timer, self._timer = self._timer, None
+            digest_timer, self._digest_timer = self._digest_timer, None
+        for pending_timer in (timer, digest_timer):
+            if pending_timer:
+                pending_timer.cancel()
+        self.flush()
+
+    def _hold_for_digest(self, key, booking_info):
+        with self._lock:
+            self._digest[key] = booking_info
+            count = len(self._digest)
+            self._schedule_digest()
+            self._save_digest()
+            digest_at = self._digest_at
+
+        if self.on_held:
+            self.on_held(key)
+        print(f"🗓️ 予約をまとめ送信（{digest_at:%H:%M}）待ちに追加しました（{count}件）")
+        return None
+
+    def _schedule_digest(self):
+        # 呼び出し元でロックを取得済み
+        if self._digest_timer is not None:
+            return
+        now = datetime.now()
+        self._digest_at = next_digest_time(now, self.digest_times)
+        self._digest_timer = threading.Timer((self._digest_at - now).total_seconds(), self.flush_digest)
+        self._digest_timer.daemon = True
+        self._digest_timer.start()
+
+    def _load_digest(self):
+        if not self.digest_file or not os.path.exists(self.digest_file):
+            return
+        with open(self.digest_file, encoding='utf-8') as f:
+            entries = json.load(f)
+        if not entries:
+            return
+
+        with self._lock:
+            self._digest = {entry['key']: entry['booking_info'] for entry in entries}
+            self._schedule_digest()
+            digest_at = self._digest_at
+        print(f"🗓️ 前回のまとめ送信待ち {len(entries)}件を引き継ぎました（{digest_at:%H:%M} に送信）")
+
+    def _save_digest(self):
+        # 呼び出し元でロックを取得済み（一時ファイルに書いてから置き換える）
+        if not self.digest_file:
+            return
+        entries = [{'key': key, 'booking_info': booking_info} for key, booking_info in self._digest.items()]
+        temp_file = f'{self.digest_file}.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(temp_file, self.digest_file)
+
+    def _start_timer(self, now):
+        # 呼び出し元でロックを取得済み
+        if self._timer is not None:
+            return
+        self._timer = threading.Timer(max(0.0, self._quiet_until - now), self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _delivered(self, keys):
+        if self.on_delivered:
+            for key in keys:
+                self.on_delivered(key)
@@ -0,0 +1,144 @@
+import re
+
+# フィールドごとの抽出パターン（上にあるものほど優先）
+# 各パターンは必ず先頭のラベル文字列から始まる
+FIELD_PATTERNS = {
+    'tour_name': [
+        r'booked:\s*([^\n]*(?:Tokyo|Private|Customizable|Tour)[^\n]*)',
+        r'following offer has been booked:\s*([^\n]+)',
+        r'booked:\s*([^\n]{15,})',
+    ],
+    'options': [
+        r'Option:\s*([^\n]+)',
+        r'(Option:[^\n]+)',
+    ],
+    'date': [
+        r'Date:\s*([^\n]+)',
+        r'Date\s+([^\n]+)',
+    ],
+    'price': [
+        r'Price:\s*([^\n]+)',
+        r'Price\s+([^\n]+)',
+    ],
+    'reference': [
+        r'Reference number:\s*([^\n]+)',
+        r'Reference number\s+([^\n]+)',
+    ],
+    'customer_name': [
+        r'Main customer:\s*([^\n]+)',
+        r'Customer:\s*([^\n]+)',
+    ],
+    'phone': [
+        r'Phone:\s*([^\n]+)',
+        r'Phone\s+([^\n]+)',
+    ],
+    'language': [
+        r'Language:\s*([^\n]+)',
+        r'Language\s+([^\n]+)',
+    ],
+    'tour_language': [
+        r'Tour language:\s*([^\n]+)',
+        r'Tour language\s+([^\n]+)',
+    ],
+    'pickup_location': [
+        r'Pickup location:\s*([^\n]+)',
+        r'Pickup:\s*([^\n]+)',
+        r'Pickup location\s+([^\n]+)',
+    ],
+}
+
+_FLAGS = re.IGNORECASE | re.MULTILINE
+
+# ラベル（小文字）→ そのラベルで始まるパターンの一覧 [(フィールド, 優先順位, パターン)]
+_LABEL_ENTRIES = {
+    'following offer has been booked:': [('tour_name', 1)],
+    'booked:': [('tour_name', 0), ('tour_name', 2)],
+    'option:': [('options', 0), ('options', 1)],
+    'date': [('date', 0), ('date', 1)],
+    'price': [('price', 0), ('price', 1)],
+    'reference number': [('reference', 0), ('reference', 1)],
+    'main customer:': [('customer_name', 0)],
+    'customer:': [('customer_name', 1)],
+    'phone': [('phone', 0), ('phone', 1)],
+    'tour language': [('tour_language', 0), ('tour_language', 1)],
+    'language': [('language', 0), ('language', 1)],
+    'pickup': [('pickup_location', 0), ('pickup_location', 1), ('pickup_location', 2)],
+}
+
+# ラベル → コンパイル済みパターンの一覧（モジュール読み込み時に1度だけコンパイル）
+_LABEL_DISPATCH = [
+    (label, [(field, index, re.compile(FIELD_PATTERNS[field][index], _FLAGS)) for field, index in entries])
+    for label, entries in _LABEL_ENTRIES.items()
+]
+
+
+def compile_field_patterns(field_patterns):
+    """フィールド → パターンの一覧 をコンパイル済みのパターンにする"""
+    return {
+        field: [re.compile(pattern, _FLAGS) for pattern in patterns]
+        for field, patterns in field_patterns.items()
+    }
+
+
+# フォールバック用：フィールドごとのコンパイル済みパターン
+_COMPILED_PATTERNS = compile_field_patterns(FIELD_PATTERNS)
+
+# lower()で文字数が変わる、またはIGNORECASEでASCII文字と一致するのにlower()では一致しない文字
+_CASE_FOLD_HAZARDS = ('\u0130', '\u0131', '\u017f')
+
+
+def extract_booking_fields(text_content):
+    """テキストから予約情報を抽出
+
+    小文字化したテキストを1度だけ作り、ラベルの出現位置から該当するパターンだけを
+    その位置で照合する。結果はフィールドごとに FIELD_PATTERNS を上から順に
+    re.search した場合と同じになる。
+    """
+    lowered = text_content.lower()
+    if len(lowered) != len(text_content) or any(c in text_content for c in _CASE_FOLD_HAZARDS):
+        return _extract_by_search(text_content)
+
+    # パターンごとに最初に一致した位置の値だけを記録する
+    first_matches = {}
+    for label, entries in _LABEL_DISPATCH:
+        remaining = len(entries)
+        position = lowered.find(label)
+        while position != -1 and remaining:
+            for field, index, pattern in entries:
+                if (field, index) in first_matches:
+                    continue
+                match = pattern.match(text_content, position)
+                if match:
+                    first_matches[(field, index)] = match.group(1).strip().replace('*', '')
+                    remaining -= 1
+            position = lowered.find(label, position + 1)
+
+    booking_info = {}
+    for field, patterns in FIELD_PATTERNS.items():
+        for index in range(len(patterns)):
+            value = first_matches.get((field, index))
+            if value:
+                booking_info[field] = value
+                break
+
+    return booking_info
+
+
+def _extract_by_search(text_content, compiled_patterns=_COMPILED_PATTERNS):
+    """パターンを優先順に検索して抽出（特殊な大文字小文字を含むテキストや、設定ファイルで追加したプラットフォーム用）"""
+    booking_info = {}
+    for field, patterns in compiled_patterns.items():
+        for pattern in patterns:
+            match = pattern.search(text_content)
+            if match:
+                value = match.group(1).strip().replace('*', '')
+                if value:
+                    booking_info[field] = value
+                    break
+    return booking_info
+
+
+def pattern_extractor(field_patterns):
+    """フィールドごとのパターンから抽出関数を作る（パターンは上にあるものほど優先）"""
+    compiled_patterns = compile_field_patterns(field_patterns)
+    return lambda text_content: _extract_by_search(text_content, compiled_patterns)
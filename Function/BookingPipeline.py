@@ -0,0 +1,104 @@
+import asyncio
+import os
+import time
+
+
+class BookingPipeline:
+    """Gmailの取得・解析・LINE送信を独立したステージで動かすasyncioランナー
+
+    各ステージは上限付きキューでつながっており、後段が詰まると前段が待たされる
+    （バックプレッシャー）。LINE送信が遅くてもポーリング間隔は保たれる。
+    """
+
+    def __init__(self, monitor, line_api, sender_email, interval=30, queue_size=None, scheduler=None):
+        self.monitor = monitor
+        self.line_api = line_api
+        self.sender_email = sender_email
+        self.interval = interval
+        # 指定があればポーリング間隔をスケジューラに任せる
+        self.scheduler = scheduler
+        self.queue_size = queue_size or int(os.getenv("PIPELINE_QUEUE_SIZE", "100"))
+
+        self.parse_queue = None
+        self.deliver_queue = None
+        self._pending_poll = None
+
+    async def run(self):
+        """3つのステージを起動して停止されるまで動かし続ける"""
+        self.parse_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.deliver_queue = asyncio.Queue(maxsize=self.queue_size)
+
+        await asyncio.gather(
+            self._fetch_stage(),
+            self._parse_stage(),
+            self._deliver_stage(),
+        )
+
+    async def _fetch_stage(self):
+        """一定間隔でGmailをポーリングし、取得したメッセージを解析キューへ送る"""
+        loop = asyncio.get_running_loop()
+
+        while True:
+            started = loop.time()
+
+            # 前回のポーリングが応答待ちのままなら新しいリクエストは出さない
+            if self._pending_poll is None:
+                self._pending_poll = asyncio.ensure_future(
+                    asyncio.to_thread(self.monitor.poll_new_messages, self.sender_email)
+                )
+
+            done, _ = await asyncio.wait({self._pending_poll}, timeout=self.interval)
+            if done:
+                poll, self._pending_poll = self._pending_poll, None
+                try:
+                    messages = poll.result()
+                    if self.scheduler:
+                        self.scheduler.record_success(len(messages))
+                except Exception as error:
+                    print(f'Gmail APIエラー: {error}')
+                    messages = []
+                    if self.scheduler:
+                        self.scheduler.record_error()
+
+                if not messages:
+                    print(f"📭 新着メールなし ({time.strftime('%H:%M:%S')})")
+                for message_id, message in messages:
+                    # キューが満杯なら解析が追いつくまで待つ
+                    await self.parse_queue.put((message_id, message))
+
+                # 送信に失敗した予約（parsedのまま）を同期モードと同じ間隔で再送する
+                # （Gmailのクライアントを同時に使わないよう、ポーリングが終わっている間に行う）
+                await asyncio.to_thread(self.monitor.retry_pending_if_due, self.line_api, self.sender_email)
+            else:
+                print("⚠️ Gmailの応答待ち - 次の周期で再確認します")
+
+            # 処理にかかった時間を差し引き、ポーリング間隔を一定に保つ
+            if self.scheduler and done:
+                await asyncio.sleep(self.scheduler.seconds_until_next_run())
+            else:
+                elapsed = loop.time() - started
+                await asyncio.sleep(max(0, self.interval - elapsed))
+
+    async def _parse_stage(self):
+        """メッセージから予約情報を抽出して送信キューへ送る"""
+        while True:
+            message_id, message = await self.parse_queue.get()
+            try:
+                booking_info = await asyncio.to_thread(self.monitor.parse_message, message_id, message)
+                if booking_info:
+                    await self.deliver_queue.put((message_id, booking_info))
+            finally:
+                self.parse_queue.task_done()
+
+    async def _deliver_stage(self):
+        """予約情報をLINEへFlex Messageとして送信"""
+        while True:
+            message_id, booking_info = await self.deliver_queue.get()
+            try:
+                sent = await asyncio.to_thread(self.monitor.notify, message_id, booking_info, self.line_api)
+                if sent:
+                    print(f"🔔 メッセージ {message_id} のFlex Message送信完了")
+            except Exception as error:
+                print(f"❌ LINE送信中にエラー: {error}")
+            finally:
+                self.deliver_queue.task_done()
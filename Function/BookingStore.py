@@ -0,0 +1,240 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from Function.MailTriage import KIND_BOOKING, KIND_CANCELLATION, KIND_AMENDMENT
+
+# 予約の状態
+STATUS_BOOKED = 'booked'
+STATUS_AMENDED = 'amended'
+STATUS_CANCELLED = 'cancelled'
+
+# メールの種類 → 記録後の予約の状態
+_STATUS_FOR_KIND = {
+    KIND_BOOKING: STATUS_BOOKED,
+    KIND_AMENDMENT: STATUS_AMENDED,
+    KIND_CANCELLATION: STATUS_CANCELLED,
+}
+
+# 変更点として比べる項目と表示名（LINEのバブルと同じ表記）
+DIFF_FIELDS = {
+    'tour_name': 'Tour',
+    'options': 'Option',
+    'date': 'Date',
+    'price': 'Price',
+    'customer_name': 'Customer',
+    'phone': 'Phone',
+    'language': 'Language',
+    'tour_language': 'Tour language',
+    'pickup_location': 'Pickup',
+}
+
+# ツアー日時の書式（GetYourGuide: "Monday, November 24, 2025 at 10:00 AM"）
+_DATE_FORMATS = (
+    '%A, %B %d, %Y at %I:%M %p',
+    '%B %d, %Y at %I:%M %p',
+    '%A, %B %d, %Y',
+    '%B %d, %Y',
+    '%A, %d %B %Y at %H:%M',
+    '%d %B %Y at %H:%M',
+    '%d %B %Y',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d',
+)
+
+# 日時の後ろに付く補足（"(Local time)" や "GMT+9" など）
+_DATE_SUFFIX = re.compile(r'\s*(\(.*\)|(GMT|UTC)[+-]?[\d:]*)\s*$', re.IGNORECASE)
+
+
+def parse_tour_date(text):
+    """予約メールの日時の表記を 'YYYY-MM-DD HH:MM' にする（解釈できなければNone）
+
+    文字列として並べると時刻順になるため、そのままインデックスで範囲検索できる。
+    """
+    if not text:
+        return None
+    text = _DATE_SUFFIX.sub('', ' '.join(text.split()))
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).strftime('%Y-%m-%d %H:%M')
+        except ValueError:
+            continue
+    return None
+
+
+def format_changes(changes):
+    """変更点を「項目: 変更前 → 変更後」の行にまとめる（状態の変化は見出しで表すため含めない）"""
+    return '\n'.join(
+        f"{DIFF_FIELDS[field]}: {old or '-'} → {new or '-'}"
+        for field, (old, new) in changes.items()
+        if field in DIFF_FIELDS
+    )
+
+
+class BookingStore:
+    """抽出した予約をreferenceごとに保存するSQLiteのストア
+
+    - referenceを主キーにしているため、キャンセル・変更のメールは該当の予約を
+      インデックス経由で引いて更新できる
+    - ツアー日時（'YYYY-MM-DD HH:MM'）とツアー名にインデックスがあり、
+      日ごとの予約一覧をGmailに問い合わせずに範囲検索で作れる
+    MessageLedgerと同じくWALモードで、書き込み中も読み取りを妨げない。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS bookings (
+                    reference TEXT PRIMARY KEY,
+                    platform TEXT,
+                    tour_name TEXT,
+                    tour_date TEXT,
+                    status TEXT NOT NULL,
+                    info TEXT NOT NULL,
+                    message_id TEXT,
+                    changes TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_tour_date ON bookings (tour_date)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_tour_name ON bookings (tour_name, tour_date)")
+
+    @classmethod
+    def from_env(cls):
+        """BOOKING_STORE_DBのストアを開く（空なら保存しない）"""
+        db_path = os.getenv("BOOKING_STORE_DB", "bookings.db")
+        return cls(db_path) if db_path else None
+
+    def record(self, booking_info, kind=KIND_BOOKING, message_id=None):
+        """予約メールの内容を保存し、既存の予約からの変更点 {項目: (変更前, 変更後)} を返す
+
+        キャンセル・変更のメールは、メールにある項目だけで既存の予約を上書きする。
+        referenceのない予約は保存できないためNoneを返す。
+        同じメールを再処理した場合は、前回記録した変更点をそのまま返す。
+        """
+        reference = booking_info.get('reference')
+        if not reference:
+            return None
+
+        status = _STATUS_FOR_KIND.get(kind, STATUS_BOOKED)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT info, status, message_id, changes FROM bookings WHERE reference = ?", (reference,)
+                ).fetchone()
+
+                if row is not None and message_id and row[2] == message_id:
+                    self._conn.execute("COMMIT")
+                    return {field: tuple(values) for field, values in json.loads(row[3] or '{}').items()}
+
+                if row is None:
+                    merged, changes = dict(booking_info), {}
+                else:
+                    previous = json.loads(row[0])
+                    merged = {**previous, **booking_info}
+                    changes = {
+                        field: (previous.get(field), merged.get(field))
+                        for field in DIFF_FIELDS
+                        if previous.get(field) != merged.get(field)
+                    }
+                    if row[1] != status:
+                        changes['status'] = (row[1], status)
+
+                self._conn.execute(
+                    """
+                    INSERT INTO bookings
+                        (reference, platform, tour_name, tour_date, status, info, message_id, changes, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (reference) DO UPDATE SET
+                        platform = excluded.platform,
+                        tour_name = excluded.tour_name,
+                        tour_date = excluded.tour_date,
+                        status = excluded.status,
+                        info = excluded.info,
+                        message_id = excluded.message_id,
+                        changes = excluded.changes,
+                        updated_at = excluded.updated_at
+                    """,
+                    (
+                        reference,
+                        merged.get('platform'),
+                        merged.get('tour_name'),
+                        parse_tour_date(merged.get('date')),
+                        status,
+                        json.dumps(merged, ensure_ascii=False),
+                        message_id,
+                        json.dumps(changes, ensure_ascii=False),
+                        now,
+                        now,
+                    )
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return changes
+
+    def get(self, reference):
+        """referenceの予約を返す（なければNone）"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT info, status, tour_date FROM bookings WHERE reference = ?", (reference,)
+            ).fetchone()
+        return self._to_booking(row) if row else None
+
+    def between(self, start, end, tour_name=None, include_cancelled=False):
+        """ツアー日時が start 以上 end 未満の予約を日時順に返す（datetimeまたは'YYYY-MM-DD HH:MM'）"""
+        conditions = ["tour_date >= ?", "tour_date < ?"]
+        params = [self._date_key(start), self._date_key(end)]
+        if tour_name:
+            conditions.append("tour_name = ?")
+            params.append(tour_name)
+        if not include_cancelled:
+            conditions.append("status != ?")
+            params.append(STATUS_CANCELLED)
+
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT info, status, tour_date FROM bookings WHERE {' AND '.join(conditions)} ORDER BY tour_date",
+                params
+            ).fetchall()
+        return [self._to_booking(row) for row in rows]
+
+    def roster(self, day, tour_name=None, include_cancelled=False):
+        """dayの日（date / datetime）にツアーがある予約を返す"""
+        start = datetime(day.year, day.month, day.day)
+        return self.between(start, start + timedelta(days=1), tour_name, include_cancelled)
+
+    def tour_names(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT tour_name FROM bookings WHERE tour_name IS NOT NULL ORDER BY tour_name"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _date_key(value):
+        return value.strftime('%Y-%m-%d %H:%M') if isinstance(value, datetime) else value
+
+    @staticmethod
+    def _to_booking(row):
+        booking = json.loads(row[0])
+        booking['status'] = row[1]
+        booking['tour_date'] = row[2]
+        return booking
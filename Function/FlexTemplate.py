@@ -0,0 +1,153 @@
+# 値が入る場所の目印（予約情報には現れない文字列）
+_SLOT_MARK = '\x00slot:'
+
+# 予約情報に項目がない場合の表示（LineApi._build_booking_bubbleと同じ）
+FIELD_DEFAULTS = {
+    'platform': 'Booking',
+    'tour_name': 'Tour Booking',
+    'options': '',
+    'date': 'Not specified',
+    'price': 'Not specified',
+    'customer_name': 'Not specified',
+    'phone': 'Not specified',
+    'language': 'Not specified',
+    'tour_language': 'Not specified',
+    'pickup_location': 'Not specified',
+    'reference': 'Not specified',
+    'changes': '',
+}
+
+# 値があるときだけ行が表示される項目（有無の組み合わせごとに骨組みを作る）
+OPTIONAL_FIELDS = ('options', 'phone', 'pickup_location', 'changes')
+
+# 値によってバブルの構成が変わる項目（メールの種類で見出しが変わる）。値ごとに骨組みを作る
+STRUCTURAL_FIELDS = ('kind',)
+
+
+class RawMessage:
+    """組み立て済みのJSON（dict）をそのまま送るためのメッセージ
+
+    SDKのpush_messageは各メッセージのas_json_dict()を送信するため、
+    SendMessageの代わりに渡せば再変換なしで送信できる。
+    """
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def as_json_dict(self):
+        return self.payload
+
+
+def _slot(field):
+    return f'{_SLOT_MARK}{field}\x00'
+
+
+def _compile(node):
+    """骨組みから、スロットに値を入れた構造を返す関数を作る（スロットがなければNone）
+
+    スロットを含まない部分は毎回同じオブジェクトを共有し、
+    スロットまでの経路にあるdict・listだけを新しく作る。
+    """
+    if isinstance(node, str):
+        if node.startswith(_SLOT_MARK):
+            field = node[len(_SLOT_MARK):-1]
+            default = FIELD_DEFAULTS[field]
+            return lambda info: info.get(field, default)
+        return None
+
+    if isinstance(node, dict):
+        dynamic = [(key, fn) for key, fn in ((key, _compile(value)) for key, value in node.items()) if fn]
+        if not dynamic:
+            return None
+
+        def render_dict(info):
+            rendered = dict(node)
+            for key, fn in dynamic:
+                rendered[key] = fn(info)
+            return rendered
+        return render_dict
+
+    if isinstance(node, list):
+        dynamic = [(index, fn) for index, fn in ((index, _compile(value)) for index, value in enumerate(node)) if fn]
+        if not dynamic:
+            return None
+
+        def render_list(info):
+            rendered = list(node)
+            for index, fn in dynamic:
+                rendered[index] = fn(info)
+            return rendered
+        return render_list
+
+    return None
+
+
+class BubbleTemplate:
+    """予約バブルのJSONを骨組みから組み立てるレンダラ
+
+    予約のたびにSDKのComponentを40個ほど組み立ててJSONへ戻す代わりに、
+    SDKで一度だけ組み立てたバブルのJSONを骨組みとして使い回し、
+    予約ごとに値の入る場所（スロット）だけを差し替える。
+    build_bubbleにはSDKでバブルを組み立てる関数（LineApi._build_booking_bubble）を渡す。
+    任意項目の有無の組み合わせごとに初回だけSDKで骨組みを作り、
+    SDKの出力と一致することを確認してから使う。
+    """
+
+    def __init__(self, build_bubble):
+        self.build_bubble = build_bubble
+        self._renderers = {}
+
+    def render(self, booking_info):
+        """予約情報からバブルのJSON（dict）を返す"""
+        variant = (
+            tuple(booking_info.get(field) for field in STRUCTURAL_FIELDS),
+            tuple(bool(booking_info.get(field)) for field in OPTIONAL_FIELDS),
+        )
+        renderer = self._renderers.get(variant)
+        if renderer is None:
+            renderer = self._renderers[variant] = self._compile_variant(variant)
+        return renderer(booking_info)
+
+    def render_message(self, booking_info, alt_text="New Booking Received"):
+        """1件分のFlex Message（送信用）を返す"""
+        return RawMessage({'type': 'flex', 'altText': alt_text, 'contents': self.render(booking_info)})
+
+    def render_carousel_message(self, booking_infos, alt_text):
+        """複数件をまとめたカルーセルのFlex Message（送信用）を返す"""
+        return RawMessage({
+            'type': 'flex',
+            'altText': alt_text,
+            'contents': {'type': 'carousel', 'contents': [self.render(info) for info in booking_infos]},
+        })
+
+    def precompile(self, structures=((None,),)):
+        """構成（STRUCTURAL_FIELDSの値の組）ごとに、任意項目の有無のすべての組み合わせの骨組みを先に作っておく"""
+        for structure in structures:
+            for bits in range(2 ** len(OPTIONAL_FIELDS)):
+                presence = tuple(bool(bits >> index & 1) for index in range(len(OPTIONAL_FIELDS)))
+                variant = (tuple(structure), presence)
+                if variant not in self._renderers:
+                    self._renderers[variant] = self._compile_variant(variant)
+
+    def _compile_variant(self, variant):
+        structure, presence = variant
+        fixed = {field: value for field, value in zip(STRUCTURAL_FIELDS, structure) if value is not None}
+        present = dict(zip(OPTIONAL_FIELDS, presence))
+        placeholders = {
+            field: _slot(field) for field in FIELD_DEFAULTS
+            if present.get(field, True)
+        }
+        renderer = _compile(self.build_bubble({**placeholders, **fixed}).as_json_dict())
+
+        # 項目が欠けている予約でも、SDKで組み立てた場合と同じになることを確認する
+        sample = {
+            field: f'sample {field}' for field in OPTIONAL_FIELDS
+            if present[field]
+        }
+        sample.update(fixed)
+        expected = self.build_bubble(sample).as_json_dict()
+        if renderer is None or renderer(sample) != expected:
+            # 一致しない場合は従来どおりSDKで組み立てる
+            print(f"⚠️ バブルの骨組みがSDKの出力と一致しないため、SDKで組み立てます: {present}")
+            return lambda info: self.build_bubble(info).as_json_dict()
+        return renderer
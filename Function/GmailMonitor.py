@@ -1,11 +1,31 @@
 import os
+import json
 import time
+import threading
 from dotenv import load_dotenv
-from datetime import datetime
-from google.auth.transport.requests import Request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
+from Function.BookingExtractor import FIELD_PATTERNS
+from Function.HtmlText import html_to_text
+from Function.TemplateCache import TemplateCache
+from Function.PlatformRegistry import PlatformRegistry, GETYOURGUIDE
+from Function.TokenRefresher import TokenRefresher
+from Function.RateLimiter import TokenBucket, RetryPolicy, is_retryable
+from Function.Metrics import (
+    STAGE_SECONDS, DELIVERY_LAG_SECONDS, MESSAGES_TOTAL, RETRIES_TOTAL, FAILURES_TOTAL
+)
+from Function.MimeParts import PREFERRED_TYPES, find_part, decode_part
+from Function.MailTriage import SubjectTriage, TRIAGE_HEADERS, KIND_BOOKING
+from Function.BookingStore import BookingStore, format_changes
+from Function.MessageLedger import (
+    MessageLedger, STATE_LISTED, STATE_FETCHED, STATE_PARSED, STATE_QUEUED, STATE_HELD, STATE_NOTIFIED, STATE_FAILED, STATE_SKIPPED
+)
 import base64
 import re
 from email.utils import parsedate_to_datetime
@@ -16,41 +36,210 @@ from email.mime.multipart import MIMEMultipart
 # 現在のスコープを以下に変更
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
+# Gmailのバッチリクエスト1回あたりの上限件数
+GMAIL_BATCH_LIMIT = 100
+
+# messages.batchModify 1回あたりの上限件数
+GMAIL_MODIFY_LIMIT = 1000
+
+# 呼び出しごとのクォータ消費量（ユーザーあたり毎秒250ユニットまで）
+GMAIL_QUOTA_COST = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.batchModify': 50,
+    'history.list': 2,
+    'labels.list': 1,
+    'labels.create': 5,
+    'getProfile': 1,
+}
+
+
+def load_discovery_document(cache_file=None):
+    """Gmail APIのディスカバリドキュメントをローカルから読み込む
+
+    build()は呼び出しのたびにドキュメントを探して読み込む（古いgoogle-api-python-clientでは
+    毎回ネットワークから取得する）。一度保存したものをGMAIL_DISCOVERY_FILEから読み、
+    なければライブラリに同梱されたものを保存して使う。APIの定義を更新したい場合は
+    ファイルを削除すれば次回の起動時に作り直される。
+    """
+    cache_file = cache_file if cache_file is not None else os.getenv("GMAIL_DISCOVERY_FILE", "gmail_discovery.json")
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, encoding='utf-8') as f:
+            return json.load(f)
+
+    from googleapiclient.discovery_cache import get_static_doc
+    content = get_static_doc('gmail', 'v1')
+    if content is None:
+        # 同梱されていない古いバージョンではDiscovery APIから取得する
+        from googleapiclient.discovery import DISCOVERY_URI
+        response, content = httplib2.Http().request(DISCOVERY_URI.format(api='gmail', apiVersion='v1'))
+        if response.status != 200:
+            raise RuntimeError(f"ディスカバリドキュメントを取得できません (HTTP {response.status})")
+        content = content.decode('utf-8')
+
+    if cache_file:
+        tmp_file = f'{cache_file}.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_file, cache_file)
+    return json.loads(content)
+
+
+def sender_list(sender_email):
+    """送信者の指定（カンマ区切りの文字列またはリスト）をアドレスのリストにする"""
+    if isinstance(sender_email, str):
+        sender_email = sender_email.split(',')
+    return [sender.strip() for sender in sender_email if sender and sender.strip()]
+
+
+def sender_query(sender_email):
+    """送信者の検索条件（複数の場合は1つのOR条件にまとめる）"""
+    senders = sender_list(sender_email)
+    if len(senders) == 1:
+        return f'from:{senders[0]}'
+    return f'from:({" OR ".join(senders)})'
+
+
+def label_query(label):
+    """ラベル名を検索条件の表記にする（空白や階層の'/'は'-'になる）"""
+    return re.sub(r'[\s/]+', '-', label.strip().lower())
+
 
 class GmailMonitor:
-    def __init__(self):
+    def __init__(self, token_file=None, ledger=None, name=None, bookings=None):
+        """Gmailの監視を初期化
+
+        複数のメールボックスを1プロセスで扱う場合は、メールボックスごとに
+        token_file（認証トークン）とledger（MessageLedger）を分け、nameを付ける。
+        nameを付けると通知のキーが "name/message_id" になり、送信結果を
+        どのメールボックスの台帳に記録するかを区別できる。
+        bookings（BookingStore）はメールボックス間で共有できる。
+        """
         load_dotenv()
+        self.name = name
         self.credentials_file = os.getenv("GMAIL_CREDENTIALS_FILE")
+        self.token_file = token_file or os.getenv("GMAIL_TOKEN_FILE", "token.json")
         self.service = self._authenticate(self.credentials_file)
-        self.last_check = datetime.now()  # 最後にメールをチェックした時刻を記録
+
+        # Gmail APIのクォータに合わせたレート制限と再試行
+        self.gmail_retry = RetryPolicy(
+            'Gmail',
+            bucket=TokenBucket(rate=float(os.getenv("GMAIL_QUOTA_UNITS_PER_SEC", "250"))),
+            max_attempts=int(os.getenv("GMAIL_RETRY_ATTEMPTS", "5")),
+        )
+
+        # 処理状態と同期位置を記録する台帳（再起動後もここから再開する）
+        self.ledger = ledger or MessageLedger(os.getenv("GMAIL_LEDGER_DB", "ledger.db"))
+        self.max_attempts = int(os.getenv("GMAIL_MAX_ATTEMPTS", "5"))
+
+        # 通知に失敗したメッセージを再送するまでの待ち時間（秒）
+        self.retry_pending_after = float(os.getenv("GMAIL_RETRY_PENDING_AFTER", "300"))
+        self._last_pending_retry = time.time()
+
+        # 最後にメールをチェックした時刻（台帳に記録がなければ現在時刻から）
+        watermark = self.ledger.get_watermark('last_check')
+        self._last_check = datetime.fromtimestamp(float(watermark)) if watermark else datetime.now()
+        self.last_error = None  # 直近のチェックで発生したエラー（スケジューラが参照）
+
+        # 差分同期の設定（history: historyIdで差分のみ取得 / query: after:検索）
+        self.sync_mode = os.getenv("GMAIL_SYNC_MODE", "history")
+        self.history_file = os.getenv("GMAIL_HISTORY_FILE", "history_id.txt")
+        self.resync_window_hours = int(os.getenv("GMAIL_RESYNC_WINDOW_HOURS", "24"))
+        self.resync_max_results = int(os.getenv("GMAIL_RESYNC_MAX_RESULTS", "100"))
+        # 差分を絞り込むラベル（既定は全メール。フィルタで受信トレイをスキップした予約メールも拾うため）
+        self.history_label = os.getenv("GMAIL_HISTORY_LABEL", "")
+        self.history_id = self._load_history_id()
+
+        # 直近に処理したメッセージID（after:の秒単位の重複や再同期との重複を除外）
+        self._recent_ids = deque(maxlen=1000)
+
+        # messages().getをまとめて送るバッチのサイズ
+        self.batch_size = min(int(os.getenv("GMAIL_BATCH_SIZE", str(GMAIL_BATCH_LIMIT))), GMAIL_BATCH_LIMIT)
+
+        # 本文を取得する前に件名で予約関連かどうかを判定する
+        self.triage = SubjectTriage()
+        
+        # 送信元と件名から予約プラットフォーム（解析に使うパターン）を選ぶ
+        self.platforms = PlatformRegistry.from_env()
+        
+        # 通知済みのメッセージに付けるラベル（検索条件で除外する、GMAIL_NOTIFIED_LABEL=で無効）
+        # 通知済みにしたメッセージIDを溜めておき、次のポーリングでbatchModifyでまとめて付ける
+        self.notified_label = os.getenv("GMAIL_NOTIFIED_LABEL", "booking-notified")
+        self._notified_label_id = None
+        self._label_pending = []
+        self._label_lock = threading.Lock()
+        
+        # 抽出した予約を保存するストア（キャンセル・変更の照合と予約一覧に使う、BOOKING_STORE_DB=で無効）
+        self.bookings = bookings if bookings is not None else BookingStore.from_env()
+
+        # デコードする本文パートの上限サイズ（異常に大きいメールでメモリを使い切らないように）
+        self.max_part_bytes = int(os.getenv("GMAIL_MAX_PART_BYTES", str(5 * 1024 * 1024)))
+
+        # キャッチアップ時の並列ワーカー数
+        self.catchup_workers = int(os.getenv("GMAIL_CATCHUP_WORKERS", "8"))
+        self._local = threading.local()
+
+        # 続けて届いた予約をまとめて送るBookingCoalescer（Noneなら1件ずつ送信）
+        self.coalescer = None
+
+        # LOG_LEVEL=DEBUG のときだけペイロード構造や抽出結果の詳細を表示する
+        self.debug = os.getenv("LOG_LEVEL", "INFO").upper() == "DEBUG"
+
+        # 予約メールのレイアウトごとに学習した抽出方法（TEMPLATE_CACHE_SIZE=0で無効）
+        self.template_cache = TemplateCache() if int(os.getenv("TEMPLATE_CACHE_SIZE", "128")) > 0 else None
+
+        # 通知待ちのメッセージの受信時刻（message_id → UNIX時間、遅延の計測用）
+        self._received_at = {}
+
+    @property
+    def last_check(self):
+        return self._last_check
+
+    @last_check.setter
+    def last_check(self, value):
+        # 更新のたびに台帳へ書き込み、再起動時に続きから検索できるようにする
+        self._last_check = value
+        self.ledger.set_watermark('last_check', value.timestamp())
 
     def _authenticate(self, credentials_file):
         creds = None
-        if os.path.exists('token.json'):
-            creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+        if os.path.exists(self.token_file):
+            creds = Credentials.from_authorized_user_file(self.token_file, SCOPES)
         
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(credentials_file, SCOPES)
-                creds = flow.run_local_server(port=54561)
+        if not creds or not (creds.valid or creds.refresh_token):
+            # 初回の認証のときだけOAuthフローのライブラリを読み込む
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file(credentials_file, SCOPES)
+            creds = flow.run_local_server(port=54561)
             
-            with open('token.json', 'w') as token:
+            with open(self.token_file, 'w') as token:
                 token.write(creds.to_json())
         
-        return build('gmail', 'v1', credentials=creds)
+        # 期限切れのトークンも起動を待たせずにバックグラウンドで更新する
+        # （更新が間に合わなければ最初のAPI呼び出しで更新される）
+        self.creds = creds
+        self.token_refresher = TokenRefresher(creds, self.token_file)
+        self.token_refresher.start()
+        return build_from_document(load_discovery_document(), credentials=creds)
+
+    def _thread_http(self):
+        """スレッドごとのHTTPクライアントを返す（httplib2はスレッドセーフではないため）"""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = AuthorizedHttp(self.creds, http=httplib2.Http())
+            self._local.http = http
+        return http
     
     # 特定の送信者からの新しいメールをチェック
     def check_new_emails(self, sender_email):
         try:
             # 最後のチェック時刻以降のメールを検索
-            query = f'from:{sender_email} after:{int(self.last_check.timestamp())}'
+            query = self._search_query(sender_email, self.last_check)
             
-            result = self.service.users().messages().list(
+            result = self._execute(self.service.users().messages().list(
                 userId='me', 
                 q=query
-            ).execute()
+            ), cost=GMAIL_QUOTA_COST['messages.list'], stage='list')
             
             messages = result.get('messages', [])
             
@@ -69,10 +258,10 @@ class GmailMonitor:
     # メールの詳細を取得して処理
     def _process_message(self, message_id):
         try:
-            message = self.service.users().messages().get(
+            message = self._execute(self.service.users().messages().get(
                 userId='me', 
                 id=message_id
-            ).execute()
+            ), cost=GMAIL_QUOTA_COST['messages.get'], stage='get')
             
             headers = message['payload'].get('headers', [])
             subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
@@ -114,37 +303,505 @@ class GmailMonitor:
     def check_new_emails_with_flex(self, sender_email, line_api):
         """新着メールをチェックしてFlex Messageで通知"""
         try:
-            query = f'from:{sender_email} after:{int(self.last_check.timestamp())}'
+            messages = self.poll_new_messages(sender_email)
             
-            result = self.service.users().messages().list(
-                userId='me', 
-                q=query
-            ).execute()
-            
-            messages = result.get('messages', [])
+            for message_id, message in messages:
+                self._handle_message(message_id, message, line_api)
             
-            if messages:
-                print(f"新しいメールを {len(messages)} 件受信しました")
-            for message in messages:
-                self._process_message_with_details(message['id'], line_api)
+            # LINEの一時的な障害などで通知できなかった予約を、間隔をあけて再送する
+            self.retry_pending_if_due(line_api, sender_email)
             
-            self.last_check = datetime.now()
+            self.last_error = None
             return len(messages)
             
+        except Exception as error:
+            print(f'Gmail APIエラー: {error}')
+            self.last_error = error
+            return 0
+
+    def retry_pending_if_due(self, line_api, sender_email=None):
+        """前回の再送からretry_pending_after秒たっていれば、通知できなかったメッセージを再処理"""
+        if time.time() - self._last_pending_retry < self.retry_pending_after:
+            return 0
+        self._last_pending_retry = time.time()
+        return self.resume_pending(line_api, older_than=self.retry_pending_after, sender_email=sender_email)
+
+    def resume_pending(self, line_api, older_than=None, sender_email=None):
+        """前回の停止時や取得・通知の失敗で、通知まで終わらなかったメッセージを再処理
+        
+        一覧で見つけただけ（listed）のメッセージは、新着と同じくヘッダーで振り分けてから取得する
+        （sender_emailを指定すると送信者も確認する）。
+        """
+        listed_ids = self.ledger.pending_ids(self.max_attempts, older_than=older_than, states=(STATE_LISTED,))
+        message_ids = self.ledger.pending_ids(
+            self.max_attempts, older_than=older_than, states=(STATE_FETCHED, STATE_PARSED)
+        )
+        total = len(listed_ids) + len(message_ids)
+        if not total:
+            return 0
+        
+        print(f"♻️ 未通知のメッセージを {total} 件再処理します")
+        try:
+            for message_id in listed_ids:
+                # 取得のやり直しも試行回数に数え、取得できないメッセージを繰り返さない
+                self.ledger.mark(message_id, STATE_LISTED)
+            message_ids += self._triage_messages(listed_ids, sender_email)
+            
+            for message_id, message in self._fetch_messages(message_ids):
+                self._handle_message(message_id, message, line_api)
+            
+            return total
+            
+        except Exception as error:
+            print(f'Gmail APIエラー: {error}')
+            return 0
+
+    def poll_new_messages(self, sender_email):
+        """新着の予約関連メッセージを一覧取得し、本文ごとまとめて取得して返す"""
+        # 前回までに通知したメッセージのラベルを先に付け、検索結果から外しておく
+        self.apply_notified_label()
+        message_ids = self._list_new_message_ids(sender_email)
+        
+        if message_ids:
+            print(f"新しいメールを {len(message_ids)} 件受信しました")
+        messages = self._fetch_messages(message_ids)
+        # 取得できたものだけを処理済みとして覚える（取得できなかった分は台帳の再処理で拾う）
+        self._recent_ids.extend(message_id for message_id, _ in messages)
+        return messages
+
+    def catch_up(self, sender_email, line_api, since=None, workers=None):
+        """停止中に溜まったメールを全ページ走査し、並列で取得・解析して通知"""
+        workers = workers or self.catchup_workers
+        poll_started = datetime.now()
+        since = since or self.last_check
+        
+        try:
+            # ワーカーがラベルを確認する前に、ラベルのIDを引いておく
+            self._label_id()
+            query = self._search_query(sender_email, since)
+            message_ids = self._drop_seen(self._list_all_message_ids(query))
         except Exception as error:
             print(f'Gmail APIエラー: {error}')
             return 0
+        
+        total = len(message_ids)
+        if not total:
+            print("📭 キャッチアップ対象のメールはありません")
+            return 0
+        
+        # ワーカー全員に仕事が行き渡るよう、バッチ上限の範囲でチャンクを小さくする
+        chunk_size = min(self.batch_size, max(1, -(-total // workers)))
+        chunks = [message_ids[i:i + chunk_size] for i in range(0, total, chunk_size)]
+        print(f"📥 キャッチアップ開始: {total} 件 (ワーカー {workers}, {len(chunks)} チャンク)")
+        
+        processed = 0
+        notified = 0
+        failed = 0
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # mapは投入順に結果を返すので、取得・解析は並列でも通知は受信順になる
+            for chunk, results in zip(chunks, executor.map(self._catch_up_chunk, chunks)):
+                if results is None:
+                    failed += len(chunk)
+                    results = []
+                for message_id, booking_info in results:
+                    # まとめ送信待ち（None）も通知対象として数える
+                    if booking_info and self.notify(message_id, booking_info, line_api) is not False:
+                        notified += 1
+                processed += len(results)
+                elapsed = time.monotonic() - started
+                print(f"⏳ 進捗: {processed + failed}/{total} 件 ({elapsed:.1f}秒, 通知 {notified} 件)")
+        
+        self.last_check = max(self.last_check, poll_started)
+        self.apply_notified_label()
+        print(f"✅ キャッチアップ完了: {processed} 件処理, {notified} 件通知")
+        if failed:
+            print(f"⚠️ 取得できなかった {failed} 件は未通知のメッセージとして再処理します")
+        return notified
+
+    def _catch_up_chunk(self, message_ids):
+        """チャンクを取得・解析（失敗したらNone）
+
+        1つのチャンクのエラーでキャッチアップ全体（と起動）を止めない。
+        チャンクのメッセージは台帳にlisted以降の状態で残っているため、resume_pendingで拾い直せる。
+        """
+        try:
+            return self._fetch_and_parse_chunk(message_ids)
+        except Exception as error:
+            print(f'Gmail APIエラー（キャッチアップの {len(message_ids)} 件）: {error}')
+            return None
+
+    def _fetch_and_parse_chunk(self, message_ids):
+        """ワーカースレッドでメッセージをまとめて取得し予約情報を抽出"""
+        http = self._thread_http()
+        relevant_ids = set(self._triage_messages(message_ids, http=http))
+        fetched = self._fetch_messages([message_id for message_id in message_ids if message_id in relevant_ids], http=http)
+        self._recent_ids.extend(message_id for message_id, _ in fetched)
+        parsed = {message_id: self.parse_message(message_id, message) for message_id, message in fetched}
+        # 進捗の件数を合わせるため、対象外のメッセージもNoneとして返す
+        return [(message_id, parsed.get(message_id)) for message_id in message_ids]
+
+    def _list_new_message_ids(self, sender_email):
+        """同期モードに応じて新着メッセージIDを取得（古い順）"""
+        if self.sync_mode == 'history':
+            return self._list_history_message_ids(sender_email)
+        return self._list_query_message_ids(sender_email)
+
+    def _list_query_message_ids(self, sender_email):
+        """after:検索で新着メッセージIDを取得"""
+        # 検索前の時刻を記録し、処理中に届いたメールを取りこぼさない
+        poll_started = datetime.now()
+        query = self._search_query(sender_email, self.last_check)
+        
+        message_ids = self._triage_messages(self._drop_seen(self._list_all_message_ids(query)))
+        
+        self.last_check = poll_started
+        return message_ids
+
+    def _list_all_message_ids(self, query, max_results=None):
+        """nextPageTokenをたどって検索結果の全ページからメッセージIDを取得（古い順）"""
+        message_ids = []
+        page_token = None
+        
+        while True:
+            result = self._execute(self.service.users().messages().list(
+                userId='me',
+                q=query,
+                pageToken=page_token
+            ), cost=GMAIL_QUOTA_COST['messages.list'], stage='list')
+            
+            message_ids.extend(m['id'] for m in result.get('messages', []))
+            
+            page_token = result.get('nextPageToken')
+            if not page_token or (max_results and len(message_ids) >= max_results):
+                break
+        
+        # 検索結果は新しい順なので、受信順に並べ替える
+        if max_results:
+            message_ids = message_ids[:max_results]
+        return message_ids[::-1]
+
+    def _list_history_message_ids(self, sender_email):
+        """historyIdからの差分で新着メッセージIDを取得"""
+        if not self.history_id:
+            # 初回は現在のhistoryIdを起点にする（それ以前のメールは通知しない）
+            self._save_history_id(self._current_history_id())
+            self.last_check = datetime.now()
+            print(f"📌 差分同期を開始します (historyId: {self.history_id})")
+            return []
+        
+        poll_started = datetime.now()
+        message_ids = []
+        page_token = None
+        
+        try:
+            while True:
+                params = {
+                    'userId': 'me',
+                    'startHistoryId': self.history_id,
+                    'historyTypes': ['messageAdded'],
+                    'pageToken': page_token,
+                }
+                if self.history_label:
+                    params['labelId'] = self.history_label
+                result = self._execute(self.service.users().history().list(**params),
+                                       cost=GMAIL_QUOTA_COST['history.list'], stage='list')
+                
+                for record in result.get('history', []):
+                    for added in record.get('messagesAdded', []):
+                        message_ids.append(added['message']['id'])
+                
+                page_token = result.get('nextPageToken')
+                if not page_token:
+                    break
+        except HttpError as error:
+            # historyIdが古すぎる場合は404が返る
+            if error.resp.status == 404:
+                print("⚠️ historyIdの有効期限が切れました - 範囲を限定して再同期します")
+                return self._resync_message_ids(sender_email)
+            raise
+        
+        message_ids = list(dict.fromkeys(message_ids))
+        matched = self._triage_messages(self._drop_seen(message_ids), sender_email)
+        
+        self._save_history_id(result.get('historyId', self.history_id))
+        self.last_check = poll_started
+        return matched
+
+    def _resync_message_ids(self, sender_email):
+        """historyId失効時に期間と件数を限定して検索し直す"""
+        # 先に現在のhistoryIdを取得し、再同期中に届いたメールは次回の差分で拾う
+        history_id = self._current_history_id()
+        poll_started = datetime.now()
+        
+        window_start = poll_started - timedelta(hours=self.resync_window_hours)
+        since = max(self.last_check, window_start)
+        query = self._search_query(sender_email, since)
+        
+        message_ids = self._list_all_message_ids(query, max_results=self.resync_max_results)
+        message_ids = self._triage_messages(self._drop_seen(message_ids))
+        
+        self._save_history_id(history_id)
+        self.last_check = poll_started
+        return message_ids
+
+    def _triage_messages(self, message_ids, sender_email=None, http=None):
+        """ヘッダーだけを取得して分類し、本文を取得すべきメッセージIDを返す
+        
+        sender_emailを指定した場合は送信者（複数可）も確認する（historyの差分は全送信者を含むため）。
+        予約・キャンセル・変更以外のメールは台帳にスキップとして記録する。
+        """
+        if not message_ids:
+            return []
+        
+        senders = [address.lower() for address in sender_list(sender_email)] if sender_email else []
+        notified_label_id = self._notified_label_id
+        relevant = []
+        fetched = self._fetch_messages(message_ids, format='metadata', metadata_headers=TRIAGE_HEADERS, http=http)
+        for message_id, message in fetched:
+            headers = message['payload'].get('headers', [])
+            
+            # 台帳にない（作り直した・別の環境で通知した）メッセージでも、ラベルがあれば通知済み
+            if notified_label_id and notified_label_id in message.get('labelIds', []):
+                self.ledger.mark(message_id, STATE_NOTIFIED)
+                continue
+            
+            if senders:
+                sender = (self._get_header_value(headers, 'From') or '').lower()
+                if not any(address in sender for address in senders):
+                    # 一覧で記録済みのため、対象外として記録して再処理されないようにする
+                    self.ledger.mark(message_id, STATE_SKIPPED)
+                    continue
+            
+            subject = self._get_header_value(headers, 'Subject') or ''
+            kind = self.triage.classify(subject)
+            if kind is None:
+                print(f"⏭️ 予約関連のメールではないためスキップ: {subject}")
+                self.ledger.mark(message_id, STATE_SKIPPED)
+                MESSAGES_TOTAL.inc(result='skipped')
+                continue
+            
+            relevant.append(message_id)
+        
+        return relevant
+
+    def _fetch_messages(self, message_ids, format='full', metadata_headers=None, http=None):
+        """バッチリクエストでメッセージをまとめて取得（1回のHTTP呼び出しで最大100件）
+        
+        取得に失敗したメッセージはエラーを表示して結果から除外する。
+        クォータ超過などの一時的なエラーになったメッセージだけを、間隔をあけて取り直す。
+        戻り値は (message_id, message) のリストで、引数の順序を保つ。
+        """
+        message_ids = list(dict.fromkeys(message_ids))
+        fetched = {}
+        retry = []
+        
+        def on_response(request_id, response, exception):
+            if exception is None:
+                fetched[request_id] = response
+            elif is_retryable(exception):
+                retry.append((request_id, exception))
+            else:
+                # 取得前に削除されたメッセージなど、1件の失敗でバッチ全体を止めない
+                print(f'メッセージ取得エラー ({request_id}): {exception}')
+                FAILURES_TOTAL.inc(api='gmail')
+        
+        pending = message_ids
+        attempt = 0
+        while pending:
+            attempt += 1
+            for start in range(0, len(pending), self.batch_size):
+                chunk = pending[start:start + self.batch_size]
+                batch = self.service.new_batch_http_request(callback=on_response)
+                for message_id in chunk:
+                    params = {'userId': 'me', 'id': message_id, 'format': format}
+                    if metadata_headers:
+                        params['metadataHeaders'] = metadata_headers
+                    batch.add(self.service.users().messages().get(**params), request_id=message_id)
+                self._execute(batch, cost=GMAIL_QUOTA_COST['messages.get'] * len(chunk), http=http, stage='get')
+            
+            if not retry:
+                break
+            if attempt >= self.gmail_retry.max_attempts:
+                for message_id, exception in retry:
+                    print(f'メッセージ取得エラー ({message_id}): {exception}')
+                FAILURES_TOTAL.inc(len(retry), api='gmail')
+                break
+            
+            delay = max(self.gmail_retry.delay_for(exception, attempt) for _, exception in retry)
+            print(f"⚠️ {len(retry)} 件が一時的なエラー - {delay:.1f}秒後に取り直します")
+            RETRIES_TOTAL.inc(len(retry), api='gmail')
+            time.sleep(delay)
+            pending = [message_id for message_id, _ in retry]
+            retry.clear()
+        
+        return [(message_id, fetched[message_id]) for message_id in message_ids if message_id in fetched]
+
+    def _execute(self, request, cost, http=None, stage=None):
+        """レート制限と再試行を通してGmail APIリクエストを実行（stageを指定すると所要時間を記録）"""
+        if stage is None:
+            return self.gmail_retry.call(request.execute, http=http, cost=cost)
+        with STAGE_SECONDS.time(stage=stage):
+            return self.gmail_retry.call(request.execute, http=http, cost=cost)
+
+    def _current_history_id(self):
+        """メールボックスの現在のhistoryIdを取得"""
+        profile = self._execute(self.service.users().getProfile(userId='me'), cost=GMAIL_QUOTA_COST['getProfile'])
+        return profile['historyId']
+
+    def _load_history_id(self):
+        """保存済みのhistoryIdを読み込む"""
+        history_id = self.ledger.get_watermark('history_id')
+        if history_id:
+            return history_id
+        
+        # 台帳導入前のファイルに保存されたhistoryIdを引き継ぐ（名前付きのメールボックスは対象外）
+        if self.name or not os.path.exists(self.history_file):
+            return None
+        with open(self.history_file) as f:
+            return f.read().strip() or None
+
+    def _save_history_id(self, history_id):
+        """historyIdを台帳に保存（再起動後も差分同期を継続）"""
+        self.history_id = str(history_id)
+        self.ledger.set_watermark('history_id', self.history_id)
+
+    def _search_query(self, sender_email, since):
+        """送信者とsince以降の検索条件（通知済みのラベルが付いたメッセージはGmail側で除外する）"""
+        query = f'{sender_query(sender_email)} after:{int(since.timestamp())}'
+        if self.notified_label:
+            query += f' -label:{label_query(self.notified_label)}'
+        return query
+
+    def _label_id(self):
+        """通知済みラベルのIDを返す（なければ作成し、取得できなければNone）"""
+        if not self.notified_label or self._notified_label_id:
+            return self._notified_label_id
+        
+        try:
+            result = self._execute(self.service.users().labels().list(userId='me'), cost=GMAIL_QUOTA_COST['labels.list'])
+            for label in result.get('labels', []):
+                if label['name'].lower() == self.notified_label.lower():
+                    self._notified_label_id = label['id']
+                    break
+            else:
+                label = self._execute(self.service.users().labels().create(userId='me', body={
+                    'name': self.notified_label,
+                    'labelListVisibility': 'labelShow',
+                    'messageListVisibility': 'show',
+                }), cost=GMAIL_QUOTA_COST['labels.create'])
+                self._notified_label_id = label['id']
+                print(f"🏷️ ラベル「{self.notified_label}」を作成しました")
+        except Exception as error:
+            print(f'⚠️ ラベル「{self.notified_label}」を取得できません: {error}')
+        return self._notified_label_id
+
+    def apply_notified_label(self):
+        """通知済みにしたメッセージに、batchModifyでまとめてラベルを付ける（1回あたり最大1000件）
+
+        付けられなかった分は溜めたままにして、次の呼び出しで付け直す。
+        """
+        # 差分同期の振り分けでもラベルを確認するため、付けるものがなくてもIDは引いておく
+        label_id = self._label_id()
+        with self._label_lock:
+            pending, self._label_pending = self._label_pending, []
+        if not pending:
+            return 0
+        
+        applied = 0
+        try:
+            if label_id is None:
+                raise RuntimeError('ラベルのIDがありません')
+            for start in range(0, len(pending), GMAIL_MODIFY_LIMIT):
+                chunk = pending[start:start + GMAIL_MODIFY_LIMIT]
+                self._execute(self.service.users().messages().batchModify(userId='me', body={
+                    'ids': chunk,
+                    'addLabelIds': [label_id],
+                }), cost=GMAIL_QUOTA_COST['messages.batchModify'], stage='label')
+                applied += len(chunk)
+        except Exception as error:
+            print(f'⚠️ 通知済みのラベルを付けられません（{len(pending) - applied} 件は次回に再試行）: {error}')
+            with self._label_lock:
+                self._label_pending[:0] = pending[applied:]
+        return applied
+
+    def _drop_seen(self, message_ids):
+        """直近に処理したものと、台帳で通知済み・対象外のメッセージIDを除外
+        
+        残ったメッセージは同期位置を進める前に台帳へlistedとして記録し、
+        この後のヘッダー・本文の取得に失敗しても再処理（resume_pending）で拾えるようにする。
+        直近に処理したものとして覚えるのは、本文を取得できた時点。
+        """
+        new_ids = [message_id for message_id in message_ids if message_id not in self._recent_ids]
+        new_ids = self.ledger.filter_unprocessed(new_ids)
+        self.ledger.mark_listed(new_ids)
+        return new_ids
 
     def _process_message_with_details(self, message_id, line_api):
         """メールの詳細を取得してHTML構造を完全に表示"""
         try:
-            print(f"=== メッセージ {message_id} の処理開始 ===")
-            
-            message = self.service.users().messages().get(
+            message = self._execute(self.service.users().messages().get(
                 userId='me', 
                 id=message_id,
                 format='full'
-            ).execute()
+            ), cost=GMAIL_QUOTA_COST['messages.get'], stage='get')
+        except Exception as error:
+            print(f'メッセージ取得エラー: {error}')
+            return
+        
+        self._handle_message(message_id, message, line_api)
+
+    def _handle_message(self, message_id, message, line_api):
+        """取得済みメッセージから予約情報を抽出してLINEに通知"""
+        booking_info = self.parse_message(message_id, message)
+        if booking_info:
+            self.notify(message_id, booking_info, line_api)
+
+    def notify(self, message_id, booking_info, line_api):
+        """予約情報をLINEに送信し、成功したら台帳に通知済みとして記録"""
+        if self.coalescer is not None:
+            # まとめ送信では、実際に送信できた時点でmark_notifiedが呼ばれる
+            return self.coalescer.submit(self.delivery_key(message_id), booking_info)
+        
+        # バックグラウンド送信ではNoneが返り、送信できた時点でmark_notifiedが呼ばれる
+        key = self.delivery_key(message_id)
+        sent = line_api.send_booking_flex_message(booking_info, keys=[key])
+        if sent:
+            self.mark_notified(key)
+        return sent
+
+    def delivery_key(self, message_id):
+        """送信結果の通知に使うキー（名前付きのメールボックスでは "name/message_id"）"""
+        return f'{self.name}/{message_id}' if self.name else message_id
+
+    def mark_queued(self, key):
+        """台帳に送信スプールへ保存済みとして記録"""
+        self.ledger.mark(key.rsplit('/', 1)[-1], STATE_QUEUED)
+
+    def mark_held(self, key):
+        """台帳にまとめ送信待ちとして記録（保存はBookingCoalescer側で行い、再処理の対象から外す）"""
+        self.ledger.mark(key.rsplit('/', 1)[-1], STATE_HELD)
+
+    def mark_notified(self, key):
+        """台帳に通知済みとして記録し、メール受信からの遅延を記録"""
+        message_id = key.rsplit('/', 1)[-1]
+        self.ledger.mark(message_id, STATE_NOTIFIED)
+        MESSAGES_TOTAL.inc(result='notified')
+        
+        # 送信スレッドからも呼ばれるため、Gmail APIは呼ばずに溜めておく
+        if self.notified_label:
+            with self._label_lock:
+                self._label_pending.append(message_id)
+        
+        received_at = self._received_at.pop(message_id, None)
+        if received_at is not None:
+            DELIVERY_LAG_SECONDS.observe(max(0.0, time.time() - received_at))
+
+    def parse_message(self, message_id, message):
+        """取得済みメッセージから予約情報を抽出（失敗時はNone）"""
+        self.ledger.mark(message_id, STATE_FETCHED)
+        try:
+            print(f"=== メッセージ {message_id} の処理開始 ===")
             
             headers = message['payload'].get('headers', [])
             subject = self._get_header_value(headers, 'Subject') or 'No Subject'
@@ -153,46 +810,79 @@ class GmailMonitor:
             print(f"件名: {subject}")
             print(f"送信者: {sender}")
             
-            payload = message['payload']
-            self._debug_payload_structure(payload, level=0)
-            
-            all_contents = self._extract_all_contents(payload)
+            platform = self.platforms.match(sender, subject)
+            if platform is None:
+                print("⏭️ 対応する予約プラットフォームがないためスキップ")
+                self.ledger.mark(message_id, STATE_SKIPPED)
+                MESSAGES_TOTAL.inc(result='skipped')
+                return None
+            print(f"プラットフォーム: {platform.label}")
             
-            print("=== 取得されたすべてのコンテンツ ===")
-            for mime_type, content in all_contents.items():
-                print(f"\n--- {mime_type} ---")
-                print(f"コンテンツ長: {len(content)} 文字")
+            payload = message['payload']
+            if self.debug:
+                self._debug_payload_structure(payload, level=0)
             
             # HTMLから情報抽出を試行（優先順位付き）
-            extraction_success = False
-            
-            # 1. HTMLコンテンツを優先
-            for mime_type in ['text/html', 'text/plain']:
-                if mime_type in all_contents:
-                    content = all_contents[mime_type]
-                    if content.strip():
-                        print(f"\n{mime_type} から抽出試行:")
-                        booking_info = self._extract_booking_info_from_content(content, mime_type)
-                        if booking_info:
-                            print(f"抽出成功: {len(booking_info)} 項目")
+            # 1. HTMLコンテンツを優先し、失敗した場合だけ次の種類をデコードする
+            for mime_type in PREFERRED_TYPES:
+                part = find_part(payload, mime_type)
+                if part is None:
+                    continue
+                
+                with STAGE_SECONDS.time(stage='decode'):
+                    content = decode_part(part, max_bytes=self.max_part_bytes)
+                if content and content.strip():
+                    print(f"\n{mime_type} から抽出試行 ({len(content)} 文字):")
+                    booking_info = self._extract_booking_info_from_content(content, mime_type, platform)
+                    if booking_info:
+                        print(f"抽出成功: {len(booking_info)} 項目")
+                        booking_info['platform'] = platform.label
+                        self._record_booking(message_id, booking_info, self.triage.classify(subject) or KIND_BOOKING)
+                        if self.debug:
                             for key, value in booking_info.items():
                                 print(f"  {key}: {value}")
-                            
-                            line_api.send_booking_flex_message(booking_info)
-                            extraction_success = True
-                            break
-                        else:
-                            print("このコンテンツからは抽出失敗")
-            
-            if not extraction_success:
-                print("全てのコンテンツからの抽出に失敗")
+                        
+                        print(f"=== メッセージ {message_id} の処理完了 ===")
+                        self.ledger.mark(message_id, STATE_PARSED)
+                        MESSAGES_TOTAL.inc(result='parsed')
+                        
+                        # メール受信からLINE送信までの遅延を測るため受信時刻を覚えておく
+                        if message.get('internalDate'):
+                            self._received_at[message_id] = int(message['internalDate']) / 1000
+                            if len(self._received_at) > 1000:
+                                # 通知されないまま残ったものは古い順に捨てる
+                                self._received_at.pop(next(iter(self._received_at)))
+                        return booking_info
+                    else:
+                        print("このコンテンツからは抽出失敗")
             
+            print("全てのコンテンツからの抽出に失敗")
             print(f"=== メッセージ {message_id} の処理完了 ===")
+            self.ledger.mark(message_id, STATE_FAILED)
+            MESSAGES_TOTAL.inc(result='failed')
+            return None
             
         except Exception as error:
             print(f'メッセージ処理エラー: {error}')
             import traceback
             traceback.print_exc()
+            return None
+
+    def _record_booking(self, message_id, booking_info, kind):
+        """予約をストアに保存し、既存の予約からの変更点を通知用にbooking_infoへ加える"""
+        if self.bookings is not None:
+            try:
+                changes = self.bookings.record(booking_info, kind, message_id)
+            except Exception as error:
+                # 保存できなくても通知は止めない
+                print(f"⚠️ 予約の保存に失敗しました: {error}")
+                changes = None
+            if changes:
+                print(f"📝 予約 {booking_info['reference']} の変更点: {', '.join(changes)}")
+                text = format_changes(changes)
+                if text:
+                    booking_info['changes'] = text
+        booking_info['kind'] = kind
 
     def _debug_payload_structure(self, payload, level=0):
         """ペイロード構造を詳細にデバッグ表示"""
@@ -255,127 +945,29 @@ class GmailMonitor:
 
     def _html_to_text(self, html_content):
         """HTMLをプレーンテキストに変換"""
-        import re
-        
-        # スクリプトとスタイルを除去
-        text = re.sub(r'<script[^>]*>.*?</script>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-        text = re.sub(r'<style[^>]*>.*?</style>', '', text, flags=re.DOTALL | re.IGNORECASE)
-        
-        # テーブル構造を保持しつつHTMLを変換
-        # <td> タグの間にスペースを追加
-        text = re.sub(r'</td>\s*<td[^>]*>', ' ', text, flags=re.IGNORECASE)
-        text = re.sub(r'</tr>\s*<tr[^>]*>', '\n', text, flags=re.IGNORECASE)
-        
-        # 改行を保持するHTMLタグ
-        text = re.sub(r'<br[^>]*>', '\n', text, flags=re.IGNORECASE)
-        text = re.sub(r'<p[^>]*>', '\n', text, flags=re.IGNORECASE)
-        text = re.sub(r'</p>', '\n', text, flags=re.IGNORECASE)
-        text = re.sub(r'<div[^>]*>', '\n', text, flags=re.IGNORECASE)
-        text = re.sub(r'</div>', '\n', text, flags=re.IGNORECASE)
-        
-        # 全てのHTMLタグを除去
-        text = re.sub(r'<[^>]+>', '', text)
-        
-        # HTMLエンティティをデコード
-        html_entities = {
-            '&nbsp;': ' ',
-            '&amp;': '&',
-            '&lt;': '<',
-            '&gt;': '>',
-            '&quot;': '"',
-            '&#39;': "'",
-            '&apos;': "'",
-            '&yen;': '¥',
-        }
-        
-        for entity, char in html_entities.items():
-            text = text.replace(entity, char)
-        
-        # 複数の改行と空白を整理
-        text = re.sub(r'\n\s*\n', '\n\n', text)
-        text = re.sub(r'[ \t]+', ' ', text)
-        
-        # 各行をトリムし、アスタリスクを除去
-        lines = []
-        for line in text.split('\n'):
-            line = line.strip()
-            if line:
-                # アスタリスクを除去
-                line = line.replace('*', '')
-                lines.append(line)
-        
-        return '\n'.join(lines)
-
-    def _extract_from_text(self, text_content):
+        return html_to_text(html_content)
+
+    def _extract_from_text(self, text_content, platform=GETYOURGUIDE):
         """テキストから予約情報を抽出（改良版）"""
         booking_info = {}
         
         try:
-            print("=== テキスト抽出開始 ===")
-            print(f"テキスト内容（最初の500文字）:\n{text_content[:500]}")
-            
-            # より柔軟なパターン
-            patterns = {
-                'tour_name': [
-                    r'booked:\s*([^\n]*(?:Tokyo|Private|Customizable|Tour)[^\n]*)',
-                    r'following offer has been booked:\s*([^\n]+)',
-                    r'booked:\s*([^\n]{15,})',
-                ],
-                'options': [
-                    r'Option:\s*([^\n]+)',
-                    r'(Option:[^\n]+)',
-                ],
-                'date': [
-                    r'Date:\s*([^\n]+)',
-                    r'Date\s+([^\n]+)',
-                ],
-                'price': [
-                    r'Price:\s*([^\n]+)',
-                    r'Price\s+([^\n]+)',
-                ],
-                'reference': [
-                    r'Reference number:\s*([^\n]+)',
-                    r'Reference number\s+([^\n]+)',
-                ],
-                'customer_name': [
-                    r'Main customer:\s*([^\n]+)',
-                    r'Customer:\s*([^\n]+)',
-                ],
-                'phone': [
-                    r'Phone:\s*([^\n]+)',
-                    r'Phone\s+([^\n]+)',
-                ],
-                'language': [
-                    r'Language:\s*([^\n]+)',
-                    r'Language\s+([^\n]+)',
-                ],
-                'tour_language': [
-                    r'Tour language:\s*([^\n]+)',
-                    r'Tour language\s+([^\n]+)',
-                ],
-                'pickup_location': [
-                    r'Pickup location:\s*([^\n]+)',
-                    r'Pickup:\s*([^\n]+)',
-                    r'Pickup location\s+([^\n]+)',
-                ]
-            }
-            
-            for field, field_patterns in patterns.items():
-                for pattern in field_patterns:
-                    match = re.search(pattern, text_content, re.IGNORECASE | re.MULTILINE)
-                    if match:
-                        value = match.group(1).strip()
-                        # アスタリスクを除去
-                        value = value.replace('*', '')
-                        if value and len(value) > 0:
-                            booking_info[field] = value
-                            print(f"  {field}: {value}")
-                            break
+            if self.debug:
+                print("=== テキスト抽出開始 ===")
+                print(f"テキスト内容（最初の500文字）:\n{text_content[:500]}")
+            
+            # プラットフォームの抽出関数で全フィールドを抽出
+            with STAGE_SECONDS.time(stage='extract'):
+                booking_info = platform.extract(text_content)
+            
+            if self.debug:
+                for field in FIELD_PATTERNS:
+                    if field in booking_info:
+                        print(f"  {field}: {booking_info[field]}")
+                    else:
+                        print(f"  {field}: 見つからず")
                 
-                if field not in booking_info:
-                    print(f"  {field}: 見つからず")
-            
-            print(f"抽出された情報: {len(booking_info)} 項目")
+                print(f"抽出された情報: {len(booking_info)} 項目")
             
             return booking_info
             
@@ -383,7 +975,17 @@ class GmailMonitor:
             print(f"テキスト抽出エラー: {error}")
             return {}
 
-    def _extract_booking_info_from_content(self, content, mime_type):
+    def _extract_from_html(self, content, platform=GETYOURGUIDE):
+        """HTMLをテキストに変換してから予約情報を抽出（汎用の経路）"""
+        with STAGE_SECONDS.time(stage='html_to_text'):
+            text_content = self._html_to_text(content)
+        if self.debug:
+            print(f"HTML→テキスト変換後の長さ: {len(text_content)} 文字")
+        
+        # 変換されたテキストから抽出
+        return self._extract_from_text(text_content, platform)
+
+    def _extract_booking_info_from_content(self, content, mime_type, platform=GETYOURGUIDE):
         """コンテンツタイプに応じて予約情報を抽出"""
         booking_info = {}
         
@@ -391,16 +993,20 @@ class GmailMonitor:
             if 'html' in mime_type.lower():
                 print("HTML解析モード - HTMLをテキストに変換")
                 
-                # HTMLをテキストに変換
-                text_content = self._html_to_text(content)
-                print(f"HTML→テキスト変換後の長さ: {len(text_content)} 文字")
-                
-                # 変換されたテキストから抽出
-                booking_info = self._extract_from_text(text_content)
+                # 既知のレイアウトは学習済みの位置から直接取り出し、それ以外は変換して抽出
+                if self.template_cache is not None:
+                    booking_info = self.template_cache.extract(
+                        content,
+                        lambda html: self._extract_from_html(html, platform),
+                        namespace=platform.name,
+                        extract_text=platform.extract,
+                    )
+                else:
+                    booking_info = self._extract_from_html(content, platform)
                 
             else:
                 print("プレーンテキスト解析モード")
-                booking_info = self._extract_from_text(content)
+                booking_info = self._extract_from_text(content, platform)
             
             return booking_info
             
@@ -0,0 +1,79 @@
+import re
+from functools import lru_cache
+from html import unescape
+
+# 置換はすべてモジュール読み込み時にコンパイルし、固定文字列への置換だけにする
+# （置換関数を呼ぶとタグ1つごとにPythonの呼び出しが発生して遅くなるため）
+
+# script/style は中身ごと捨てる（従来どおり script → style の順に除去）
+_SCRIPT = re.compile(r'<script[^>]*>.*?</script>', re.DOTALL | re.IGNORECASE)
+_STYLE = re.compile(r'<style[^>]*>.*?</style>', re.DOTALL | re.IGNORECASE)
+
+# 隣り合うセルは空白でつなぐ
+_CELL_GAP = re.compile(r'</td>\s*<td[^>]*>', re.IGNORECASE)
+
+# 隣り合う行と、改行を保持するタグは改行にする
+_LINE_BREAK = re.compile(
+    r'</tr>\s*<tr[^>]*>|<br[^>]*>|<p[^>]*>|</p>|<div[^>]*>|</div>',
+    re.IGNORECASE
+)
+
+# 残りのタグはすべて除去
+_TAG = re.compile(r'<[^>]+>')
+
+# よく使われる文字参照（&amp; は二重デコードを避けるため最後に置換する）
+_COMMON_ENTITIES = (
+    ('&nbsp;', ' '),
+    ('&lt;', '<'),
+    ('&gt;', '>'),
+    ('&quot;', '"'),
+    ('&#39;', "'"),
+    ('&apos;', "'"),
+    ('&yen;', '¥'),
+)
+
+# それ以外の名前付き・数値文字参照
+_OTHER_ENTITY = re.compile(r'&(?!amp;)(?:#[0-9]+|#[xX][0-9a-fA-F]+|[A-Za-z][A-Za-z0-9]*);')
+
+
+@lru_cache(maxsize=512)
+def _decode_entity(entity):
+    # ノーブレークスペースは通常の空白として抽出側に渡す
+    return unescape(entity).replace('\xa0', ' ')
+
+
+def _decode_entities(text):
+    """すべての文字参照を1度だけデコード"""
+    for entity, char in _COMMON_ENTITIES:
+        if entity in text:
+            text = text.replace(entity, char)
+    if '&' in text:
+        text = _OTHER_ENTITY.sub(lambda match: _decode_entity(match.group(0)), text)
+    return text.replace('&amp;', '&')
+
+
+def html_to_text(html_content):
+    """HTMLを行単位のプレーンテキストに変換"""
+    text = _SCRIPT.sub('', html_content)
+    text = _STYLE.sub('', text)
+    text = _CELL_GAP.sub(' ', text)
+    text = _LINE_BREAK.sub('\n', text)
+    text = _TAG.sub('', text)
+
+    if '&' in text:
+        text = _decode_entities(text)
+
+    # 連続する空白・タブを1つにまとめる
+    if '\t' in text:
+        text = text.replace('\t', ' ')
+    while '  ' in text:
+        text = text.replace('  ', ' ')
+
+    # 各行をトリムし、アスタリスクを除去
+    lines = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if line:
+            lines.append(line.replace('*', ''))
+
+    return '\n'.join(lines)
@@ -1,14 +1,38 @@
-from linebot import LineBotApi
-from linebot.models import TextSendMessage
-from linebot.exceptions import LineBotApiError
 from dotenv import load_dotenv
 import os
-from datetime import datetime
-from linebot.models import (
-    FlexSendMessage, BubbleContainer, ImageComponent, BoxComponent,
-    TextComponent, IconComponent, ButtonComponent, URIAction, MessageAction,
-    SeparatorComponent
-)
+import threading
+import uuid
+from Function.RateLimiter import TokenBucket, RetryPolicy
+from Function.FlexTemplate import BubbleTemplate
+from Function.LineDelivery import LineDelivery, DeliveryError
+from Function.LineQuota import QuotaBudget
+from Function.Metrics import STAGE_SECONDS
+from Function.Recipients import RecipientRouter, split_for_delivery
+from Function.MailTriage import KIND_BOOKING, KIND_AMENDMENT, KIND_CANCELLATION
+
+# カルーセル1通に入れられるバブルの上限
+FLEX_CAROUSEL_LIMIT = 12
+
+# 1回の送信リクエストに入れられるメッセージの上限（何通入れても宛先ごとに1通と数えられる）
+MESSAGES_PER_REQUEST = 5
+
+# メールの種類ごとのバブルの見出し・色と通知文
+BOOKING_HEADERS = {
+    KIND_BOOKING: ("NEW BOOKING", "#1DB446", "New {platform}Booking Received"),
+    KIND_AMENDMENT: ("BOOKING CHANGED", "#F5A623", "{platform}Booking Changed"),
+    KIND_CANCELLATION: ("BOOKING CANCELLED", "#E74C3C", "{platform}Booking Cancelled"),
+}
+
+
+def booking_header(booking_info):
+    """予約の種類（kind）に合わせた (見出し, 色, 通知文の書式) を返す"""
+    return BOOKING_HEADERS.get(booking_info.get('kind'), BOOKING_HEADERS[KIND_BOOKING])
+
+
+def booking_alt_text(booking_info):
+    """トーク一覧やプッシュ通知に表示される通知文"""
+    platform = booking_info.get('platform')
+    return booking_header(booking_info)[2].format(platform=f'{platform} ' if platform else '')
 
 class LineApi:
     def __init__(self):
@@ -16,86 +40,354 @@ class LineApi:
         self.line_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
         self.target_user_id = os.getenv('LINE_TARGET_USER_ID')
         
-        if not self.line_token or not self.target_user_id:
+        # 通知先（複数の宛先と、ツアー名・ツアー言語による振り分けに対応）
+        self.router = RecipientRouter.from_env()
+        
+        # linebot（SDK）は読み込みに時間がかかるため、同期送信やバブルの骨組み作りで初めて使うときに読み込む
+        self.configured = bool(self.line_token and self.router)
+        self._line_bot_api = None
+        # SDKは再試行キーを共有のヘッダーに書き込むため、同期送信は1件ずつ行う
+        self._call_lock = threading.Lock()
+        if not self.configured:
             print("LINE設定が不完全です")
-            self.line_bot_api = None
         else:
-            self.line_bot_api = LineBotApi(self.line_token)
-            print("LINE API初期化成功")
+            print(f"LINE API初期化成功（通知先 {len(self.router)} 件）")
+
+        # LINE APIのレート制限に合わせた送信間隔と再試行
+        self.retry = RetryPolicy(
+            'LINE',
+            bucket=TokenBucket(rate=float(os.getenv("LINE_RATE_LIMIT", "2000"))),
+            max_attempts=int(os.getenv("LINE_RETRY_ATTEMPTS", "5")),
+        )
+
+        # バブルのJSONは骨組みを使い回して組み立てる
+        self.bubble_template = BubbleTemplate(self._build_booking_bubble)
+
+        # スプール経由のバックグラウンド送信（start_deliveryで有効になる）
+        self.delivery = None
+
+        # 月間メッセージ数の予算管理（LINE_QUOTA_MANAGEMENT=0で無効）
+        self.quota = None
+        if self.configured and os.getenv("LINE_QUOTA_MANAGEMENT", "1") != "0":
+            self.quota = QuotaBudget(self.line_token)
+
+    @property
+    def line_bot_api(self):
+        """同期送信に使うSDKのクライアント（未設定ならNone）"""
+        if self._line_bot_api is None and self.configured:
+            from linebot import LineBotApi
+            self._line_bot_api = LineBotApi(self.line_token)
+        return self._line_bot_api
+
+    def warm_up(self):
+        """最初の予約の通知が遅れないように、SDKの読み込みとバブルの骨組み作りを別スレッドで済ませておく"""
+        if not self.configured:
+            return None
+        thread = threading.Thread(target=self._warm_up, name='line-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def _warm_up(self):
+        try:
+            self.bubble_template.precompile(structures=[(kind,) for kind in (None, *BOOKING_HEADERS)])
+            if not self.delivery:
+                self.line_bot_api
+        except Exception as e:
+            print(f"⚠️ LINE送信の準備中にエラー: {e}")
+
+    def start_delivery(self, on_queued=None, on_delivered=None):
+        """送信をスプール経由のバックグラウンド送信に切り替える（LINE_SPOOL_DIRが空なら同期送信のまま）"""
+        spool_dir = os.getenv("LINE_SPOOL_DIR", "line_spool")
+        if not spool_dir or not self.configured:
+            return None
+
+        self.delivery = LineDelivery(
+            self.line_token,
+            spool_dir,
+            bucket=self.retry.bucket,
+            on_queued=on_queued,
+            on_delivered=on_delivered,
+        )
+        self.delivery.start()
+        print(f"📮 LINE送信をバックグラウンドで行います（スプール: {spool_dir}）")
+        return self.delivery
+
+    def recipients_for(self, booking_infos):
+        """予約を送る宛先IDを返す（複数の予約はいずれかの宛先になっていれば含める）"""
+        recipient_ids = []
+        for booking_info in booking_infos:
+            recipient_ids.extend(self.router.route(booking_info))
+        return list(dict.fromkeys(recipient_ids))
+
+    def _send(self, recipient_ids, messages, keys=()):
+        """宛先にメッセージ（最大5通）を送信（ユーザーはmulticastでまとめ、グループ・トークルームは個別にpush）
+
+        バックグラウンド送信が有効な場合はスプールに保存してすぐに戻り、Noneを返す。
+        keysは最後のAPI呼び出しに付け、すべての宛先に送れた時点でon_deliveredに渡される。
+        """
+        batches, others = split_for_delivery(recipient_ids)
+        calls = [('multicast', batch) if len(batch) > 1 else ('push', batch[0]) for batch in batches]
+        calls.extend(('push', recipient_id) for recipient_id in others)
+
+        for index, (kind, to) in enumerate(calls):
+            call_keys = keys if index == len(calls) - 1 else ()
+            if self.delivery:
+                self.delivery.send(kind, to, messages, call_keys)
+            else:
+                self._call(kind, to, messages)
+            if self.quota:
+                self.quota.record_sent(len(to) if kind == 'multicast' else 1)
+
+        return None if self.delivery and calls else True
+
+    def _call(self, kind, to, messages):
+        """レート制限と再試行を通してpush/multicastを同期で呼び出す
 
-    def send_booking_flex_message(self, booking_info):
-        """Send booking information as Flex Message (Receipt style)"""
-        if not self.line_bot_api:
+        再試行キーを付けるため、再送しても同じメッセージが二重に届くことはない。
+        同じキーで受付済み（409）の場合は送信済みとして扱う。
+        SDKの例外はバックグラウンド送信と同じDeliveryErrorにして返す。
+        """
+        from linebot.exceptions import LineBotApiError
+
+        send = self.line_bot_api.multicast if kind == 'multicast' else self.line_bot_api.push_message
+        retry_key = str(uuid.uuid4())
+        try:
+            # X-Line-Retry-KeyはLineBotApiのheadersに設定されるため、複数のスレッド
+            # （MailboxRunnerのワーカー）から同時に送ると別の送信のキーで送られてしまう
+            with self._call_lock, STAGE_SECONDS.time(stage='push'):
+                self.retry.call(send, to, messages, retry_key=retry_key)
+        except LineBotApiError as e:
+            if e.status_code != 409:
+                raise DeliveryError(e.status_code, e.headers, e.message) from e
+
+    def send_booking_flex_message(self, booking_info, keys=()):
+        """Send booking information as Flex Message (Receipt style)
+
+        送信できたらTrue、バックグラウンド送信のキューに入れたらNone、失敗したらFalseを返す。
+        """
+        if not self.configured:
             print("LINE API not initialized")
             return False
 
         try:
-            # 動的にツアー名を取得、フォールバック値を設定
-            tour_title = booking_info.get('tour_name', 'Tour Booking')
-            tour_option = booking_info.get('options', '')
+            with STAGE_SECONDS.time(stage='render'):
+                flex_message = self.bubble_template.render_message(booking_info, alt_text=booking_alt_text(booking_info))
             
-            # 基本的な項目リスト
-            detail_items = []
+            recipient_ids = self.recipients_for([booking_info])
+            if not recipient_ids:
+                print("振り分けルールに一致する通知先がないため送信しません")
+                return True
             
-            # Date
-            detail_items.append(
-                BoxComponent(
-                    layout="horizontal",
-                    contents=[
-                        TextComponent(
-                            text="Date",
-                            size="sm",
-                            color="#555555",
-                            flex=0
-                        ),
-                        TextComponent(
-                            text=booking_info.get('date', 'Not specified'),
-                            size="sm",
-                            color="#111111",
-                            align="end",
-                            wrap=True
-                        )
-                    ]
-                )
+            sent = self._send(
+                recipient_ids,
+                [flex_message],
+                keys
             )
             
-            # Price
-            detail_items.append(
-                BoxComponent(
-                    layout="horizontal",
-                    contents=[
-                        TextComponent(
-                            text="Price",
-                            size="sm",
-                            color="#555555",
-                            flex=0
-                        ),
-                        TextComponent(
-                            text=booking_info.get('price', 'Not specified'),
-                            size="sm",
-                            color="#111111",
-                            align="end"
-                        )
-                    ]
+            if sent is None:
+                print("Booking Flex Message queued for delivery")
+                return None
+            print("Booking Flex Message sent successfully")
+            return True
+            
+        except DeliveryError as e:
+            print(f"LINE sending error: {e}")
+            return False
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+            return False
+
+    def send_booking_carousel(self, booking_infos, keys=()):
+        """複数の予約を1通のカルーセルFlex Messageで送信（1通あたり最大12件）
+
+        いずれかの予約の通知先になっている宛先すべてに送るため、
+        宛先の異なる予約は呼び出し元で分けてから渡す。
+        """
+        if not self.configured:
+            print("LINE API not initialized")
+            return False
+
+        booking_infos = list(booking_infos)
+        if len(booking_infos) == 1:
+            return self.send_booking_flex_message(booking_infos[0], keys)
+        if len(booking_infos) > FLEX_CAROUSEL_LIMIT:
+            raise ValueError(f"カルーセルに入れられる予約は{FLEX_CAROUSEL_LIMIT}件までです")
+
+        try:
+            with STAGE_SECONDS.time(stage='render'):
+                flex_message = self.bubble_template.render_carousel_message(
+                    booking_infos,
+                    alt_text=f"{len(booking_infos)} New Bookings Received"
                 )
+            
+            recipient_ids = self.recipients_for(booking_infos)
+            if not recipient_ids:
+                print("振り分けルールに一致する通知先がないため送信しません")
+                return True
+            
+            sent = self._send(
+                recipient_ids,
+                [flex_message],
+                keys
             )
             
-            # セパレータ
-            detail_items.append(SeparatorComponent(margin="xxl"))
+            if sent is None:
+                print(f"Booking carousel queued for delivery ({len(booking_infos)} bookings)")
+                return None
+            print(f"Booking carousel sent successfully ({len(booking_infos)} bookings)")
+            return True
             
-            # Customer Name
+        except DeliveryError as e:
+            print(f"LINE sending error: {e}")
+            return False
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+            return False
+
+    def send_booking_digest(self, booking_infos, keys=()):
+        """まとめ送信：予約を12件ずつのカルーセルにし、最大5通を1回のリクエストで送信
+
+        LINEの送信数は1回のリクエストごとに宛先の数で数えられるため、
+        5通（最大60件）までなら宛先1つあたり1通分の消費で済む。
+        """
+        if not self.configured:
+            print("LINE API not initialized")
+            return False
+
+        booking_infos = list(booking_infos)
+        if not booking_infos:
+            return True
+
+        try:
+            messages = []
+            with STAGE_SECONDS.time(stage='render'):
+                for start in range(0, len(booking_infos), FLEX_CAROUSEL_LIMIT):
+                    chunk = booking_infos[start:start + FLEX_CAROUSEL_LIMIT]
+                    alt_text = f"{len(booking_infos)} Bookings (digest)"
+                    if len(chunk) == 1:
+                        messages.append(self.bubble_template.render_message(chunk[0], alt_text=alt_text))
+                    else:
+                        messages.append(self.bubble_template.render_carousel_message(chunk, alt_text=alt_text))
+
+            recipient_ids = self.recipients_for(booking_infos)
+            if not recipient_ids:
+                print("振り分けルールに一致する通知先がないため送信しません")
+                return True
+
+            queued = False
+            for start in range(0, len(messages), MESSAGES_PER_REQUEST):
+                # キーは最後のリクエストに付け、すべて送れた時点で通知済みにする
+                last = start + MESSAGES_PER_REQUEST >= len(messages)
+                sent = self._send(recipient_ids, messages[start:start + MESSAGES_PER_REQUEST], keys if last else ())
+                queued = queued or sent is None
+
+            if queued:
+                print(f"Booking digest queued for delivery ({len(booking_infos)} bookings)")
+                return None
+            print(f"Booking digest sent successfully ({len(booking_infos)} bookings)")
+            return True
+
+        except DeliveryError as e:
+            print(f"LINE sending error: {e}")
+            return False
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+            return False
+
+    def _build_booking_bubble(self, booking_info):
+        """予約情報からレシート風のバブルを組み立てる"""
+        from linebot.models import BubbleContainer, BoxComponent, TextComponent, SeparatorComponent
+
+        # 動的にツアー名を取得、フォールバック値を設定
+        tour_title = booking_info.get('tour_name', 'Tour Booking')
+        tour_option = booking_info.get('options', '')
+        header, header_color, _ = booking_header(booking_info)
+        changes = booking_info.get('changes', '')
+        
+        # 基本的な項目リスト
+        detail_items = []
+        
+        # Date
+        detail_items.append(
+            BoxComponent(
+                layout="horizontal",
+                contents=[
+                    TextComponent(
+                        text="Date",
+                        size="sm",
+                        color="#555555",
+                        flex=0
+                    ),
+                    TextComponent(
+                        text=booking_info.get('date', 'Not specified'),
+                        size="sm",
+                        color="#111111",
+                        align="end",
+                        wrap=True
+                    )
+                ]
+            )
+        )
+        
+        # Price
+        detail_items.append(
+            BoxComponent(
+                layout="horizontal",
+                contents=[
+                    TextComponent(
+                        text="Price",
+                        size="sm",
+                        color="#555555",
+                        flex=0
+                    ),
+                    TextComponent(
+                        text=booking_info.get('price', 'Not specified'),
+                        size="sm",
+                        color="#111111",
+                        align="end"
+                    )
+                ]
+            )
+        )
+        
+        # セパレータ
+        detail_items.append(SeparatorComponent(margin="xxl"))
+        
+        # Customer Name
+        detail_items.append(
+            BoxComponent(
+                layout="horizontal",
+                margin="xxl",
+                contents=[
+                    TextComponent(
+                        text="Customer",
+                        size="sm",
+                        color="#555555"
+                    ),
+                    TextComponent(
+                        text=booking_info.get('customer_name', 'Not specified'),
+                        size="sm",
+                        color="#111111",
+                        align="end",
+                        wrap=True
+                    )
+                ]
+            )
+        )
+        
+        # Phone（存在する場合のみ追加）
+        if booking_info.get('phone'):
             detail_items.append(
                 BoxComponent(
                     layout="horizontal",
-                    margin="xxl",
                     contents=[
                         TextComponent(
-                            text="Customer",
+                            text="Phone",
                             size="sm",
                             color="#555555"
                         ),
                         TextComponent(
-                            text=booking_info.get('customer_name', 'Not specified'),
+                            text=booking_info.get('phone'),
                             size="sm",
                             color="#111111",
                             align="end",
@@ -104,176 +396,155 @@ class LineApi:
                     ]
                 )
             )
-            
-            # Phone（存在する場合のみ追加）
-            if booking_info.get('phone'):
-                detail_items.append(
-                    BoxComponent(
-                        layout="horizontal",
-                        contents=[
-                            TextComponent(
-                                text="Phone",
-                                size="sm",
-                                color="#555555"
-                            ),
-                            TextComponent(
-                                text=booking_info.get('phone'),
-                                size="sm",
-                                color="#111111",
-                                align="end",
-                                wrap=True
-                            )
-                        ]
+        
+        # Language
+        detail_items.append(
+            BoxComponent(
+                layout="horizontal",
+                contents=[
+                    TextComponent(
+                        text="Language",
+                        size="sm",
+                        color="#555555"
+                    ),
+                    TextComponent(
+                        text=booking_info.get('language', 'Not specified'),
+                        size="sm",
+                        color="#111111",
+                        align="end"
                     )
-                )
-            
-            # Language
-            detail_items.append(
-                BoxComponent(
-                    layout="horizontal",
-                    contents=[
-                        TextComponent(
-                            text="Language",
-                            size="sm",
-                            color="#555555"
-                        ),
-                        TextComponent(
-                            text=booking_info.get('language', 'Not specified'),
-                            size="sm",
-                            color="#111111",
-                            align="end"
-                        )
-                    ]
-                )
+                ]
             )
-            
-            # Tour Language
+        )
+        
+        # Tour Language
+        detail_items.append(
+            BoxComponent(
+                layout="horizontal",
+                contents=[
+                    TextComponent(
+                        text="Tour language",
+                        size="sm",
+                        color="#555555"
+                    ),
+                    TextComponent(
+                        text=booking_info.get('tour_language', 'Not specified'),
+                        size="sm",
+                        color="#111111",
+                        align="end"
+                    )
+                ]
+            )
+        )
+        
+        # Pickup Location（存在する場合のみ追加、縦並び）
+        if booking_info.get('pickup_location'):
             detail_items.append(
                 BoxComponent(
-                    layout="horizontal",
+                    layout="vertical",
                     contents=[
                         TextComponent(
-                            text="Tour language",
+                            text="Pickup",
                             size="sm",
                             color="#555555"
                         ),
                         TextComponent(
-                            text=booking_info.get('tour_language', 'Not specified'),
+                            text=booking_info.get('pickup_location'),
                             size="sm",
                             color="#111111",
-                            align="end"
+                            wrap=True,
+                            margin="xs"
                         )
                     ]
                 )
             )
-            
-            # Pickup Location（存在する場合のみ追加、縦並び）
-            if booking_info.get('pickup_location'):
-                detail_items.append(
-                    BoxComponent(
+        
+        # Create receipt-style Flex Message
+        bubble = BubbleContainer(
+            body=BoxComponent(
+                layout="vertical",
+                contents=[
+                    TextComponent(
+                        text=header,
+                        weight="bold",
+                        color=header_color,
+                        size="sm"
+                    ),
+                    TextComponent(
+                        text=booking_info.get('platform', 'Booking'),  # 解析したプラットフォーム名
+                        weight="bold",
+                        size="xxl",
+                        margin="md"
+                    ),
+                    TextComponent(
+                        text=tour_title,  # 動的に取得
+                        size="sm",
+                        color="#333333",
+                        wrap=True,
+                        weight="bold",
+                        margin="sm"
+                    ),
+                    # オプション情報がある場合のみ表示
+                    *([TextComponent(
+                        text=tour_option,
+                        size="xs",
+                        color="#666666",
+                        wrap=True
+                    )] if tour_option else []),
+                    # キャンセル・変更の場合は前回の内容からの変更点を表示
+                    *([BoxComponent(
                         layout="vertical",
+                        margin="lg",
                         contents=[
                             TextComponent(
-                                text="Pickup",
-                                size="sm",
-                                color="#555555"
+                                text="CHANGES",
+                                size="xs",
+                                color="#aaaaaa"
                             ),
                             TextComponent(
-                                text=booking_info.get('pickup_location'),
+                                text=changes,
                                 size="sm",
-                                color="#111111",
+                                color=header_color,
                                 wrap=True,
                                 margin="xs"
                             )
                         ]
+                    )] if changes else []),
+                    SeparatorComponent(margin="xxl"),
+                    BoxComponent(
+                        layout="vertical",
+                        margin="xxl",
+                        spacing="sm",
+                        contents=detail_items
+                    ),
+                    SeparatorComponent(margin="xxl"),
+                    # Reference ID
+                    BoxComponent(
+                        layout="horizontal",
+                        margin="md",
+                        contents=[
+                            TextComponent(
+                                text="REFERENCE ID",
+                                size="xs",
+                                color="#aaaaaa",
+                                flex=0
+                            ),
+                            TextComponent(
+                                text=booking_info.get('reference', 'Not specified'),
+                                color="#aaaaaa",
+                                size="xs",
+                                align="end",
+                                wrap=True
+                            )
+                        ]
                     )
-                )
-            
-            # Create receipt-style Flex Message
-            bubble = BubbleContainer(
-                body=BoxComponent(
-                    layout="vertical",
-                    contents=[
-                        TextComponent(
-                            text="NEW BOOKING",
-                            weight="bold",
-                            color="#1DB446",
-                            size="sm"
-                        ),
-                        TextComponent(
-                            text="GetYourGuide",
-                            weight="bold",
-                            size="xxl",
-                            margin="md"
-                        ),
-                        TextComponent(
-                            text=tour_title,  # 動的に取得
-                            size="sm",
-                            color="#333333",
-                            wrap=True,
-                            weight="bold",
-                            margin="sm"
-                        ),
-                        # オプション情報がある場合のみ表示
-                        *([TextComponent(
-                            text=tour_option,
-                            size="xs",
-                            color="#666666",
-                            wrap=True
-                        )] if tour_option else []),
-                        SeparatorComponent(margin="xxl"),
-                        BoxComponent(
-                            layout="vertical",
-                            margin="xxl",
-                            spacing="sm",
-                            contents=detail_items
-                        ),
-                        SeparatorComponent(margin="xxl"),
-                        # Reference ID
-                        BoxComponent(
-                            layout="horizontal",
-                            margin="md",
-                            contents=[
-                                TextComponent(
-                                    text="REFERENCE ID",
-                                    size="xs",
-                                    color="#aaaaaa",
-                                    flex=0
-                                ),
-                                TextComponent(
-                                    text=booking_info.get('reference', 'Not specified'),
-                                    color="#aaaaaa",
-                                    size="xs",
-                                    align="end",
-                                    wrap=True
-                                )
-                            ]
-                        )
-                    ]
-                ),
-                styles={
-                    "footer": {
-                        "separator": True
-                    }
+                ]
+            ),
+            styles={
+                "footer": {
+                    "separator": True
                 }
-            )
-            
-            flex_message = FlexSendMessage(
-                alt_text="New Booking Received",
-                contents=bubble
-            )
-            
-            self.line_bot_api.push_message(
-                self.target_user_id,
-                flex_message
-            )
-            
-            print("Booking Flex Message sent successfully")
-            return True
-            
-        except LineBotApiError as e:
-            print(f"LINE sending error: {e.message}")
-            return False
-        except Exception as e:
-            print(f"Unexpected error: {e}")
-            return False
\ No newline at end of file
+            }
+        )
+        
+        return bubble
@@ -0,0 +1,228 @@
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+from Function.RateLimiter import RetryPolicy, is_retryable
+from Function.Metrics import STAGE_SECONDS, RETRIES_TOTAL, FAILURES_TOTAL
+
+LINE_API_ENDPOINT = 'https://api.line.me'
+PUSH_PATH = '/v2/bot/message/push'
+MULTICAST_PATH = '/v2/bot/message/multicast'
+
+# 送信の種類ごとのエンドポイント
+SEND_PATHS = {
+    'push': PUSH_PATH,
+    'multicast': MULTICAST_PATH,
+}
+
+
+class DeliveryError(Exception):
+    """LINE APIが2xx以外を返したときの例外（再試行の判定に使う）"""
+
+    def __init__(self, status_code, headers, body):
+        super().__init__(f"HTTP {status_code}: {body}")
+        self.status_code = status_code
+        self.headers = headers
+
+
+class OutboundSpool:
+    """送信前のメッセージを1件1ファイルで保存するディスク上のスプール
+
+    ファイル名は作成時刻から始まるため、名前順に並べると作成順になる。
+    書き込みは一時ファイルからの置き換えで行い、途中で止まっても壊れたエントリを残さない。
+    送信できないと判定されたエントリはdead/に移して残す。
+    """
+
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        self.dead_dir = os.path.join(spool_dir, 'dead')
+        os.makedirs(self.dead_dir, exist_ok=True)
+
+    def put(self, path, body, keys=()):
+        """エントリを保存してファイル名を返す（エントリのIDはLINEの再試行キーとしても使う）"""
+        entry_id = str(uuid.uuid4())
+        entry = {
+            'id': entry_id,
+            'created_at': time.time(),
+            'path': path,
+            'body': body,
+            'keys': list(keys),
+        }
+        filename = f"{time.time_ns():020d}-{entry_id}.json"
+        final_path = os.path.join(self.spool_dir, filename)
+        temp_path = final_path + '.tmp'
+
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, final_path)
+        return filename
+
+    def load(self, filename):
+        with open(os.path.join(self.spool_dir, filename), encoding='utf-8') as f:
+            return json.load(f)
+
+    def pending(self):
+        """未送信のエントリ名を作成順に返す"""
+        return sorted(name for name in os.listdir(self.spool_dir) if name.endswith('.json'))
+
+    def delete(self, filename):
+        try:
+            os.remove(os.path.join(self.spool_dir, filename))
+        except FileNotFoundError:
+            pass
+
+    def bury(self, filename):
+        """送信できないエントリをdead/に移す"""
+        os.replace(os.path.join(self.spool_dir, filename), os.path.join(self.dead_dir, filename))
+
+
+class LineDelivery:
+    """スプールを経由してLINEへメッセージを送るバックグラウンド送信
+
+    - 送信するメッセージはまずスプールに保存し、呼び出し元はすぐに戻る
+    - バックグラウンドのワーカーがkeep-aliveのHTTPセッションで送信する
+    - 2xx（または同じ再試行キーで受付済みの409）を受け取ってからエントリを削除する
+    - 一時的なエラーは間隔をあけて送れるまで再試行し、それ以外はdead/に移す
+    - 起動時にスプールに残っているエントリを作成順に再送する
+    送信できたメッセージはon_deliveredに、スプールに保存したメッセージはon_queuedに、
+    keys（message_idなど）を1件ずつ渡して知らせる。
+    """
+
+    def __init__(self, line_token, spool_dir, bucket=None, on_queued=None, on_delivered=None):
+        self.spool = OutboundSpool(spool_dir)
+        self.on_queued = on_queued
+        self.on_delivered = on_delivered
+        self.retry = RetryPolicy(
+            'LINE',
+            bucket=bucket,
+            max_delay=float(os.getenv("LINE_DELIVERY_MAX_DELAY", "300")),
+        )
+        self.timeout = float(os.getenv("LINE_DELIVERY_TIMEOUT", "10"))
+        self.workers = int(os.getenv("LINE_DELIVERY_WORKERS", "1"))
+
+        # 接続を使い回すHTTPセッション（ワーカー数分の接続をプールする）
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max(1, self.workers)))
+        self.session.headers.update({
+            'Authorization': f'Bearer {line_token}',
+            'Content-Type': 'application/json',
+        })
+
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """ワーカーを起動し、前回送れなかったエントリを再送キューに入れる"""
+        pending = self.spool.pending()
+        if pending:
+            print(f"♻️ 未送信のLINEメッセージを {len(pending)} 件再送します")
+        for filename in pending:
+            self._enqueue(filename)
+
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'line-delivery-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def push(self, to, messages, keys=()):
+        """プッシュメッセージをスプールに保存して送信キューに入れる"""
+        return self.send('push', to, messages, keys)
+
+    def multicast(self, to, messages, keys=()):
+        """複数ユーザー宛てのメッセージをスプールに保存して送信キューに入れる"""
+        return self.send('multicast', to, messages, keys)
+
+    def send(self, kind, to, messages, keys=()):
+        """push/multicastのリクエストをスプールに保存して送信キューに入れる"""
+        body = {'to': to, 'messages': [message.as_json_dict() for message in messages]}
+        filename = self.spool.put(SEND_PATHS[kind], body, keys)
+        self._notify(self.on_queued, keys)
+        self._enqueue(filename)
+        return filename
+
+    def pending_count(self):
+        return self._queue.qsize()
+
+    def join(self, timeout=None):
+        """キューが空になるまで待つ（停止前の送信待ち用）"""
+        deadline = time.monotonic() + timeout if timeout else None
+        while self._queue.unfinished_tasks:
+            if deadline and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def _enqueue(self, filename):
+        # 同じエントリを二重にキューへ入れない
+        with self._lock:
+            if filename in self._queued:
+                return
+            self._queued.add(filename)
+        self._queue.put(filename)
+
+    def _worker(self):
+        while True:
+            filename = self._queue.get()
+            try:
+                self._deliver(filename)
+            except Exception as error:
+                # 想定外のエラーでもワーカーは止めない（エントリはスプールに残る）
+                print(f"❌ LINE送信ワーカーエラー ({filename}): {error}")
+            finally:
+                with self._lock:
+                    self._queued.discard(filename)
+                self._queue.task_done()
+
+    def _deliver(self, filename):
+        entry = self.spool.load(filename)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self._post(entry)
+                break
+            except Exception as error:
+                if not is_retryable(error):
+                    print(f"❌ LINE送信エラー（再試行しません）: {error}")
+                    FAILURES_TOTAL.inc(api='line')
+                    self.spool.bury(filename)
+                    return
+
+                RETRIES_TOTAL.inc(api='line')
+                delay = self.retry.delay_for(error, attempt)
+                print(f"⚠️ LINE送信に失敗 ({error}) - {delay:.1f}秒後に再試行 ({attempt}回目)")
+                time.sleep(delay)
+
+        self.spool.delete(filename)
+        self._notify(self.on_delivered, entry['keys'])
+        print(f"📨 LINEメッセージを送信しました（送信待ち {self.pending_count()} 件）")
+
+    def _post(self, entry):
+        if self.retry.bucket:
+            self.retry.bucket.acquire()
+
+        with STAGE_SECONDS.time(stage='push'):
+            response = self.session.post(
+                LINE_API_ENDPOINT + entry['path'],
+                data=json.dumps(entry['body']),
+                # エントリIDを再試行キーにして、再送しても二重に届かないようにする
+                headers={'X-Line-Retry-Key': entry['id']},
+                timeout=self.timeout,
+            )
+        # 409は同じ再試行キーのリクエストが受付済みであることを示す
+        if 200 <= response.status_code < 300 or response.status_code == 409:
+            return response
+        raise DeliveryError(response.status_code, response.headers, response.text)
+
+    def _notify(self, callback, keys):
+        if callback:
+            for key in keys:
+                callback(key)
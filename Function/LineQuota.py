@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+import requests
+from Function.LineDelivery import LINE_API_ENDPOINT
+
+QUOTA_PATH = '/v2/bot/message/quota'
+CONSUMPTION_PATH = '/v2/bot/message/quota/consumption'
+
+# LINEの月間メッセージ数は日本時間の月初にリセットされる
+QUOTA_TIMEZONE = timezone(timedelta(hours=9))
+
+# 送信モード
+MODE_PUSH = 'push'      # 予約ごとに送信
+MODE_DIGEST = 'digest'  # 決まった時刻にまとめて送信
+
+
+def month_bounds(now):
+    """nowを含む月の始まりと次の月の始まり（日本時間）"""
+    start = now.astimezone(QUOTA_TIMEZONE).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return start, end
+
+
+def parse_digest_times(value):
+    """"09:00,13:00,18:00" を [(9, 0), (13, 0), (18, 0)] にする"""
+    times = []
+    for item in value.split(','):
+        if item.strip():
+            hour, minute = item.strip().split(':')
+            times.append((int(hour), int(minute)))
+    return sorted(times)
+
+
+def next_digest_time(now, digest_times):
+    """now以降で最初のまとめ送信の時刻（ローカル時刻のdatetime）"""
+    for day in range(2):
+        date = (now + timedelta(days=day)).date()
+        for hour, minute in digest_times:
+            candidate = datetime(date.year, date.month, date.day, hour, minute)
+            if candidate > now:
+                return candidate
+    return now + timedelta(days=1)
+
+
+class QuotaBudget:
+    """LINEの月間メッセージ数の上限に対する使用量を見積もり、送信モードを決める
+
+    使用量はLINEのquota/consumptionエンドポイントの値に、前回の取得以降に
+    送った通数（ローカルのカウンター）を足したもの。予約ごとに送った場合の
+    通数のペース（直近rate_window秒）で月末まで送り続けたときの見込みが予算を
+    超えるとまとめ送信（digest）に切り替え、見込みが予算のresume_ratio以下に
+    戻ったら予約ごとの送信に戻す。月末に近づくほど残り期間の見込みが小さくなるため、
+    忙しい月でも最後の数日まで通知が止まることはない。
+    """
+
+    def __init__(self, line_token, budget=None, refresh_interval=None, resume_ratio=None, rate_window=None, session=None):
+        self.line_token = line_token
+        # 予算（通数）。未指定ならLINEの上限をそのまま使う
+        budget = budget if budget is not None else os.getenv("LINE_MONTHLY_BUDGET")
+        self.budget = int(budget) if budget else None
+        self.refresh_interval = float(refresh_interval or os.getenv("LINE_QUOTA_REFRESH", "600"))
+        self.resume_ratio = float(resume_ratio or os.getenv("LINE_QUOTA_RESUME_RATIO", "0.9"))
+        self.rate_window = float(rate_window or os.getenv("LINE_QUOTA_RATE_WINDOW", str(3 * 24 * 3600)))
+        self.session = session or requests.Session()
+
+        self.limit = None          # LINEの月間上限（上限なしのプランではNone）
+        self.server_usage = 0      # 前回取得したときの今月の使用量
+        self._sent_since_refresh = 0
+        self._refreshed_at = None
+        self._month = None
+        self._demand = deque()     # (時刻, 予約ごとに送った場合の通数)
+        self._tracking_since = time.time()
+        self.mode = MODE_PUSH
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """LINEから今月の上限と使用量を取得（失敗したらローカルのカウンターで見積もりを続ける）"""
+        headers = {'Authorization': f'Bearer {self.line_token}'}
+        try:
+            quota = self.session.get(LINE_API_ENDPOINT + QUOTA_PATH, headers=headers, timeout=5)
+            quota.raise_for_status()
+            consumption = self.session.get(LINE_API_ENDPOINT + CONSUMPTION_PATH, headers=headers, timeout=5)
+            consumption.raise_for_status()
+        except requests.RequestException as e:
+            print(f"⚠️ LINEのメッセージ数を取得できません: {e}")
+            with self._lock:
+                self._refreshed_at = time.time()
+            return False
+
+        quota = quota.json()
+        with self._lock:
+            self.limit = quota.get('value') if quota.get('type') == 'limited' else None
+            self.server_usage = int(consumption.json().get('totalUsage', 0))
+            self._sent_since_refresh = 0
+            self._refreshed_at = time.time()
+        return True
+
+    def record_sent(self, count):
+        """実際に送った通数（宛先の数）を加算"""
+        with self._lock:
+            self._sent_since_refresh += count
+
+    def record_demand(self, count):
+        """予約ごとに送った場合にかかる通数を記録（まとめ送信中も記録して戻す判断に使う）"""
+        now = time.time()
+        with self._lock:
+            self._demand.append((now, count))
+            while self._demand and self._demand[0][0] < now - self.rate_window:
+                self._demand.popleft()
+
+    def used(self):
+        return self.server_usage + self._sent_since_refresh
+
+    def effective_budget(self):
+        if self.budget is not None and self.limit is not None:
+            return min(self.budget, self.limit)
+        return self.budget if self.budget is not None else self.limit
+
+    def projected(self, now=None):
+        """予約ごとに送り続けた場合の月末の使用量の見込み"""
+        now = now or datetime.now(timezone.utc)
+        start, end = month_bounds(now)
+        remaining = (end - now).total_seconds()
+
+        with self._lock:
+            tracked = min(self.rate_window, now.timestamp() - self._tracking_since)
+            demand = sum(count for _, count in self._demand)
+            used = self.server_usage + self._sent_since_refresh
+
+        if tracked >= 3600:
+            rate = demand / tracked
+        else:
+            # 記録が短いうちは今月のここまでの平均ペースで見積もる
+            rate = used / max(1.0, (now - start).total_seconds())
+        return used + rate * remaining
+
+    def current_mode(self):
+        """今の見込みに合わせた送信モードを返す（必要なら使用量を取り直す）"""
+        now = datetime.now(timezone.utc)
+        month = month_bounds(now)[0]
+        if month != self._month:
+            # 月が替わったら使用量はリセットされる
+            self._month = month
+            self._refreshed_at = None
+        if self._refreshed_at is None or time.time() - self._refreshed_at >= self.refresh_interval:
+            self.refresh()
+
+        budget = self.effective_budget()
+        if budget is None:
+            return self._switch(MODE_PUSH, None, None)
+
+        projected = self.projected(now)
+        if self.mode == MODE_PUSH and projected > budget:
+            return self._switch(MODE_DIGEST, projected, budget)
+        if self.mode == MODE_DIGEST and projected <= budget * self.resume_ratio:
+            return self._switch(MODE_PUSH, projected, budget)
+        return self.mode
+
+    def _switch(self, mode, projected, budget):
+        if mode != self.mode:
+            self.mode = mode
+            if mode == MODE_DIGEST:
+                print(f"📉 月末のLINE送信数の見込み {projected:,.0f} 通が予算 {budget:,} 通を超えるため、まとめ送信に切り替えます")
+            else:
+                print(f"📈 LINE送信数に余裕ができたため（見込み {projected:,.0f} / {budget:,} 通）予約ごとの送信に戻します"
+                      if budget else "📈 予約ごとの送信に戻します")
+        return mode
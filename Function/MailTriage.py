@@ -0,0 +1,47 @@
+import os
+import re
+
+# メールの種類
+KIND_BOOKING = 'booking'
+KIND_CANCELLATION = 'cancellation'
+KIND_AMENDMENT = 'amendment'
+
+# 本文の取得前に見るヘッダー
+TRIAGE_HEADERS = ['Subject', 'From', 'Date']
+
+
+class SubjectTriage:
+    """件名のルールでメールを分類し、本文を取得すべきかどうかを判定する
+
+    ルールは上から順に評価する：
+    1. 除外（レビュー依頼・メルマガなど）
+    2. キャンセル
+    3. 変更
+    4. 新規予約
+    どれにも当たらないメールは予約関連ではないとして扱う。
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("TRIAGE_ENABLED", "1") != "0"
+        self.ignore_rule = self._compile("TRIAGE_IGNORE_PATTERN", r'review|feedback|survey|newsletter')
+        self.rules = [
+            (KIND_CANCELLATION, self._compile("TRIAGE_CANCELLATION_PATTERN", r'cancel')),
+            (KIND_AMENDMENT, self._compile("TRIAGE_AMENDMENT_PATTERN", r'amend|change|modif|updated')),
+            (KIND_BOOKING, self._compile("TRIAGE_BOOKING_PATTERN", r'booking|booked|reservation')),
+        ]
+
+    def _compile(self, env_name, default):
+        return re.compile(os.getenv(env_name, default), re.IGNORECASE)
+
+    def classify(self, subject):
+        """件名からメールの種類を返す（予約関連でなければNone）"""
+        if not self.enabled:
+            return KIND_BOOKING
+
+        subject = subject or ''
+        if self.ignore_rule.search(subject):
+            return None
+        for kind, rule in self.rules:
+            if rule.search(subject):
+                return kind
+        return None
@@ -0,0 +1,134 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from Function.GmailMonitor import GmailMonitor, sender_list
+from Function.MessageLedger import MessageLedger
+from Function.BookingStore import BookingStore
+from Function.PollScheduler import PollScheduler
+
+
+class Mailbox:
+    """監視するメールボックス1つ分（認証・台帳・送信者・ポーリング間隔）"""
+
+    def __init__(self, name, monitor, senders, scheduler=None):
+        self.name = name
+        self.monitor = monitor
+        self.senders = sender_list(senders)
+        self.scheduler = scheduler or PollScheduler()
+
+
+class MailboxRunner:
+    """複数のメールボックスを1プロセスで監視するランナー
+
+    メールボックスごとに送信者を1つのOR条件にまとめて検索し、
+    ポーリングは共有のワーカープールで実行する。各メールボックスは
+    自分のスケジューラの時刻になったら実行され、実行中のものは重ねて実行しない。
+
+    設定はMAILBOXES_FILEのJSONで指定する：
+    [{"name": "office", "token_file": "tokens/office.json",
+      "ledger": "ledgers/office.db", "senders": ["a@example.com", "b@example.com"]}]
+    """
+
+    def __init__(self, mailboxes, line_api, workers=None):
+        self.mailboxes = {mailbox.name: mailbox for mailbox in mailboxes}
+        self.line_api = line_api
+        self.workers = workers or int(os.getenv("MAILBOX_WORKERS", str(min(8, len(self.mailboxes) or 1))))
+
+    @classmethod
+    def from_file(cls, path, line_api):
+        with open(path, encoding='utf-8') as f:
+            entries = json.load(f)
+
+        # 予約のストアは全メールボックスで共有する（予約一覧は1つにまとめる）
+        bookings = BookingStore.from_env()
+
+        mailboxes = []
+        for entry in entries:
+            name = entry['name']
+            monitor = GmailMonitor(
+                token_file=entry.get('token_file', f'token_{name}.json'),
+                ledger=MessageLedger(entry.get('ledger', f'ledger_{name}.db')),
+                name=name,
+                bookings=bookings,
+            )
+            mailboxes.append(Mailbox(name, monitor, entry['senders']))
+            print(f"📬 {name}: {', '.join(sender_list(entry['senders']))}")
+
+        if not mailboxes:
+            raise ValueError(f"{path} に監視するメールボックスがありません")
+        return cls(mailboxes, line_api)
+
+    def monitor_for(self, key):
+        """通知のキー（"name/message_id"）から担当のGmailMonitorを返す"""
+        name = key.split('/', 1)[0]
+        return self.mailboxes[name].monitor
+
+    def mark_queued(self, key):
+        self.monitor_for(key).mark_queued(key)
+
+    def mark_held(self, key):
+        self.monitor_for(key).mark_held(key)
+
+    def mark_notified(self, key):
+        self.monitor_for(key).mark_notified(key)
+
+    def resume_pending(self):
+        for mailbox in self.mailboxes.values():
+            mailbox.monitor.resume_pending(self.line_api, sender_email=mailbox.senders)
+
+    def set_coalescer(self, coalescer):
+        """全メールボックスで1つのまとめ送信を共有する"""
+        for mailbox in self.mailboxes.values():
+            mailbox.monitor.coalescer = coalescer
+
+    def run(self):
+        """停止されるまで、時刻になったメールボックスを共有プールでポーリングし続ける"""
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='mailbox') as executor:
+            while True:
+                now = time.time()
+                for mailbox in self.mailboxes.values():
+                    if mailbox.name in running or mailbox.scheduler.next_run_at > now:
+                        continue
+                    running[mailbox.name] = executor.submit(self._poll, mailbox)
+
+                # 次の実行時刻か、実行中のポーリングのどれかが終わるまで待つ
+                waiting = [
+                    mailbox.scheduler.seconds_until_next_run()
+                    for mailbox in self.mailboxes.values() if mailbox.name not in running
+                ]
+                timeout = min(waiting) if waiting else None
+                if not running:
+                    time.sleep(timeout)
+                    continue
+
+                wait(running.values(), timeout=timeout, return_when=FIRST_COMPLETED)
+                for name, future in list(running.items()):
+                    if future.done():
+                        del running[name]
+
+    def _poll(self, mailbox):
+        """1つのメールボックスをポーリングしてスケジューラに結果を記録"""
+        try:
+            new_emails = mailbox.monitor.check_new_emails_with_flex(mailbox.senders, self.line_api)
+        except Exception as e:
+            print(f"❌ [{mailbox.name}] メールチェック中にエラー: {e}")
+            new_emails = 0
+            mailbox.monitor.last_error = e
+
+        try:
+            if mailbox.monitor.last_error:
+                mailbox.scheduler.record_error()
+                print(f"🔄 [{mailbox.name}] {mailbox.scheduler.last_interval:.0f}秒後に再試行します...")
+                return
+            mailbox.scheduler.record_success(new_emails)
+        except Exception as e:
+            # 次回の時刻が過去のままだと、すぐに再投入されて連続でポーリングしてしまう
+            mailbox.scheduler.defer()
+            print(f"❌ [{mailbox.name}] 次回の時刻を決められません（{mailbox.scheduler.last_interval:.0f}秒後に再開）: {e}")
+            return
+
+        if new_emails > 0:
+            print(f"🔔 [{mailbox.name}] 新しいメールが {new_emails} 件届きました")
+        print(f"⏱️  [{mailbox.name}] 次回チェック: {mailbox.scheduler.next_run_time():%H:%M:%S}")
@@ -0,0 +1,149 @@
+import sqlite3
+import threading
+import time
+
+# メッセージの処理状態
+STATE_LISTED = 'listed'      # 一覧で見つけた（同期位置を進める前に記録、ヘッダー・本文は未取得）
+STATE_FETCHED = 'fetched'    # 本文を取得した
+STATE_PARSED = 'parsed'      # 予約情報を抽出した（未通知）
+STATE_QUEUED = 'queued'      # LINEの送信スプールに保存した（送信はスプール側で再試行）
+STATE_HELD = 'held'          # まとめ送信待ちとして保存した（送信はBookingCoalescerが行う）
+STATE_NOTIFIED = 'notified'  # LINEへの通知が完了した
+STATE_FAILED = 'failed'      # 予約メールではない、または抽出できなかった
+STATE_SKIPPED = 'skipped'    # 件名から予約関連ではないと判定した（本文は未取得）
+
+# 再処理の対象になる途中状態
+PENDING_STATES = (STATE_LISTED, STATE_FETCHED, STATE_PARSED)
+
+# IN句に渡すIDの上限（SQLiteの変数上限より十分小さく）
+_QUERY_CHUNK = 500
+
+
+class MessageLedger:
+    """処理済みメッセージと同期位置を記録するSQLite台帳
+
+    message_idを主キーにしているため、重複チェックは件数が増えても
+    インデックス経由の一定時間で済む。WALモードで書き込み中も読み取りを妨げない。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_state ON messages (state, updated_at)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            """)
+
+    def state_of(self, message_id):
+        """メッセージの処理状態を返す（未記録ならNone）"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state FROM messages WHERE message_id = ?", (message_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def is_notified(self, message_id):
+        """通知済みかどうか"""
+        return self.state_of(message_id) == STATE_NOTIFIED
+
+    def filter_unprocessed(self, message_ids):
+        """通知済み・送信待ち・まとめ送信待ち・処理対象外のメッセージを除いたIDを順序を保って返す"""
+        message_ids = list(message_ids)
+        done = set()
+
+        with self._lock:
+            for start in range(0, len(message_ids), _QUERY_CHUNK):
+                chunk = message_ids[start:start + _QUERY_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT message_id FROM messages WHERE message_id IN ({placeholders}) AND state IN (?, ?, ?, ?, ?)",
+                    (*chunk, STATE_NOTIFIED, STATE_QUEUED, STATE_HELD, STATE_FAILED, STATE_SKIPPED)
+                ).fetchall()
+                done.update(row[0] for row in rows)
+
+        return [message_id for message_id in message_ids if message_id not in done]
+
+    def mark_listed(self, message_ids):
+        """一覧で見つけたメッセージを記録（記録済みのメッセージの状態は変えない）
+
+        同期位置（historyIdや最終チェック時刻）を進める前に記録しておけば、
+        その後の取得に失敗しても再処理（pending_ids）で拾い直せる。
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO messages (message_id, state, attempts, updated_at) VALUES (?, ?, 0, ?) "
+                "ON CONFLICT (message_id) DO NOTHING",
+                [(message_id, STATE_LISTED, now) for message_id in message_ids]
+            )
+
+    def mark(self, message_id, state):
+        """メッセージの処理状態を記録（取得・取得のやり直しのたびに試行回数を加算）"""
+        attempt = 1 if state in (STATE_LISTED, STATE_FETCHED) else 0
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO messages (message_id, state, attempts, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (message_id) DO UPDATE SET
+                    state = excluded.state,
+                    attempts = attempts + excluded.attempts,
+                    updated_at = excluded.updated_at
+                """,
+                (message_id, state, attempt, time.time())
+            )
+
+    def pending_ids(self, max_attempts, older_than=None, states=PENDING_STATES):
+        """一覧・取得・抽出まで進んだが通知が完了していないメッセージIDを古い順に返す
+
+        older_thanを指定すると、その秒数以上更新のないメッセージだけを返す。
+        """
+        updated_before = time.time() - older_than if older_than else time.time()
+        placeholders = ','.join('?' * len(states))
+        with self._lock:
+            rows = self._conn.execute(
+                f"""
+                SELECT message_id FROM messages
+                WHERE state IN ({placeholders}) AND attempts < ? AND updated_at <= ?
+                ORDER BY updated_at
+                """,
+                (*states, max_attempts, updated_before)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def get_watermark(self, key, default=None):
+        """同期位置（historyIdや最終チェック時刻）を取得"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM sync_state WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else default
+
+    def set_watermark(self, key, value):
+        """同期位置を保存"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sync_state (key, value) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (key, str(value))
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,210 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 処理段階ごとの所要時間のバケット（秒）
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# メール受信からLINE送信までの遅延のバケット（秒）
+LAG_BUCKETS = (1, 2, 5, 10, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    """単調に増えるカウンター（ラベルの組み合わせごとに集計）"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f'{self.name}{_label_text(self.labels, key)} {value}'
+
+
+class Histogram:
+    """値の分布をバケットごとに数えるヒストグラム（ラベルの組み合わせごとに集計）"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.labels = tuple(labels)
+        # ラベルごとに [バケットごとの件数..., 合計値, 件数]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """withブロックの所要時間を記録"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        state = self._values.get(key)
+        return state[-1] if state else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = _label_text(self.labels + ('le',), key + (repr(float(bound)),))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _label_text(self.labels + ('le',), key + ('+Inf',))
+            yield f'{self.name}_bucket{labels} {state[-1]}'
+            yield f'{self.name}_sum{_label_text(self.labels, key)} {state[-2]}'
+            yield f'{self.name}_count{_label_text(self.labels, key)} {state[-1]}'
+
+
+class Registry:
+    """メトリクスをまとめてPrometheusのテキスト形式で出力する"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# 処理段階（list / get / decode / html_to_text / extract / render / push）ごとの所要時間
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'booking_stage_seconds', 'Latency of each processing stage in seconds.', STAGE_BUCKETS, labels=('stage',)
+))
+
+# メールのinternalDateからLINEへの送信完了までの遅延
+DELIVERY_LAG_SECONDS = REGISTRY.register(Histogram(
+    'booking_delivery_lag_seconds', 'Seconds from the email internalDate to LINE delivery.', LAG_BUCKETS
+))
+
+# メッセージの処理結果（parsed / failed / skipped / notified）
+MESSAGES_TOTAL = REGISTRY.register(Counter(
+    'booking_messages_total', 'Messages by processing result.', labels=('result',)
+))
+
+# API呼び出しの再試行と失敗（gmail / line）
+RETRIES_TOTAL = REGISTRY.register(Counter(
+    'booking_api_retries_total', 'API calls retried after a transient error.', labels=('api',)
+))
+FAILURES_TOTAL = REGISTRY.register(Counter(
+    'booking_api_failures_total', 'API calls that failed without further retry.', labels=('api',)
+))
+
+# レイアウトの指紋キャッシュの結果（hit / learn / confirm / reject / uncacheable）
+TEMPLATE_CACHE_TOTAL = REGISTRY.register(Counter(
+    'booking_template_cache_total', 'Template fingerprint cache lookups by result.', labels=('result',)
+))
+
+
+class StartupTimer:
+    """起動の段階ごとの所要時間を記録して、起動完了時にまとめて表示する"""
+
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.phases = []
+        self._last = self.started
+
+    def mark(self, phase):
+        """直前のmarkからここまでをphaseの時間として記録"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def total(self):
+        return self._last - self.started
+
+    def report(self):
+        phases = ' / '.join(f'{phase} {seconds * 1000:.0f}ms' for phase, seconds in self.phases)
+        print(f"🚀 起動完了まで {self.total():.2f}秒（{phases}）")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # アクセスごとのログは出さない
+        pass
+
+
+def start_metrics_server(port=None, addr=None):
+    """/metrics を返すHTTPサーバーをバックグラウンドで起動（METRICS_PORT=0で無効）"""
+    port = int(port if port is not None else os.getenv("METRICS_PORT", "9108"))
+    addr = addr or os.getenv("METRICS_ADDR", "127.0.0.1")
+    if not port:
+        return None
+
+    try:
+        server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    except OSError as e:
+        print(f"⚠️ メトリクスサーバーを起動できません ({addr}:{port}): {e}")
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    print(f"📊 メトリクスを http://{addr}:{port}/metrics で公開しています")
+    return server
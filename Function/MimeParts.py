@@ -0,0 +1,72 @@
+import base64
+import codecs
+import re
+
+# 抽出を試す本文の種類（優先順）
+PREFERRED_TYPES = ('text/html', 'text/plain')
+
+_CHARSET = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+
+
+def iter_leaf_parts(payload):
+    """ペイロードの末端パートを深さ優先で順に返す（デコードはしない）"""
+    parts = payload.get('parts')
+    if not parts:
+        yield payload
+        return
+
+    for part in parts:
+        if 'parts' in part:
+            yield from iter_leaf_parts(part)
+        else:
+            yield part
+
+
+def find_part(payload, mime_type):
+    """指定したMIMEタイプの本文パートを探す
+
+    添付ファイル（attachmentIdだけを持つパート）とデータのないパートは対象外。
+    同じタイプが複数ある場合は、従来の全件デコードと同じく最後のパートを使う。
+    """
+    found = None
+    for part in iter_leaf_parts(payload):
+        if part.get('mimeType') != mime_type:
+            continue
+        body = part.get('body', {})
+        if body.get('attachmentId') or not body.get('data'):
+            continue
+        found = part
+    return found
+
+
+def part_charset(part):
+    """パートのContent-Typeヘッダーから文字コードを取得（不明ならUTF-8）"""
+    for header in part.get('headers', []):
+        if header.get('name', '').lower() == 'content-type':
+            match = _CHARSET.search(header.get('value', ''))
+            if match:
+                charset = match.group(1)
+                try:
+                    return codecs.lookup(charset).name
+                except LookupError:
+                    break
+    return 'utf-8'
+
+
+def decode_part(part, max_bytes=None):
+    """パートの本文をデコードして文字列で返す（大きすぎる・デコードできない場合はNone）"""
+    body = part.get('body', {})
+    data = body.get('data', '')
+
+    # sizeがない場合はbase64の長さから概算する
+    size = body.get('size') or len(data) * 3 // 4
+    if max_bytes and size > max_bytes:
+        print(f"本文が大きすぎるためスキップ ({part.get('mimeType')}: {size} bytes)")
+        return None
+
+    charset = part_charset(part)
+    try:
+        return base64.urlsafe_b64decode(data).decode(charset)
+    except (ValueError, LookupError) as e:
+        print(f"デコードエラー ({part.get('mimeType')}, {charset}): {e}")
+        return None
@@ -0,0 +1,134 @@
+import json
+import os
+import re
+from email.utils import parseaddr
+from Function.BookingExtractor import extract_booking_fields, pattern_extractor
+
+# 件名を単語に分ける（件名の目印は単語単位で照合する）
+_WORD_SPLIT = re.compile(r'\W+')
+
+
+class Platform:
+    """予約プラットフォーム（OTA）1つ分の定義
+
+    - sender_domains: 予約メールの送信元ドメイン（サブドメインからの送信も一致する）
+    - subject_signatures: 件名に含まれる目印の単語（転送されたメールなど送信元で判別できない場合に使う）
+    - extractor: テキストから予約情報（dict）を抽出する関数
+    """
+
+    def __init__(self, name, label=None, sender_domains=(), subject_signatures=(), extractor=extract_booking_fields):
+        self.name = name
+        self.label = label or name
+        self.sender_domains = tuple(domain.lower().lstrip('@') for domain in sender_domains)
+        self.subject_signatures = tuple(signature.lower() for signature in subject_signatures)
+        self.extractor = extractor
+
+    def extract(self, text_content):
+        return self.extractor(text_content)
+
+    def __repr__(self):
+        return f'Platform({self.name!r})'
+
+
+# 組み込みのプラットフォーム（BookingExtractorのパターンはGetYourGuideのメール用）
+GETYOURGUIDE = Platform(
+    'getyourguide',
+    label='GetYourGuide',
+    sender_domains=('getyourguide.com',),
+    subject_signatures=('getyourguide',),
+)
+
+
+class PlatformRegistry:
+    """送信元ドメインと件名の目印から、メールを解析するプラットフォームを選ぶ
+
+    登録時に ドメイン → プラットフォーム と 目印の単語 → プラットフォーム の索引を作っておき、
+    メールごとにすべてのプラットフォームのパターンを試す代わりに辞書を引いて選ぶ。
+    送信元のドメインを優先し、一致しなければ件名の単語、それでもなければdefaultを使う。
+
+    追加のプラットフォームは PLATFORMS_FILE のJSONファイルで設定できる：
+        [{"name": "viator", "label": "Viator",
+          "sender_domains": ["viator.com"], "subject_signatures": ["viator"],
+          "field_patterns": {"tour_name": ["Tour Name:\\s*([^\\n]+)"], ...}}]
+    field_patternsを省略したプラットフォームはGetYourGuideと同じパターンで抽出する。
+    """
+
+    def __init__(self, platforms=(), default=None):
+        self._platforms = {}
+        self._by_domain = {}
+        self._by_signature = {}
+        self.default = default
+        for platform in platforms:
+            self.register(platform)
+
+    @classmethod
+    def from_env(cls):
+        registry = cls([GETYOURGUIDE])
+
+        platforms_file = os.getenv("PLATFORMS_FILE")
+        if platforms_file:
+            with open(platforms_file, encoding='utf-8') as f:
+                entries = json.load(f)
+            for entry in entries:
+                field_patterns = entry.get('field_patterns')
+                registry.register(Platform(
+                    entry['name'],
+                    label=entry.get('label'),
+                    sender_domains=entry.get('sender_domains', ()),
+                    subject_signatures=entry.get('subject_signatures', ()),
+                    extractor=pattern_extractor(field_patterns) if field_patterns else extract_booking_fields,
+                ))
+
+        # どのプラットフォームにも一致しないメール（転送元が不明など）に使うもの（空なら解析しない）
+        default_name = os.getenv("PLATFORM_DEFAULT", GETYOURGUIDE.name)
+        registry.default = registry.get(default_name) if default_name else None
+        return registry
+
+    def register(self, platform):
+        """プラットフォームを登録（同じ名前なら置き換える）"""
+        previous = self._platforms.get(platform.name)
+        if previous is not None:
+            self._by_domain = {key: value for key, value in self._by_domain.items() if value is not previous}
+            self._by_signature = {key: value for key, value in self._by_signature.items() if value is not previous}
+            if self.default is previous:
+                self.default = platform
+
+        self._platforms[platform.name] = platform
+        for domain in platform.sender_domains:
+            self._by_domain[domain] = platform
+        for signature in platform.subject_signatures:
+            self._by_signature[signature] = platform
+        return platform
+
+    def get(self, name):
+        return self._platforms.get(name)
+
+    def __iter__(self):
+        return iter(self._platforms.values())
+
+    def __len__(self):
+        return len(self._platforms)
+
+    def match(self, sender='', subject=''):
+        """送信者（Fromヘッダー）と件名からプラットフォームを返す（決められなければdefault）"""
+        return self.match_sender(sender) or self.match_subject(subject) or self.default
+
+    def match_sender(self, sender):
+        address = parseaddr(sender or '')[1].lower()
+        domain = address.rpartition('@')[2]
+        # notification.getyourguide.com → getyourguide.com の順に親ドメインを引く
+        while domain:
+            platform = self._by_domain.get(domain)
+            if platform is not None:
+                return platform
+            domain = domain.partition('.')[2]
+        return None
+
+    def match_subject(self, subject):
+        if not self._by_signature:
+            return None
+        for word in _WORD_SPLIT.split((subject or '').lower()):
+            platform = self._by_signature.get(word)
+            if platform is not None:
+                return platform
+        return None
@@ -0,0 +1,132 @@
+import math
+import os
+import random
+import time
+from datetime import datetime
+
+
+def _parse_hours(value):
+    """"1-6" のような時間帯を (開始時, 終了時) に変換（終了時は含まない・日またぎ可）"""
+    if not value:
+        return None
+    start, end = value.split('-')
+    return int(start) % 24, int(end) % 24
+
+
+def _in_hours(hour, hours):
+    if hours is None:
+        return False
+    start, end = hours
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+class PollScheduler:
+    """新着状況に合わせてポーリング間隔を調整するスケジューラ
+
+    - 予約が届いた直後は短い間隔（バースト）で数回続けてチェックする
+    - 新着のない状態が続くと、間隔を指数的に延ばす
+    - エラー時も指数的に延ばして再試行する
+    - 深夜帯・ピーク帯ごとに基準の間隔を切り替える
+    間隔には±数%のゆらぎを加え、複数プロセスの同時アクセスを避ける。
+    """
+
+    def __init__(self):
+        self.interval = float(os.getenv("POLL_INTERVAL", "30"))
+        self.burst_interval = float(os.getenv("POLL_BURST_INTERVAL", "5"))
+        self.burst_polls = int(os.getenv("POLL_BURST_POLLS", "3"))
+        self.max_interval = float(os.getenv("POLL_MAX_INTERVAL", "300"))
+        self.backoff_factor = float(os.getenv("POLL_BACKOFF_FACTOR", "2"))
+        self.idle_grace = int(os.getenv("POLL_IDLE_GRACE", "10"))
+        self.jitter = float(os.getenv("POLL_JITTER", "0.1"))
+
+        # 時間帯ごとのプロファイル
+        self.quiet_hours = _parse_hours(os.getenv("POLL_QUIET_HOURS", "1-6"))
+        self.quiet_interval = float(os.getenv("POLL_QUIET_INTERVAL", "300"))
+        self.peak_hours = _parse_hours(os.getenv("POLL_PEAK_HOURS", "9-21"))
+        self.peak_interval = float(os.getenv("POLL_PEAK_INTERVAL", "15"))
+
+        self._idle_polls = 0
+        self._errors = 0
+        self._burst_left = 0
+
+        # 次にポーリングする時刻（UNIX時間）
+        self.next_run_at = time.time()
+        self.last_interval = 0.0
+
+    def base_interval(self, now=None):
+        """現在の時間帯の基準間隔"""
+        hour = (now or datetime.now()).hour
+        if _in_hours(hour, self.quiet_hours):
+            return self.quiet_interval
+        if _in_hours(hour, self.peak_hours):
+            return self.peak_interval
+        return self.interval
+
+    def record_success(self, new_count):
+        """ポーリング成功を記録して次回の時刻を決める"""
+        self._errors = 0
+        base = self.base_interval()
+
+        if new_count > 0:
+            # 予約が届いたら、続けて届くメールに備えて短い間隔にする
+            self._idle_polls = 0
+            self._burst_left = self.burst_polls
+            interval = self.burst_interval
+        elif self._burst_left > 0:
+            self._burst_left -= 1
+            interval = self.burst_interval
+        else:
+            self._idle_polls += 1
+            interval = self._backoff(base, self._idle_polls - self.idle_grace)
+
+        return self._schedule(interval, base)
+
+    def record_error(self):
+        """ポーリング失敗を記録して、エラーが続くほど間隔を延ばす"""
+        self._errors += 1
+        base = self.base_interval()
+        return self._schedule(self._backoff(base, self._errors), base)
+
+    def _backoff(self, base, steps):
+        """base × backoff_factor^steps（上限に届く回数より先は数えない）
+
+        新着のない状態やエラーが何日も続いても、累乗がOverflowErrorにならないようにする。
+        """
+        steps = max(0, steps)
+        limit = max(self.max_interval, base)
+        if self.backoff_factor > 1 and 0 < base < limit:
+            steps = min(steps, math.ceil(math.log(limit / base, self.backoff_factor)))
+        elif self.backoff_factor > 1:
+            steps = min(steps, 1)
+        return base * self.backoff_factor ** steps
+
+    def _schedule(self, interval, base):
+        # 深夜帯など基準間隔が上限より長い場合は基準間隔を上限にする
+        interval = min(interval, max(self.max_interval, base))
+        if self.jitter:
+            interval *= 1 + random.uniform(-self.jitter, self.jitter)
+
+        self.last_interval = interval
+        self.next_run_at = time.time() + interval
+        return interval
+
+    def defer(self):
+        """間隔を決められなかった場合に、上限の間隔で次回の時刻を決める"""
+        self.last_interval = max(self.max_interval, self.base_interval())
+        self.next_run_at = time.time() + self.last_interval
+        return self.last_interval
+
+    def seconds_until_next_run(self):
+        return max(0.0, self.next_run_at - time.time())
+
+    def next_run_time(self):
+        """次回ポーリング時刻（表示用）"""
+        return datetime.fromtimestamp(self.next_run_at)
+
+    def wait(self):
+        """次回ポーリング時刻まで待つ"""
+        delay = self.seconds_until_next_run()
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,146 @@
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from Function.Metrics import RETRIES_TOTAL, FAILURES_TOTAL
+
+# 再試行すれば成功する可能性があるHTTPステータス
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# 403でもクォータ超過なら待てば回復する（Gmail）
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+
+# 接続エラーなどの一時的な例外
+TRANSIENT_ERRORS = (socket.timeout, TimeoutError, ConnectionError)
+
+
+class TokenBucket:
+    """一定レートでトークンが補充されるバケット（APIのクォータに合わせたレート制限）"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """トークンが貯まるまで待ってから消費する（容量を超える要求は分割して待つ）"""
+        remaining = float(tokens)
+        while remaining > 0:
+            portion = min(remaining, self.capacity)
+            with self._lock:
+                self._refill()
+                if self._tokens >= portion:
+                    self._tokens -= portion
+                    remaining -= portion
+                    continue
+                wait = (portion - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _status_of(error):
+    """例外からHTTPステータスを取り出す（Gmail: HttpError / LINE: status_codeを持つ例外）"""
+    resp = getattr(error, 'resp', None)
+    if resp is not None and getattr(resp, 'status', None) is not None:
+        return int(resp.status)
+    status = getattr(error, 'status_code', None)
+    return int(status) if status is not None else None
+
+
+def _headers_of(error):
+    resp = getattr(error, 'resp', None)
+    if resp is not None:
+        return resp
+    return getattr(error, 'headers', None) or {}
+
+
+def retry_after_seconds(error):
+    """Retry-Afterヘッダーの待ち時間（秒）を返す（なければNone）"""
+    headers = _headers_of(error)
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    # HTTP日付形式の場合
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    """一時的なエラーかどうかを判定（それ以外は再試行しても無駄なエラー）"""
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+
+    status = _status_of(error)
+    if status is None:
+        # httplib2やrequestsの接続エラーも一時的なものとして扱う
+        return type(error).__name__ in (
+            'ServerNotFoundError', 'ConnectionError', 'Timeout', 'ConnectTimeout', 'ReadTimeout'
+        )
+    if status in RETRYABLE_STATUSES:
+        return True
+    if status == 403:
+        return any(reason in str(error) for reason in RATE_LIMIT_REASONS)
+    return False
+
+
+class RetryPolicy:
+    """レート制限と再試行をまとめて行う呼び出しラッパー
+
+    呼び出し前にトークンバケットでクォータ分を確保し、一時的なエラーは
+    Retry-Afterまたは指数バックオフ（ジッター付き）で待って再試行する。
+    致命的なエラーと、再試行回数を使い切ったエラーはそのまま送出する。
+    """
+
+    def __init__(self, name, bucket=None, max_attempts=5, base_delay=1.0, max_delay=60.0):
+        self.name = name
+        self.bucket = bucket
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff_delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def delay_for(self, error, attempt):
+        """次の再試行までの待ち時間（Retry-Afterを優先）"""
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return self.backoff_delay(attempt)
+
+    def call(self, func, *args, cost=1, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.bucket:
+                self.bucket.acquire(cost)
+
+            try:
+                return func(*args, **kwargs)
+            except Exception as error:
+                if not is_retryable(error) or attempt >= self.max_attempts:
+                    FAILURES_TOTAL.inc(api=self.name.lower())
+                    raise
+
+                RETRIES_TOTAL.inc(api=self.name.lower())
+                delay = self.delay_for(error, attempt)
+                print(f"⚠️ {self.name} 一時的なエラー ({error}) - {delay:.1f}秒後に再試行 ({attempt}/{self.max_attempts})")
+                time.sleep(delay)
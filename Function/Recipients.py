@@ -0,0 +1,92 @@
+import json
+import os
+import re
+
+# multicast 1回で送れる宛先の上限
+MULTICAST_LIMIT = 500
+
+# 振り分けルールに使える予約情報の項目
+ROUTING_FIELDS = ('platform', 'tour_name', 'tour_language')
+
+
+def is_user_id(recipient_id):
+    """ユーザーIDかどうか（グループ: C...・トークルーム: R... はmulticastで送れない）"""
+    return recipient_id.startswith('U')
+
+
+class Recipient:
+    """通知の宛先と振り分けルール
+
+    rulesは項目名から正規表現（大文字小文字は区別しない）への対応で、
+    すべてのルールに一致する予約だけをこの宛先に送る。ルールがなければすべての予約を送る。
+    """
+
+    def __init__(self, recipient_id, name=None, rules=None):
+        self.id = recipient_id
+        self.name = name or recipient_id
+        self.rules = [
+            (field, re.compile(pattern, re.IGNORECASE))
+            for field, pattern in (rules or {}).items()
+        ]
+
+    def matches(self, booking_info):
+        for field, rule in self.rules:
+            if not rule.search(booking_info.get(field) or ''):
+                return False
+        return True
+
+
+class RecipientRouter:
+    """予約ごとに通知する宛先を決める
+
+    宛先の設定は次の順に探す：
+    1. LINE_RECIPIENTS_FILE のJSONファイル
+       [{"id": "U...", "name": "office"},
+        {"id": "C...", "name": "guides-en", "tour_language": "english"}]
+    2. LINE_TARGET_USER_IDS（カンマ区切り、全予約を送る）
+    3. LINE_TARGET_USER_ID（従来の1宛先）
+    """
+
+    def __init__(self, recipients):
+        self.recipients = list(recipients)
+
+    @classmethod
+    def from_env(cls):
+        recipients_file = os.getenv("LINE_RECIPIENTS_FILE")
+        if recipients_file:
+            with open(recipients_file, encoding='utf-8') as f:
+                entries = json.load(f)
+            return cls(
+                Recipient(
+                    entry['id'],
+                    name=entry.get('name'),
+                    rules={field: entry[field] for field in ROUTING_FIELDS if entry.get(field)},
+                )
+                for entry in entries
+            )
+
+        ids = os.getenv("LINE_TARGET_USER_IDS") or os.getenv("LINE_TARGET_USER_ID") or ''
+        return cls(Recipient(recipient_id.strip()) for recipient_id in ids.split(',') if recipient_id.strip())
+
+    def __bool__(self):
+        return bool(self.recipients)
+
+    def __len__(self):
+        return len(self.recipients)
+
+    def route(self, booking_info):
+        """予約を送る宛先IDを設定の順に返す（重複なし）"""
+        return list(dict.fromkeys(
+            recipient.id for recipient in self.recipients if recipient.matches(booking_info)
+        ))
+
+
+def split_for_delivery(recipient_ids):
+    """宛先を multicast（ユーザーを最大500件ずつ）と push（グループ・トークルーム）に分ける
+
+    戻り値は (multicastの宛先リストのリスト, pushの宛先リスト)。
+    """
+    users = [recipient_id for recipient_id in recipient_ids if is_user_id(recipient_id)]
+    others = [recipient_id for recipient_id in recipient_ids if not is_user_id(recipient_id)]
+    batches = [users[start:start + MULTICAST_LIMIT] for start in range(0, len(users), MULTICAST_LIMIT)]
+    return batches, others
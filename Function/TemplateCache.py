@@ -0,0 +1,221 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from html import unescape
+from Function.Metrics import TEMPLATE_CACHE_TOTAL
+
+# タグで分割する（キャプチャしたタグ名が構造、それ以外がテキスト）
+_TAG_SPLIT = re.compile(r'<(/?[A-Za-z!][^\s/>]*)[^>]*>')
+
+# 学習できなかったレイアウトの目印（汎用の経路で処理する）
+_UNCACHEABLE = object()
+
+
+def skeleton(html):
+    """HTMLをテキストの断片とレイアウトの指紋に分ける
+
+    指紋はタグ名の並びだけから作るため、属性や値が違っても同じテンプレートなら同じになる。
+    同じ指紋のHTMLは断片の数も同じなので、断片の位置で項目を指定できる。
+    """
+    pieces = _TAG_SPLIT.split(html)
+    fingerprint = hash('\x00'.join(pieces[1::2]))
+    return pieces[0::2], fingerprint
+
+
+def _normalize(text):
+    """汎用の経路（html_to_text → 抽出）と同じ形に整える"""
+    if '&' in text:
+        text = unescape(text)
+    return ' '.join(text.split()).replace('*', '')
+
+
+class LearnedTemplate:
+    """1つのレイアウトについて、各項目が何番目の断片にあるかを覚えたもの
+
+    fieldsは 項目 → (断片の位置, ラベル, 目印)。
+    - ラベルがある場合は「Option: ...」のようにラベルと値が同じ断片にあり、ラベルを除いた残りが値になる
+    - 値だけの断片は、直前の空でない断片（表のラベル列など）を目印として覚えておく。
+      タグの並びが同じでも行の種類が違う（電話番号の行と集合場所の行など）メールを区別するため
+    """
+
+    def __init__(self, fields, texts=()):
+        self.fields = fields
+        self.confirmations = 0
+        # 覚えていない断片の学習時の内容（変わった断片だけを確認する）
+        mapped = {index for index, _, _ in fields.values()}
+        self._unmapped = [(index, text) for index, text in enumerate(texts) if index not in mapped]
+
+    @staticmethod
+    def _anchor(normalized, index):
+        for position in range(index - 1, -1, -1):
+            if normalized[position]:
+                return position, normalized[position]
+        return None
+
+    @classmethod
+    def learn(cls, texts, booking_info):
+        """汎用の経路で抽出した結果から、各項目の断片の位置を探す（見つからなければNone）"""
+        normalized = [_normalize(text) for text in texts]
+        fields = {}
+        for field, value in booking_info.items():
+            location = None
+            for index, text in enumerate(normalized):
+                if text == value:
+                    location = (index, None, cls._anchor(normalized, index))
+                    break
+                if location is None and len(text) > len(value) and text.endswith(value):
+                    label = text[:-len(value)]
+                    if label.rstrip() != label or label.endswith(':'):
+                        location = (index, label, None)
+            if location is None:
+                return None
+            fields[field] = location
+        # 2つの項目が同じ断片を指す場合は、どちらの項目の行なのか決められない
+        if len({index for index, _, _ in fields.values()}) < len(fields):
+            return None
+        return cls(fields, texts)
+
+    @staticmethod
+    def ambiguous(booking_info):
+        """同じ値の項目があるか（言語とツアー言語がどちらも"English"など）
+
+        値から断片の位置を探すため、どちらの行がどちらの項目か区別できない。
+        """
+        values = list(booking_info.values())
+        return len(set(values)) < len(values)
+
+    def apply(self, texts):
+        """覚えた位置から値を取り出す（レイアウトが合わなければNone）"""
+        booking_info = {}
+        for field, (index, label, anchor) in self.fields.items():
+            if anchor is not None and _normalize(texts[anchor[0]]) != anchor[1]:
+                return None
+            value = _normalize(texts[index])
+            if label is not None:
+                if not value.startswith(label):
+                    return None
+                value = value[len(label):].strip()
+            if not value:
+                return None
+            booking_info[field] = value
+        return booking_info
+
+    def unmapped_fields(self, texts, booking_info, extract_text):
+        """覚えた位置以外の断片から、booking_infoにない項目が見つかればその一覧を返す
+
+        タグの並びが同じでも、以前は挨拶文だった段落に「Option: ...」が入るなど、
+        覚えていない断片に項目が増えることがある。学習時と同じ断片（フッターなど）は
+        学習時の結果に含まれているため、内容が変わった断片だけを直前の空でない断片
+        （ラベルの列など）と合わせて確認する。
+        """
+        changed = []
+        for index, learned_text in self._unmapped:
+            text = texts[index]
+            if text == learned_text or not text.strip():
+                continue
+            for position in range(index - 1, -1, -1):
+                if texts[position].strip():
+                    changed.append(_normalize(texts[position]))
+                    break
+            changed.append(_normalize(text))
+        if not changed:
+            return []
+        return [field for field in extract_text('\n'.join(changed)) if field not in booking_info]
+
+
+class TemplateCache:
+    """レイアウトの指紋ごとに学習した抽出方法を覚えておくキャッシュ
+
+    - 初めてのレイアウトは汎用の経路で抽出し、その結果から各項目の位置を学習する
+    - 続くconfirmations件で汎用の経路と結果が一致したら、以降はHTMLの変換と
+      パターン検索を省いて、覚えた位置から直接取り出す
+    - 同じ指紋でも行の種類が違うメールは、別の型としてmax_variants個まで覚える
+    - 汎用の経路と結果が食い違ったレイアウトは学習対象外として汎用の経路で処理する
+    - 同じ値の項目があるメールからは学習せず、値が異なるメールが届くのを待つ
+    - 学習済みの位置から取り出した場合も、それ以外の断片に項目のラベルがあれば
+      （extract_textで項目が見つかれば）汎用の経路で処理し、学習対象外にする
+    保持するレイアウトの数には上限があり、使われていないものから捨てる。
+    """
+
+    def __init__(self, max_templates=None, confirmations=None, max_variants=8):
+        self.max_templates = max_templates or int(os.getenv("TEMPLATE_CACHE_SIZE", "128"))
+        self.confirmations = confirmations if confirmations is not None else int(
+            os.getenv("TEMPLATE_CONFIRMATIONS", "2")
+        )
+        self.max_variants = max_variants
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def extract(self, html, generic, namespace=None, extract_text=None):
+        """HTMLから予約情報を抽出する
+
+        genericはHTMLを受け取る汎用の抽出関数、extract_textはテキストを受け取る
+        プラットフォームの抽出関数（覚えていない断片に項目がないかの確認に使う）。
+        namespace（プラットフォーム名など）ごとに別のレイアウトとして覚えるため、
+        抽出関数が違うメールで学習結果を取り違えない。
+        """
+        texts, fingerprint = skeleton(html)
+        fingerprint = (namespace, fingerprint)
+        with self._lock:
+            variants = self._templates.get(fingerprint)
+            if variants is not None:
+                self._templates.move_to_end(fingerprint)
+
+        if variants is _UNCACHEABLE:
+            TEMPLATE_CACHE_TOTAL.inc(result='uncacheable')
+            return generic(html)
+
+        candidates = []
+        for template in variants or ():
+            extracted = template.apply(texts)
+            if extracted is None:
+                continue
+            if template.confirmations >= self.confirmations:
+                if extract_text is not None and template.unmapped_fields(texts, extracted, extract_text):
+                    # 覚えていない断片に項目があるレイアウトは以降も汎用の経路で処理する
+                    self._store(fingerprint, _UNCACHEABLE)
+                    TEMPLATE_CACHE_TOTAL.inc(result='reject')
+                    return generic(html)
+                TEMPLATE_CACHE_TOTAL.inc(result='hit')
+                return extracted
+            candidates.append((template, extracted))
+
+        booking_info = generic(html)
+        if not booking_info:
+            return booking_info
+
+        if candidates:
+            template, extracted = candidates[0]
+            if extracted == booking_info:
+                template.confirmations += 1
+                TEMPLATE_CACHE_TOTAL.inc(result='confirm')
+            else:
+                # 汎用の経路と結果が違うレイアウトは以降も汎用の経路で処理する
+                self._store(fingerprint, _UNCACHEABLE)
+                TEMPLATE_CACHE_TOTAL.inc(result='reject')
+            return booking_info
+
+        if LearnedTemplate.ambiguous(booking_info):
+            TEMPLATE_CACHE_TOTAL.inc(result='ambiguous')
+            return booking_info
+
+        learned = LearnedTemplate.learn(texts, booking_info)
+        variants = list(variants or ())
+        if learned is None or len(variants) >= self.max_variants:
+            self._store(fingerprint, _UNCACHEABLE)
+            TEMPLATE_CACHE_TOTAL.inc(result='uncacheable')
+        else:
+            self._store(fingerprint, variants + [learned])
+            TEMPLATE_CACHE_TOTAL.inc(result='learn')
+        return booking_info
+
+    def __len__(self):
+        return len(self._templates)
+
+    def _store(self, fingerprint, template):
+        with self._lock:
+            self._templates[fingerprint] = template
+            self._templates.move_to_end(fingerprint)
+            while len(self._templates) > self.max_templates:
+                self._templates.popitem(last=False)
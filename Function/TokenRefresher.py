@@ -0,0 +1,56 @@
+import os
+import threading
+from datetime import datetime, timezone
+import httplib2
+from google_auth_httplib2 import Request
+
+
+class TokenRefresher:
+    """Gmailのアクセストークンを有効期限の前にバックグラウンドで更新する
+
+    期限切れのトークンは最初のAPI呼び出しの中で更新されるため、その分だけ
+    起動直後や長い待機の後のチェックが遅くなる。期限のmargin秒前に別スレッドで
+    更新しておき、更新したトークンはtoken_fileにも保存する。
+    """
+
+    def __init__(self, creds, token_file, margin=None, retry_interval=30):
+        self.creds = creds
+        self.token_file = token_file
+        self.margin = float(margin if margin is not None else os.getenv("GMAIL_TOKEN_REFRESH_MARGIN", "300"))
+        self.retry_interval = retry_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not self.creds.refresh_token:
+            return None
+        self._thread = threading.Thread(target=self._run, name='gmail-token-refresh', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+
+    def seconds_until_refresh(self):
+        """次に更新するまでの秒数（期限が不明・期限切れなら0）"""
+        if not self.creds.token or not self.creds.expiry:
+            return 0
+        # google-authのexpiryはタイムゾーンなしのUTC
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        remaining = (self.creds.expiry - now).total_seconds()
+        return max(0, remaining - self.margin)
+
+    def refresh(self):
+        self.creds.refresh(Request(httplib2.Http()))
+        with open(self.token_file, 'w') as token:
+            token.write(self.creds.to_json())
+
+    def _run(self):
+        while not self._stop.wait(self.seconds_until_refresh()):
+            try:
+                self.refresh()
+                print(f"🔑 Gmailのトークンを更新しました（有効期限 {self.creds.expiry:%H:%M:%S} UTC）")
+            except Exception as e:
+                print(f"⚠️ トークンの更新に失敗しました（{self.retry_interval}秒後に再試行）: {e}")
+                if self._stop.wait(self.retry_interval):
+                    break
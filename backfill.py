@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from email import message_from_bytes, policy
+from dotenv import load_dotenv
+from Function.BookingStore import BookingStore
+from Function.HtmlText import html_to_text
+from Function.MailTriage import SubjectTriage
+from Function.MimeParts import PREFERRED_TYPES
+from Function.PlatformRegistry import PlatformRegistry
+
+# 出力レコードのうち予約情報ではない項目（ストアには保存しない）
+RECORD_FIELDS = ('kind', 'subject', 'received', 'message_id', 'source')
+
+
+def iter_mbox(path):
+    """mboxファイルを1通ずつ (位置, バイト列) で返す（ファイル全体は読み込まない）"""
+    with open(path, 'rb') as f:
+        lines = None
+        start = offset = 0
+        for line in f:
+            if line.startswith(b'From '):
+                # 区切り行はメールの一部ではない
+                if lines is not None:
+                    yield f'{path}:{start}', b''.join(lines)
+                lines = []
+                start = offset
+            elif lines is not None:
+                # 本文中の ">From " は mboxrd の退避表記なので戻す
+                lines.append(line[1:] if line.startswith(b'>From ') else line)
+            offset += len(line)
+        if lines is not None:
+            yield f'{path}:{start}', b''.join(lines)
+
+
+def iter_eml_dir(path):
+    """ディレクトリ内の .eml ファイルを (パス, バイト列) で名前順に返す"""
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            if name.lower().endswith('.eml'):
+                file_path = os.path.join(root, name)
+                with open(file_path, 'rb') as f:
+                    yield file_path, f.read()
+
+
+def iter_messages(path):
+    if os.path.isdir(path):
+        return iter_eml_dir(path)
+    return iter_mbox(path)
+
+
+def find_body(message, content_type):
+    """指定したタイプの本文パートを探す（MimeParts.find_partと同じく添付は除き、最後のパートを使う）"""
+    found = None
+    for part in message.walk():
+        if part.is_multipart() or part.is_attachment():
+            continue
+        if part.get_content_type() == content_type:
+            found = part
+    return found
+
+
+def decode_body(part):
+    """本文パートを文字列にする（パートがない・デコードできない場合はNone）"""
+    if part is None:
+        return None
+    try:
+        return part.get_content()
+    except (LookupError, UnicodeDecodeError, ValueError):
+        return None
+
+
+def parse_raw_message(source, raw, triage, platforms):
+    """1通のメールから予約情報を抽出してJSONLの1レコードを返す（予約でなければNone）"""
+    message = message_from_bytes(raw, policy=policy.default)
+    subject = str(message.get('Subject', ''))
+    kind = triage.classify(subject)
+    if kind is None:
+        return None
+    platform = platforms.match(str(message.get('From', '')), subject)
+    if platform is None:
+        return None
+
+    # GmailMonitorと同じく、HTMLから抽出できなければ次の種類の本文を試す
+    booking_info = None
+    for content_type in PREFERRED_TYPES:
+        content = decode_body(find_body(message, content_type))
+        if not content or not content.strip():
+            continue
+        if content_type == 'text/html':
+            content = html_to_text(content)
+        booking_info = platform.extract(content)
+        if booking_info:
+            break
+    if not booking_info:
+        return None
+
+    return {
+        **booking_info,
+        'platform': platform.label,
+        'kind': kind,
+        'subject': subject,
+        'received': str(message.get('Date', '')),
+        'message_id': str(message.get('Message-ID', '')),
+        'source': source,
+    }
+
+
+_TRIAGE = None
+_PLATFORMS = None
+
+
+def _worker_triage():
+    """ワーカープロセスごとに1回だけSubjectTriageとPlatformRegistryを作る"""
+    global _TRIAGE, _PLATFORMS
+    if _TRIAGE is None:
+        load_dotenv()
+        _TRIAGE = SubjectTriage()
+        _PLATFORMS = PlatformRegistry.from_env()
+    return _TRIAGE, _PLATFORMS
+
+
+def parse_chunk(chunk):
+    """ワーカープロセスでメールをまとめて解析"""
+    triage, platforms = _worker_triage()
+    records = []
+    errors = 0
+    for source, raw in chunk:
+        try:
+            record = parse_raw_message(source, raw, triage, platforms)
+        except Exception as error:
+            print(f"⚠️ 解析エラー ({source}): {error}", file=sys.stderr)
+            errors += 1
+            continue
+        if record:
+            records.append(record)
+    return len(chunk), errors, records
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def backfill(path, output, workers=None, chunk_size=200, store=None):
+    """アーカイブを並列で解析してJSONLに書き出す（先読みはワーカー数の2倍のチャンクまで）
+
+    storeにBookingStoreを渡すと、予約をアーカイブの順に保存する（キャンセル・変更も反映）。
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = workers * 2
+    started = time.monotonic()
+    scanned = found = errors = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+
+        def drain_one():
+            nonlocal scanned, found, errors
+            count, chunk_errors, records = in_flight.popleft().result()
+            for record in records:
+                output.write(json.dumps(record, ensure_ascii=False) + '\n')
+                if store is not None:
+                    booking_info = {key: value for key, value in record.items() if key not in RECORD_FIELDS}
+                    store.record(booking_info, record['kind'], record['message_id'] or record['source'])
+            scanned += count
+            found += len(records)
+            errors += chunk_errors
+            elapsed = time.monotonic() - started
+            print(f"⏳ {scanned:,} 件処理 / 予約 {found:,} 件 ({scanned / elapsed:,.0f} 件/秒)", file=sys.stderr)
+
+        for chunk in chunked(iter_messages(path), chunk_size):
+            in_flight.append(executor.submit(parse_chunk, chunk))
+            # 結果は投入順に書き出し、溜まりすぎたら古いものから待つ
+            if len(in_flight) >= max_in_flight:
+                drain_one()
+        while in_flight:
+            drain_one()
+
+    elapsed = time.monotonic() - started
+    print(f"✅ 完了: {scanned:,} 件中 {found:,} 件の予約を出力（エラー {errors} 件, {elapsed:.1f}秒）", file=sys.stderr)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='mbox / .emlディレクトリから予約情報をJSONLに抽出')
+    parser.add_argument('input', help='mboxファイル、または .eml ファイルのあるディレクトリ')
+    parser.add_argument('-o', '--output', default='-', help='出力するJSONLファイル（省略時は標準出力）')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='ワーカープロセス数（省略時はCPU数）')
+    parser.add_argument('--chunk-size', type=int, default=200, help='1回にワーカーへ渡すメール数')
+    parser.add_argument('--store', default=None, help='予約を保存するストア（SQLite）。予約一覧（roster.py）に使える')
+    args = parser.parse_args()
+
+    store = BookingStore(args.store) if args.store else None
+    try:
+        if args.output == '-':
+            backfill(args.input, sys.stdout, args.workers, args.chunk_size, store)
+        else:
+            with open(args.output, 'w', encoding='utf-8') as output:
+                backfill(args.input, output, args.workers, args.chunk_size, store)
+    finally:
+        if store is not None:
+            store.close()
+
+
+if __name__ == '__main__':
+    main()
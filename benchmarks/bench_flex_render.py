@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from linebot.models import FlexSendMessage
+from Function.LineApi import LineApi
+from Function.FlexTemplate import BubbleTemplate, OPTIONAL_FIELDS
+from Function.MailTriage import KIND_BOOKING, KIND_AMENDMENT, KIND_CANCELLATION
+
+# 構成（kind）の種類（Noneは種類の指定がないメール）
+KINDS = (None, KIND_BOOKING, KIND_AMENDMENT, KIND_CANCELLATION)
+
+# 予約情報のサンプル（任意項目ありの場合）
+SAMPLE_BOOKING = {
+    'tour_name': 'Tokyo: Shibuya Night Food Tour with a Local Guide',
+    'options': 'Small group, max 8 people',
+    'date': 'Saturday, June 14, 2025 at 7:00 PM',
+    'price': '¥ 18,000',
+    'customer_name': 'Jane Doe',
+    'phone': '+1 555 0100',
+    'language': 'English',
+    'tour_language': 'English (Live tour guide)',
+    'pickup_location': 'Hachiko Statue, Shibuya Station',
+    'reference': 'GYGABC123XYZ',
+    'platform': 'GetYourGuide',
+    'changes': 'Date: Friday, June 13, 2025 at 7:00 PM → Saturday, June 14, 2025 at 7:00 PM',
+}
+
+
+def sdk_render(line_api, booking_info):
+    """従来の方法：SDKのComponentを組み立ててJSONに変換"""
+    return FlexSendMessage(
+        alt_text="New Booking Received",
+        contents=line_api._build_booking_bubble(booking_info)
+    ).as_json_dict()
+
+
+def template_render(template, booking_info):
+    """骨組みを使い回す方法"""
+    return template.render_message(booking_info).as_json_dict()
+
+
+def check_identical(line_api, template):
+    """構成（kind）と任意項目の有無のすべての組み合わせで出力が一致することを確認"""
+    for kind in KINDS:
+        for mask in range(2 ** len(OPTIONAL_FIELDS)):
+            info = dict(SAMPLE_BOOKING, kind=kind) if kind else dict(SAMPLE_BOOKING)
+            for bit, field in enumerate(OPTIONAL_FIELDS):
+                if not mask & (1 << bit):
+                    del info[field]
+            for missing in (None, 'date', 'tour_name', 'platform'):
+                case = {key: value for key, value in info.items() if key != missing}
+                sdk = json.dumps(sdk_render(line_api, case))
+                rendered = json.dumps(template_render(template, case))
+                assert sdk == rendered, f"出力が一致しません: {case}"
+
+
+def main():
+    line_api = LineApi.__new__(LineApi)  # LINE設定なしでバブルの組み立てだけを使う
+    template = BubbleTemplate(line_api._build_booking_bubble)
+
+    check_identical(line_api, template)
+    print("✅ SDKと同じJSONを出力することを確認しました")
+
+    number = int(os.getenv("BENCH_NUMBER", "500"))
+    results = {}
+    for name, func in (
+        ('SDK', lambda: sdk_render(line_api, SAMPLE_BOOKING)),
+        ('テンプレート', lambda: template_render(template, SAMPLE_BOOKING)),
+        ('SDK + json.dumps', lambda: json.dumps(sdk_render(line_api, SAMPLE_BOOKING))),
+        ('テンプレート + json.dumps', lambda: json.dumps(template_render(template, SAMPLE_BOOKING))),
+    ):
+        best = min(timeit.repeat(func, number=number, repeat=5)) / number
+        results[name] = best
+        print(f"{name:<28} {best * 1e6:8.1f} µs/件")
+
+    print(f"📈 テンプレートはSDKの {results['SDK'] / results['テンプレート']:.1f} 倍速")
+
+
+if __name__ == '__main__':
+    main()
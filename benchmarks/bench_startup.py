@@ -0,0 +1,105 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 以前のmain.pyが起動時にまとめて読み込んでいたライブラリ（＋現在のモジュール）
+EAGER_IMPORTS = f'''
+import sys, time
+sys.path.insert(0, {ROOT!r})
+started = time.perf_counter()
+import asyncio
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2, requests
+from linebot import LineBotApi
+from linebot.models import FlexSendMessage, BubbleContainer, BoxComponent, TextComponent
+import main
+from Function.GmailMonitor import GmailMonitor
+from Function.LineApi import LineApi
+from Function.BookingCoalescer import BookingCoalescer
+from Function.BookingPipeline import BookingPipeline
+print(time.perf_counter() - started)
+'''
+
+# 現在の起動時の読み込み（main → GmailMonitor / LineApi）
+FAST_IMPORTS = f'''
+import sys, time
+sys.path.insert(0, {ROOT!r})
+started = time.perf_counter()
+import main
+from Function.GmailMonitor import GmailMonitor
+from Function.LineApi import LineApi
+from Function.BookingCoalescer import BookingCoalescer
+print(time.perf_counter() - started)
+'''
+
+# 以前の build() によるサービスの作成
+BUILD = '''
+import time
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+credentials = Credentials(token='dummy')
+started = time.perf_counter()
+build('gmail', 'v1', credentials=credentials)
+print(time.perf_counter() - started)
+'''
+
+# ローカルに保存したディスカバリドキュメントからのサービスの作成
+BUILD_FROM_CACHE = f'''
+import sys, time
+sys.path.insert(0, {ROOT!r})
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build_from_document
+from Function.GmailMonitor import load_discovery_document
+credentials = Credentials(token='dummy')
+started = time.perf_counter()
+build_from_document(load_discovery_document(sys.argv[1]), credentials=credentials)
+print(time.perf_counter() - started)
+'''
+
+
+def measure(code, repeat, *args):
+    """新しいプロセスでcodeを実行し、出力された秒数の中央値を返す"""
+    samples = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', code, *args], capture_output=True, text=True, check=True
+        ).stdout
+        samples.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='起動時間（ライブラリの読み込みとGmailサービスの作成）のベンチマーク')
+    parser.add_argument('--repeat', type=int, default=5, help='計測の繰り返し回数（中央値を採用）')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_file = os.path.join(tmp_dir, 'gmail_discovery.json')
+        # 1回目でドキュメントを保存し、以降の計測は保存済みのものを読む
+        measure(BUILD_FROM_CACHE, 1, cache_file)
+        results = [
+            ('ライブラリの読み込み', measure(EAGER_IMPORTS, args.repeat), measure(FAST_IMPORTS, args.repeat)),
+            ('Gmailサービスの作成', measure(BUILD, args.repeat), measure(BUILD_FROM_CACHE, args.repeat, cache_file)),
+        ]
+
+    print(f"{'':<20} {'以前':>9} {'現在':>9}")
+    for name, before, after in results:
+        print(f"{name:<20} {before * 1000:7.0f}ms {after * 1000:7.0f}ms")
+    before = sum(result[1] for result in results)
+    after = sum(result[2] for result in results)
+    print(f"🚀 合計 {before * 1000:.0f}ms → {after * 1000:.0f}ms（{before / after:.1f} 倍速）")
+    print("ℹ️ トークンの更新（ネットワーク往復）はバックグラウンドで行うため、起動時間には含まれなくなりました")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Function.TemplateCache import TemplateCache
+from Function.PlatformRegistry import GETYOURGUIDE
+from benchmarks.bench_parser import make_monitor, decode_preferred
+from benchmarks.synthetic_emails import generate_corpus, to_gmail_message
+
+
+def main():
+    parser = argparse.ArgumentParser(description='レイアウトの指紋キャッシュのベンチマーク')
+    parser.add_argument('--count', type=int, default=2000, help='合成メールの件数')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--layouts', type=int, default=3, help='フッターの段落数の種類（レイアウトの数に影響）')
+    args = parser.parse_args()
+
+    paddings = [index * 5 for index in range(args.layouts)]
+    htmls = []
+    for index, (_, mime) in enumerate(generate_corpus(args.count, args.seed, paddings=paddings)):
+        mime_type, content = decode_preferred(to_gmail_message(mime, f'synthetic-{index}')['payload'])
+        htmls.append(content)
+
+    monitor = make_monitor()
+    generic = monitor._extract_from_html
+
+    started = time.perf_counter()
+    expected = [generic(html) for html in htmls]
+    generic_seconds = time.perf_counter() - started
+
+    cache = TemplateCache()
+    started = time.perf_counter()
+    results = [cache.extract(html, generic, extract_text=GETYOURGUIDE.extract) for html in htmls]
+    cached_seconds = time.perf_counter() - started
+
+    mismatches = sum(1 for got, want in zip(results, expected) if got != want)
+    print(f"📨 {args.count} 件 / 学習したレイアウト {len(cache)} 種類")
+    print(f"   汎用の経路     {generic_seconds / args.count * 1e6:8.1f} µs/件")
+    print(f"   指紋キャッシュ {cached_seconds / args.count * 1e6:8.1f} µs/件"
+          f"（{generic_seconds / cached_seconds:.1f} 倍速）")
+    if mismatches:
+        print(f"❌ 汎用の経路と結果が異なるメール: {mismatches} 件")
+        return 1
+    print("✅ すべてのメールで汎用の経路と同じ結果です")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import base64
+import random
+from email.message import EmailMessage
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+# GetYourGuideの予約メールに似せた合成データの材料
+TOURS = [
+    'Tokyo: Shibuya Night Food Tour with a Local Guide',
+    'Private Tokyo Highlights Tour with Licensed Guide',
+    'Customizable Kyoto Walking Tour',
+    'Tokyo: Asakusa and Senso-ji Temple Tour',
+    'Mt. Fuji Day Trip Tour from Tokyo',
+]
+OPTIONS = ['Small group, max 8 people', 'Private tour', 'Morning departure', 'Evening departure', '']
+FIRST_NAMES = ['Jane', 'John', 'María', 'Léa', 'Søren', 'Akira', 'Chloé', 'Ömer']
+LAST_NAMES = ['Doe', 'Smith', 'García', 'Müller', 'Rossi', 'Tanaka', 'Dubois', 'Yılmaz']
+LANGUAGES = ['English', 'Spanish', 'French', 'German', 'Italian', 'Japanese']
+PICKUPS = ['Hachiko Statue, Shibuya Station', 'Hotel lobby (Shinjuku)', 'Asakusa Station Exit 1', '']
+
+
+def generate_booking(rng):
+    """予約情報（抽出結果の正解）を1件作る"""
+    start = datetime(2025, 1, 1, 9, 0) + timedelta(days=rng.randrange(365), hours=rng.randrange(12))
+    booking = {
+        'tour_name': rng.choice(TOURS),
+        'date': start.strftime('%A, %B %d, %Y at %I:%M %p'),
+        'price': f'¥ {rng.randrange(5, 60) * 1000:,}',
+        'reference': 'GYG' + ''.join(rng.choice('ABCDEFGHJKLMNPQRSTUVWXYZ23456789') for _ in range(9)),
+        'customer_name': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+        'language': rng.choice(LANGUAGES),
+        'tour_language': f'{rng.choice(LANGUAGES)} (Live tour guide)',
+    }
+    option = rng.choice(OPTIONS)
+    if option:
+        booking['options'] = option
+    if rng.random() < 0.6:
+        booking['phone'] = f'+{rng.randrange(1, 99)} {rng.randrange(100, 999)} {rng.randrange(1000, 9999)}'
+    pickup = rng.choice(PICKUPS)
+    if pickup:
+        booking['pickup_location'] = pickup
+    return booking
+
+
+def _row(label, value):
+    return (
+        '<tr><td style="padding:4px 8px;color:#555555;font-family:Arial,sans-serif">'
+        f'{label}</td><td style="padding:4px 8px;color:#111111">{value}</td></tr>'
+    )
+
+
+def booking_html(booking, padding=0):
+    """表組みのHTML本文（paddingの数だけ定型のフッター段落を足してサイズを変える）"""
+    rows = [
+        _row('Date:', booking['date']),
+        _row('Price:', booking['price'].replace('¥', '&yen;')),
+        _row('Reference number:', booking['reference']),
+        _row('Main customer:', booking['customer_name']),
+    ]
+    if 'phone' in booking:
+        rows.append(_row('Phone:', booking['phone']))
+    rows.append(_row('Language:', booking['language']))
+    rows.append(_row('Tour language:', booking['tour_language']))
+    if 'pickup_location' in booking:
+        rows.append(_row('Pickup location:', booking['pickup_location']))
+
+    option = f'<p>Option: {booking["options"]}</p>' if 'options' in booking else ''
+    footer = ''.join(
+        '<p style="font-size:11px;color:#999999">You received this email because you are a supplier '
+        'on GetYourGuide. &copy; GetYourGuide Deutschland GmbH &ndash; '
+        f'<a href="https://supplier.getyourguide.com/notice/{index}">Manage notifications</a></p>'
+        for index in range(padding)
+    )
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8">'
+        '<style>td{font-size:14px} .btn{background:#ff5533}</style>'
+        '<script>window.dataLayer=window.dataLayer||[];</script></head><body>'
+        '<table width="100%" cellpadding="0" cellspacing="0"><tr><td>'
+        '<h1>Hi supply partner,</h1>'
+        f'<p>The following offer has been booked: <strong>{booking["tour_name"]}</strong></p>'
+        f'{option}'
+        f'<table>{"".join(rows)}</table>'
+        '<div><a class="btn" href="https://supplier.getyourguide.com/bookings">View booking</a></div>'
+        f'{footer}'
+        '</td></tr></table></body></html>'
+    )
+
+
+def booking_text(booking):
+    """プレーンテキストの本文"""
+    lines = [
+        'Hi supply partner,',
+        f'The following offer has been booked: {booking["tour_name"]}',
+    ]
+    if 'options' in booking:
+        lines.append(f'Option: {booking["options"]}')
+    lines += [
+        f'Date: {booking["date"]}',
+        f'Price: {booking["price"]}',
+        f'Reference number: {booking["reference"]}',
+        f'Main customer: {booking["customer_name"]}',
+    ]
+    if 'phone' in booking:
+        lines.append(f'Phone: {booking["phone"]}')
+    lines += [
+        f'Language: {booking["language"]}',
+        f'Tour language: {booking["tour_language"]}',
+    ]
+    if 'pickup_location' in booking:
+        lines.append(f'Pickup location: {booking["pickup_location"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def build_mime(booking, rng, index=0, padding=None):
+    """multipart/alternative（テキスト＋HTML）のメールを組み立てる"""
+    message = EmailMessage()
+    message['From'] = 'GetYourGuide <do-not-reply@notification.getyourguide.com>'
+    message['To'] = 'bookings@example.com'
+    message['Subject'] = f'Booking - S{rng.randrange(100000, 999999)} - {booking["reference"]}'
+    message['Date'] = format_datetime(datetime(2025, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=index))
+    message['Message-ID'] = f'<synthetic-{index}@example.com>'
+    message.set_content(booking_text(booking))
+    # サイズのばらつき（指定がなければフッター0〜40段落）
+    if padding is None:
+        padding = rng.randrange(0, 40)
+    message.add_alternative(booking_html(booking, padding=padding), subtype='html')
+    return message
+
+
+def _gmail_part(part):
+    """email.messageのパートをGmail APIのペイロード形式に変換"""
+    headers = [{'name': name, 'value': str(value)} for name, value in part.items()]
+    if part.is_multipart():
+        return {
+            'mimeType': part.get_content_type(),
+            'headers': headers,
+            'body': {'size': 0},
+            'parts': [_gmail_part(child) for child in part.iter_parts()],
+        }
+    data = part.get_payload(decode=True) or b''
+    return {
+        'mimeType': part.get_content_type(),
+        'headers': headers,
+        'body': {'size': len(data), 'data': base64.urlsafe_b64encode(data).decode('ascii')},
+    }
+
+
+def to_gmail_message(mime, message_id):
+    """Gmail APIのmessages.get(format='full')と同じ形のdictにする"""
+    return {
+        'id': message_id,
+        'internalDate': str(int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp() * 1000)),
+        'payload': _gmail_part(mime),
+    }
+
+
+def generate_corpus(count, seed=42, paddings=None):
+    """(正解の予約情報, MIMEメール) を count 件返すジェネレータ
+
+    paddingsを指定すると、フッターの段落数をその中から選ぶ（レイアウトの種類を絞る）。
+    """
+    rng = random.Random(seed)
+    for index in range(count):
+        booking = generate_booking(rng)
+        padding = rng.choice(paddings) if paddings else None
+        yield booking, build_mime(booking, rng, index, padding=padding)
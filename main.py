@@ -1,14 +1,79 @@
-import os
 import time
+
+# 起動時間の計測はモジュールの読み込みから始める
+STARTED = time.perf_counter()
+
+import os
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from Function.GmailMonitor import GmailMonitor
-from Function.LineApi import  LineApi
+from Function.PollScheduler import PollScheduler
+from Function.Metrics import start_metrics_server, StartupTimer
+
+# Google・LINEのクライアントライブラリは読み込みに時間がかかるため、
+# 設定を確認してから各関数の中で読み込む
+
+def run_mailboxes(mailboxes_file, timer):
+    """MAILBOXES_FILEに書かれた複数のメールボックスを1プロセスで監視"""
+    from Function.LineApi import LineApi
+    from Function.BookingCoalescer import BookingCoalescer
+    from Function.MailboxRunner import MailboxRunner
+    timer.mark('import')
+    
+    runner = None
+    lineApi = None
+    try:
+        lineApi = LineApi()
+        runner = MailboxRunner.from_file(mailboxes_file, lineApi)
+        timer.mark('auth')
+        
+        # 送信結果はキーのメールボックス名から、それぞれの台帳に記録する
+        lineApi.start_delivery(on_queued=runner.mark_queued, on_delivered=runner.mark_notified)
+        if float(os.getenv("LINE_COALESCE_WINDOW", "10")) > 0 or lineApi.quota:
+            runner.set_coalescer(BookingCoalescer(lineApi, on_delivered=runner.mark_notified, on_held=runner.mark_held))
+        lineApi.warm_up()
+        timer.mark('delivery')
+        
+        print(f"📱 {len(runner.mailboxes)} 件のメールボックスの監視開始...")
+        print("⏹️  停止するには Ctrl+C を押してください")
+        
+        runner.resume_pending()
+        timer.mark('resume')
+        timer.report()
+        runner.run()
+        
+    except KeyboardInterrupt:
+        if runner:
+            for mailbox in runner.mailboxes.values():
+                if mailbox.monitor.coalescer:
+                    mailbox.monitor.coalescer.close()
+                    break
+        if lineApi and lineApi.delivery:
+            lineApi.delivery.join(timeout=10)
+        if runner:
+            for mailbox in runner.mailboxes.values():
+                mailbox.monitor.apply_notified_label()
+        print("\n⏹️  メール監視を停止しました")
+    except Exception as e:
+        print(f"❌ 初期化エラー: {e}")
+        print("💡 設定を確認してください")
 
 def main():
+    timer = StartupTimer(STARTED)
+    
     # 環境変数を読み込み
     load_dotenv()
     
-    # 設定取得
+    # 処理段階ごとの所要時間や件数をPrometheus形式で公開（METRICS_PORT=0で無効）
+    start_metrics_server()
+    timer.mark('config')
+    
+    # 複数のメールボックスを監視する場合
+    mailboxes_file = os.getenv("MAILBOXES_FILE")
+    if mailboxes_file:
+        run_mailboxes(mailboxes_file, timer)
+        return
+    
+    # 設定取得（カンマ区切りで複数の送信者を指定可能）
     target_email = os.getenv("TARGET_EMAIL")
     
     # 必須設定の確認
@@ -17,17 +82,62 @@ def main():
         print("📝 .envファイルに TARGET_EMAIL=your_email@gmail.com を追加してください")
         return
     
+    from Function.GmailMonitor import GmailMonitor
+    from Function.LineApi import LineApi
+    from Function.BookingCoalescer import BookingCoalescer
+    timer.mark('import')
+    
+    monitor = None
+    lineApi = None
     try:
         # クラスのインスタンス作成
         monitor = GmailMonitor()
         lineApi = LineApi()
-
+        timer.mark('auth')
+        
+        # LINE送信はスプールに保存してバックグラウンドで行う（前回の未送信分もここで再送）
+        lineApi.start_delivery(on_queued=monitor.mark_queued, on_delivered=monitor.mark_notified)
+        
+        # 短時間に続けて届いた予約はカルーセル1通にまとめて送信（0で無効）
+        # 月間メッセージ数の予算管理が有効な場合は、予算を超えそうな間のまとめ送信にも使う
+        if float(os.getenv("LINE_COALESCE_WINDOW", "10")) > 0 or lineApi.quota:
+            monitor.coalescer = BookingCoalescer(lineApi, on_delivered=monitor.mark_notified, on_held=monitor.mark_held)
+        
+        # 最初の通知までにSDKの読み込みとバブルの骨組み作りを済ませておく
+        lineApi.warm_up()
+        timer.mark('delivery')
         
         print(f"📱 {target_email} からのメール監視開始...")
         print("⏹️  停止するには Ctrl+C を押してください")
         print("📧 新着メールはリッチなFlex Messageで通知されます")
         
+        # 前回の停止時に通知まで終わらなかったメッセージを再処理
+        monitor.resume_pending(lineApi, sender_email=target_email)
+        timer.mark('resume')
+        timer.report()
+        
+        # 停止中に溜まったメールを起動時にまとめて処理
+        catchup_hours = os.getenv("GMAIL_CATCHUP_HOURS")
+        if catchup_hours:
+            monitor.catch_up(
+                sender_email=target_email,
+                line_api=lineApi,
+                since=datetime.now() - timedelta(hours=float(catchup_hours)),
+            )
+        
+        # 新着状況と時間帯に合わせてポーリング間隔を調整
+        scheduler = PollScheduler()
+        
+        # PIPELINE_MODE=async で取得・解析・送信を独立したステージで実行
+        if os.getenv("PIPELINE_MODE") == "async":
+            import asyncio
+            from Function.BookingPipeline import BookingPipeline
+            pipeline = BookingPipeline(monitor, lineApi, target_email, scheduler=scheduler)
+            asyncio.run(pipeline.run())
+            return
+        
         while True:
+            scheduler.wait()
             try:
                 # Flex Message対応の新しいメソッドを使用
                 new_emails =  monitor.check_new_emails_with_flex(
@@ -35,6 +145,12 @@ def main():
                         line_api=lineApi,
                     )
                 
+                if monitor.last_error:
+                    scheduler.record_error()
+                    print(f"🔄 {scheduler.last_interval:.0f}秒後に再試行します...")
+                    continue
+                
+                scheduler.record_success(new_emails)
                 if new_emails > 0:
                     print("🔔 新しいメールが届きました！Flex Message送信完了")
 
@@ -43,14 +159,23 @@ def main():
                     current_time = time.strftime("%H:%M:%S")
                     print(f"📭 新着メールなし ({current_time})")
                 
-                time.sleep(30)  # 30秒ごとにチェック
+                print(f"⏱️  次回チェック: {scheduler.next_run_time():%H:%M:%S}")
                 
             except Exception as e:
                 print(f"❌ メールチェック中にエラー: {e}")
-                print("🔄 30秒後に再試行します...")
-                time.sleep(30)
+                scheduler.record_error()
+                print(f"🔄 {scheduler.last_interval:.0f}秒後に再試行します...")
                 
     except KeyboardInterrupt:
+        if monitor and monitor.coalescer:
+            # まとめ送信待ちの予約を送ってから終了
+            monitor.coalescer.close()
+        if lineApi and lineApi.delivery:
+            # 送信待ちのメッセージを送り切ってから終了（残った分はスプールから次回再送）
+            lineApi.delivery.join(timeout=10)
+        if monitor:
+            # 通知済みのメッセージにラベルを付けてから終了
+            monitor.apply_notified_label()
         print("\n⏹️  メール監視を停止しました")
     except Exception as e:
         print(f"❌ 初期化エラー: {e}")
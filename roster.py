@@ -0,0 +1,78 @@
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from Function.BookingStore import BookingStore, STATUS_CANCELLED
+
+
+def parse_day(value):
+    """'today' / 'tomorrow' / 'YYYY-MM-DD' を日付にする"""
+    today = datetime.now().date()
+    if value == 'today':
+        return today
+    if value == 'tomorrow':
+        return today + timedelta(days=1)
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def format_booking(booking):
+    line = f"{booking['tour_date'][11:]}  {booking.get('customer_name', '-')}"
+    details = [booking.get(field) for field in ('tour_language', 'options', 'pickup_location') if booking.get(field)]
+    if details:
+        line += f"（{' / '.join(details)}）"
+    line += f"  [{booking['reference']}]"
+    if booking['status'] == STATUS_CANCELLED:
+        line += ' ❌ キャンセル'
+    elif booking['status'] != 'booked':
+        line += ' ✏️ 変更あり'
+    return line
+
+
+def print_roster(store, day, days=1, tour_name=None, include_cancelled=False):
+    """day から days 日分の予約一覧をツアーごとに表示（Gmailには問い合わせない）"""
+    start = datetime(day.year, day.month, day.day)
+    bookings = store.between(start, start + timedelta(days=days), tour_name, include_cancelled)
+    if not bookings:
+        print(f"📭 {day:%Y-%m-%d} から {days} 日間の予約はありません")
+        return 0
+
+    current_day = current_tour = None
+    for booking in sorted(bookings, key=lambda b: (b['tour_date'][:10], b.get('tour_name') or '', b['tour_date'])):
+        if booking['tour_date'][:10] != current_day:
+            current_day = booking['tour_date'][:10]
+            current_tour = None
+            print(f"\n📅 {current_day}")
+        if booking.get('tour_name') != current_tour:
+            current_tour = booking.get('tour_name')
+            print(f"  🗺️ {current_tour or 'Tour Booking'}")
+        print(f"    {format_booking(booking)}")
+    print(f"\n合計 {len(bookings)} 件")
+    return len(bookings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='保存済みの予約からツアーごとの予約一覧を表示')
+    parser.add_argument('day', nargs='?', default='tomorrow', help='today / tomorrow / YYYY-MM-DD（省略時は明日）')
+    parser.add_argument('--days', type=int, default=1, help='表示する日数')
+    parser.add_argument('--tour', default=None, help='ツアー名（完全一致）で絞り込む')
+    parser.add_argument('--include-cancelled', action='store_true', help='キャンセルされた予約も表示')
+    parser.add_argument('--db', default=None, help='予約のストア（省略時はBOOKING_STORE_DB）')
+    args = parser.parse_args()
+
+    load_dotenv()
+    db_path = args.db or os.getenv("BOOKING_STORE_DB", "bookings.db")
+    if not os.path.exists(db_path):
+        print(f"❌ 予約のストアがありません: {db_path}")
+        return 1
+
+    store = BookingStore(db_path)
+    try:
+        print_roster(store, parse_day(args.day), args.days, args.tour, args.include_cancelled)
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
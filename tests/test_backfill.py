@@ -0,0 +1,45 @@
+import os
+import sys
+import unittest
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backfill import parse_raw_message
+from Function.MailTriage import SubjectTriage
+from Function.PlatformRegistry import GETYOURGUIDE, PlatformRegistry
+
+PLAIN = (
+    "Reference number: GYG1\n"
+    "Date: Monday, November 24, 2025 at 10:00 AM\n"
+    "Main customer: Customer 1\n"
+)
+
+
+def raw_message(html, plain=PLAIN):
+    message = EmailMessage()
+    message['From'] = 'GetYourGuide <partner@notification.getyourguide.com>'
+    message['Subject'] = 'Booking - S1'
+    message.set_content(plain)
+    message.add_alternative(html, subtype='html')
+    return message.as_bytes()
+
+
+class ParseRawMessageTest(unittest.TestCase):
+    def parse(self, raw):
+        return parse_raw_message('test.eml', raw, SubjectTriage(), PlatformRegistry([GETYOURGUIDE]))
+
+    def test_falls_back_to_plain_when_html_has_no_booking(self):
+        # HTMLが画像だけなどで抽出できなくても、GmailMonitorと同じくテキスト本文から取り出す
+        record = self.parse(raw_message('<html><body><img src="cid:logo"></body></html>'))
+        self.assertIsNotNone(record)
+        self.assertEqual(record['platform'], 'GetYourGuide')
+
+    def test_prefers_html(self):
+        html = f"<html><body><p>{PLAIN.replace(chr(10), '</p><p>').replace('Customer 1', 'Customer H')}</p></body></html>"
+        record = self.parse(raw_message(html))
+        self.assertIn('Customer H', str(record))
+
+
+if __name__ == '__main__':
+    unittest.main()
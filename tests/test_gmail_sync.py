@@ -0,0 +1,173 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Function.GmailMonitor import GmailMonitor
+from Function.MessageLedger import MessageLedger, STATE_LISTED
+
+
+class StubRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self, http=None):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class StubBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        error = self.service.batch_errors.pop(0) if self.service.batch_errors else None
+        if error is not None:
+            raise error
+        for request_id, request in self.requests:
+            self.callback(request_id, request.execute(), None)
+
+
+class StubGmail:
+    """history.list・messages.get・バッチだけを返すGmail APIのスタブ"""
+
+    def __init__(self):
+        self.history_pages = []  # history.listの応答（呼び出しごとに先頭から返す）
+        self.search_ids = []     # messages.listの検索結果
+        self.history_params = []  # history.listに渡された引数
+        self.batch_errors = []  # バッチの実行で送出する例外（先頭から1回ずつ、Noneなら成功）
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return self
+
+    def labels(self):
+        return self
+
+    def list(self, **kwargs):
+        if 'startHistoryId' in kwargs:
+            self.history_params.append(kwargs)
+            return StubRequest(self.history_pages.pop(0))
+        if 'q' in kwargs:
+            return StubRequest({'messages': [{'id': message_id} for message_id in self.search_ids]})
+        return StubRequest({'labels': [{'id': 'Label_1', 'name': 'booking-notified'}]})
+
+    def get(self, userId, id, format, metadataHeaders=None):
+        return StubRequest({
+            'id': id,
+            'labelIds': ['INBOX'],
+            'payload': {'headers': [
+                {'name': 'From', 'value': 'GetYourGuide <partner@notification.getyourguide.com>'},
+                {'name': 'Subject', 'value': f'Booking - {id}'},
+            ]},
+        })
+
+    def new_batch_http_request(self, callback):
+        return StubBatch(self, callback)
+
+
+def history_page(history_id, *message_ids):
+    return {
+        'historyId': history_id,
+        'history': [{'messagesAdded': [{'message': {'id': message_id}}]} for message_id in message_ids],
+    }
+
+
+def unavailable():
+    return HttpError(httplib2.Response({'status': 503}), b'backend error')
+
+
+class HistorySyncTest(unittest.TestCase):
+    SENDER = 'notification.getyourguide.com'
+
+    def setUp(self):
+        environ = {
+            'GMAIL_SYNC_MODE': 'history',
+            'GMAIL_RETRY_ATTEMPTS': '1',
+            'BOOKING_STORE_DB': '',
+        }
+        patcher = mock.patch.dict(os.environ, environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.gmail = StubGmail()
+        self.ledger = MessageLedger(':memory:')
+        self.ledger.set_watermark('history_id', '100')
+        with mock.patch.object(GmailMonitor, '_authenticate', return_value=self.gmail):
+            self.monitor = GmailMonitor(ledger=self.ledger)
+
+    def test_failed_triage_keeps_message_for_resume(self):
+        # 1回目: 差分にAがあるが、ヘッダーの取得が一時的なエラーのまま失敗する
+        self.gmail.history_pages.append(history_page('200', 'A'))
+        self.gmail.batch_errors.append(unavailable())
+        with self.assertRaises(HttpError):
+            self.monitor.poll_new_messages(self.SENDER)
+        self.assertEqual(self.monitor.history_id, '100')
+
+        # 2回目: 差分が空でも、Aは台帳に残って再処理の対象になる
+        self.gmail.history_pages.append(history_page('200'))
+        self.assertEqual(self.monitor.poll_new_messages(self.SENDER), [])
+        self.assertEqual(self.monitor.history_id, '200')
+        self.assertEqual(self.ledger.state_of('A'), STATE_LISTED)
+        self.assertEqual(self.ledger.pending_ids(self.monitor.max_attempts), ['A'])
+
+        handled = []
+        with mock.patch.object(GmailMonitor, '_handle_message', lambda monitor, message_id, message, line_api: handled.append(message_id)):
+            self.monitor.resume_pending(line_api=None, sender_email=self.SENDER)
+        self.assertEqual(handled, ['A'])
+
+    def test_failed_triage_is_not_dropped_on_next_poll(self):
+        self.gmail.history_pages.append(history_page('200', 'A'))
+        self.gmail.batch_errors.append(unavailable())
+        with self.assertRaises(HttpError):
+            self.monitor.poll_new_messages(self.SENDER)
+
+        # 同期位置が進んでいないため、次の差分にも同じAが含まれる
+        self.gmail.history_pages.append(history_page('200', 'A'))
+        messages = self.monitor.poll_new_messages(self.SENDER)
+        self.assertEqual([message_id for message_id, _ in messages], ['A'])
+
+    def test_failed_body_fetch_keeps_message_for_resume(self):
+        # ヘッダーは取得できたが、同期位置を進めた後の本文の取得が失敗する
+        self.gmail.history_pages.append(history_page('200', 'A'))
+        self.gmail.batch_errors = [None, unavailable()]
+        with self.assertRaises(HttpError):
+            self.monitor.poll_new_messages(self.SENDER)
+
+        self.assertEqual(self.monitor.history_id, '200')
+        self.assertNotIn('A', self.monitor._recent_ids)
+        self.assertEqual(self.ledger.pending_ids(self.monitor.max_attempts), ['A'])
+
+    def test_history_covers_mail_outside_inbox(self):
+        # フィルタで受信トレイをスキップした予約メールも差分に含める
+        self.gmail.history_pages.append(history_page('200', 'A'))
+        self.monitor.poll_new_messages(self.SENDER)
+        self.assertNotIn('labelId', self.gmail.history_params[0])
+
+    def test_catch_up_survives_failed_chunk(self):
+        # キャッチアップのチャンクが一時的なエラーのまま失敗しても、例外で起動を止めない
+        self.gmail.search_ids = ['B', 'A']
+        self.gmail.batch_errors.append(unavailable())
+        self.monitor._thread_http = lambda: None
+        self.assertEqual(self.monitor.catch_up(self.SENDER, line_api=None, workers=1), 0)
+        self.assertCountEqual(self.ledger.pending_ids(self.monitor.max_attempts), ['A', 'B'])
+
+
+if __name__ == '__main__':
+    unittest.main()
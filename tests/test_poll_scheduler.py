@@ -0,0 +1,38 @@
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Function.PollScheduler import PollScheduler
+
+
+class PollSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {'POLL_JITTER': '0', 'POLL_QUIET_HOURS': '', 'POLL_PEAK_HOURS': ''})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = PollScheduler()
+
+    def test_many_idle_polls_stay_at_max_interval(self):
+        # 新着のない状態が何日も続いても、間隔は上限のままで例外にならない
+        for _ in range(5000):
+            interval = self.scheduler.record_success(0)
+        self.assertEqual(interval, self.scheduler.max_interval)
+        self.assertGreater(self.scheduler.next_run_at, time.time())
+
+    def test_many_errors_stay_at_max_interval(self):
+        for _ in range(5000):
+            interval = self.scheduler.record_error()
+        self.assertEqual(interval, self.scheduler.max_interval)
+
+    def test_backoff_grows_before_reaching_max(self):
+        for _ in range(self.scheduler.idle_grace):
+            self.assertEqual(self.scheduler.record_success(0), self.scheduler.interval)
+        self.assertEqual(self.scheduler.record_success(0), self.scheduler.interval * self.scheduler.backoff_factor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Function.HtmlText import html_to_text
+from Function.PlatformRegistry import GETYOURGUIDE
+from Function.TemplateCache import TemplateCache
+
+
+def generic(html):
+    return GETYOURGUIDE.extract(html_to_text(html))
+
+
+def booking_html(index, intro):
+    return (
+        f"<html><body><p>{intro}</p>"
+        f"<p>Reference number: GYG{index}</p>"
+        f"<p>Date: Monday, November 24, 2025 at 10:00 AM</p>"
+        f"<p>Main customer: Customer {index}</p></body></html>"
+    )
+
+
+def language_table_html(index, language, tour_language):
+    return (
+        "<html><body><table>"
+        f"<tr><td>Reference number</td><td>GYG{index}</td></tr>"
+        f"<tr><td>Main customer:</td><td>Customer {index}</td></tr>"
+        f"<tr><td>Language</td><td>{language}</td></tr>"
+        f"<tr><td>Tour language</td><td>{tour_language}</td></tr>"
+        "</table></body></html>"
+    )
+
+
+class TemplateCacheTest(unittest.TestCase):
+    def extract(self, cache, html):
+        return cache.extract(html, generic, namespace=GETYOURGUIDE.name, extract_text=GETYOURGUIDE.extract)
+
+    def test_hit_matches_generic(self):
+        cache = TemplateCache(confirmations=2)
+        for index in range(4):
+            html = booking_html(index, 'Thanks for partnering with us')
+            self.assertEqual(self.extract(cache, html), generic(html))
+
+    def test_label_in_unmapped_fragment_falls_back(self):
+        # 挨拶文だった段落に「Option:」が入っても、学習済みの位置だけで取り出さない
+        cache = TemplateCache(confirmations=2)
+        for index in range(3):
+            self.extract(cache, booking_html(index, 'Thanks for partnering with us'))
+
+        html = booking_html(9, 'Option: Private tour, max 4 people')
+        booking_info = self.extract(cache, html)
+        self.assertEqual(booking_info, generic(html))
+        self.assertEqual(booking_info['options'], 'Private tour, max 4 people')
+
+    def test_equal_values_while_learning_are_not_swapped(self):
+        # 学習中のメールでは言語とツアー言語が同じ値でも、後で違う値になったときに取り違えない
+        cache = TemplateCache(confirmations=2)
+        for index in range(4):
+            self.extract(cache, language_table_html(index, 'English', 'English'))
+
+        html = language_table_html(9, 'German', 'English')
+        booking_info = self.extract(cache, html)
+        self.assertEqual(booking_info, generic(html))
+        self.assertEqual(booking_info['tour_language'], 'English')
+        self.assertEqual(booking_info['language'], 'German')
+
+    def test_learns_after_distinct_values(self):
+        cache = TemplateCache(confirmations=1)
+        self.extract(cache, language_table_html(0, 'English', 'English'))
+        for index, (language, tour_language) in enumerate([('German', 'English'), ('English', 'English'), ('French', 'Spanish')], 1):
+            html = language_table_html(index, language, tour_language)
+            self.assertEqual(self.extract(cache, html), generic(html))
+
+
+if __name__ == '__main__':
+    unittest.main()